@@ -1,9 +1,13 @@
 import socket
+import time
 
 from django.conf import settings
 
 from djutils.dashboard.provider import PanelProvider
 from djutils.dashboard.registry import registry
+from djutils.queue.queue import get_queue_name, invoker
+from djutils.queue.registry import registry as command_registry
+from djutils.queue.stats import CommandStats, QueueStats, get_stats, stats
 
 try:
     import psycopg2
@@ -30,6 +34,9 @@ REDIS_SERVERS = make_a_list(getattr(settings, 'DASHBOARD_REDIS_CONNECTION', None
 # a list of multiple
 MEMCACHED_SERVERS = make_a_list(getattr(settings, 'DASHBOARD_MEMCACHED_CONNECTION', None))
 
+# plot the depth of the queue and the stats published by the consumer
+QUEUE_PANELS = getattr(settings, 'DASHBOARD_QUEUE_PANELS', False)
+
 
 class CPUInfo(PanelProvider):
     def get_title(self):
@@ -293,9 +300,130 @@ class MemcachedItemsInCache(MemcachedPanelProvider):
         return data_dict
 
 
+class QueueDepth(PanelProvider):
+    """
+    Number of messages waiting in the default queue, in each named queue
+    commands are routed to, and in the dead-letter queue.  The panels are
+    updated by the consumer, which has registered every command
+    """
+    def get_title(self):
+        return 'Queue depth'
+    
+    def get_data(self):
+        data_dict = {
+            'messages': len(invoker.queue),
+            'dead': len(invoker.get_dead_queue()),
+        }
+        
+        # the named queues used so far, and those commands are routed to
+        for name in command_registry.get_queue_names():
+            invoker.get_queue(name)
+        for queue in invoker.get_queues()[1:]:
+            data_dict[queue.name] = len(queue)
+        
+        return data_dict
+
+
+class QueueThroughput(PanelProvider):
+    """
+    Number of commands executed and failed by every consumer since the panel
+    was last updated
+    """
+    def __init__(self):
+        # the counters last seen for each consumer, with when it was started
+        # and last published its stats
+        self.last = {}
+    
+    def get_title(self):
+        return 'Queue throughput'
+    
+    def get_data(self):
+        executed = failed = 0
+        for consumer_id, counters in get_stats()['consumers'].items():
+            current = (counters['started'], counters['updated'], counters['executed'], counters['failed'])
+            
+            # the counters start over when the consumer is restarted
+            last = self.last.get(consumer_id)
+            if last and last[0] == current[0]:
+                executed += current[2] - last[2]
+                failed += current[3] - last[3]
+            else:
+                executed += current[2]
+                failed += current[3]
+            self.last[consumer_id] = current
+        
+        # forget consumers whose stats have expired
+        cutoff = time.time() - QueueStats.cache_timeout
+        for consumer_id, last in self.last.items():
+            if last[1] < cutoff:
+                del(self.last[consumer_id])
+        
+        return {
+            'executed': executed,
+            'failed': failed,
+        }
+
+
+class QueueLatency(PanelProvider):
+    """
+    The slowest 95th percentile wait and run times of any command executed
+    since the panel was last updated, in milliseconds
+    """
+    def __init__(self):
+        # the dump last seen for each consumer
+        self.last = {}
+    
+    def get_title(self):
+        return 'Queue latency (ms)'
+    
+    def get_data(self):
+        commands = {}
+        for dump in stats.get_dumps(get_queue_name()):
+            # the histograms start over when the consumer is restarted
+            last = self.last.get(dump['consumer'])
+            if last and last['started'] != dump['started']:
+                last = None
+            
+            for command_str, data in dump['commands'].items():
+                command_stats = CommandStats.from_dict(data)
+                if last and command_str in last['commands']:
+                    previous = CommandStats.from_dict(last['commands'][command_str])
+                    command_stats.wait.subtract(previous.wait)
+                    command_stats.run.subtract(previous.run)
+                
+                if command_str in commands:
+                    commands[command_str].merge(command_stats)
+                else:
+                    commands[command_str] = command_stats
+            
+            self.last[dump['consumer']] = dump
+        
+        # forget consumers whose stats have expired
+        cutoff = time.time() - QueueStats.cache_timeout
+        for consumer_id, last in self.last.items():
+            if last['updated'] < cutoff:
+                del(self.last[consumer_id])
+        
+        wait = run = 0
+        for command_stats in commands.values():
+            wait = max(wait, command_stats.wait.percentile(95))
+            run = max(run, command_stats.run.percentile(95))
+        
+        return {
+            'wait_p95': int(wait * 1000),
+            'run_p95': int(run * 1000),
+        }
+
+
 registry.register(CPUInfo)
 
 
+if QUEUE_PANELS:
+    registry.register(QueueDepth)
+    registry.register(QueueThroughput)
+    registry.register(QueueLatency)
+
+
 if REDIS_SERVERS:
     registry.register(RedisConnectedClients)
     registry.register(RedisMemoryUsage)
@@ -0,0 +1,416 @@
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from optparse import make_option
+
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from djutils.management.commands.queue_consumer import Command as QueueConsumer
+from djutils.queue.backends.sqlite import SqliteQueue
+from djutils.queue.queue import Invoker, QueueCommand, get_queue_class, get_queue_name, invoker
+from djutils.queue.stats import QueueStats
+from djutils.utils.helpers import ObjectDict, load_class
+
+
+# version of the results format, bump it when the meaning of a field changes
+# so results from different versions are not compared
+RESULTS_VERSION = 2
+
+
+class BenchmarkCommand(QueueCommand):
+    """
+    Records how long it waited between being written to the queue and being
+    executed, using the time the invoker stamps each message with.  The data
+    is the payload
+    """
+    latencies = []
+    
+    def execute(self):
+        self.latencies.append(time.time() - self.enqueued_at / 1000.0)
+
+
+class NullHandler(logging.Handler):
+    """
+    Discards every record -- logging.NullHandler is new in python 2.7
+    """
+    def emit(self, record):
+        pass
+
+
+class BenchmarkConsumer(QueueConsumer):
+    """
+    A consumer that logs nothing, so logging does not skew the measurements,
+    and keeps its stats to itself so the benchmark does not show up in the
+    stats of the queue's real consumers
+    """
+    def initialize_options(self, options):
+        super(BenchmarkConsumer, self).initialize_options(options)
+        self.stats = QueueStats()
+    
+    def save_stats(self):
+        pass
+    
+    def get_logger(self, verbosity=1):
+        logger = logging.getLogger('djutils.queue.benchmark')
+        if not logger.handlers:
+            logger.addHandler(NullHandler())
+        logger.propagate = False
+        return logger
+
+
+def percentile(values, p):
+    """
+    Return the value that p percent of the sorted list 'values' are at or
+    below
+    """
+    if not values:
+        return 0
+    index = int(len(values) * p / 100.0 + .5) - 1
+    return values[max(0, min(index, len(values) - 1))]
+
+
+class QueueBenchmark(object):
+    """
+    Measures the throughput and latency of a queue backend through the
+    invoker and the consumer.  Each benchmark returns a list of results, one
+    dictionary per measurement
+    """
+    def __init__(self, queue_class, messages=1000, connection=None):
+        self.backend = '%s.%s' % (queue_class.__module__, queue_class.__name__)
+        self.messages = messages
+        self.queue = queue_class('%s-benchmark' % get_queue_name(), connection)
+        self.invoker = Invoker(self.queue)
+    
+    def get_commands(self, payload):
+        data = 'x' * payload
+        return [BenchmarkCommand(data) for i in xrange(self.messages)]
+    
+    def result(self, benchmark, payload, elapsed, **extra):
+        result = {
+            'backend': self.backend,
+            'benchmark': benchmark,
+            'payload': payload,
+            'messages': self.messages,
+            'seconds': elapsed,
+            'ops_per_sec': elapsed and self.messages / elapsed,
+        }
+        result.update(extra)
+        return result
+    
+    def enqueue(self, payload):
+        """
+        Enqueue messages one at a time, then all at once
+        """
+        self.queue.flush()
+        commands = self.get_commands(payload)
+        start = time.time()
+        for command in commands:
+            self.invoker.enqueue(command)
+        results = [self.result('enqueue', payload, time.time() - start)]
+        
+        self.queue.flush()
+        commands = self.get_commands(payload)
+        start = time.time()
+        self.invoker.enqueue_many(commands)
+        results.append(self.result('enqueue_many', payload, time.time() - start))
+        
+        self.queue.flush()
+        return results
+    
+    def dequeue(self, payload, prefetch=100):
+        """
+        Read and acknowledge messages one at a time, then 'prefetch' at a time
+        """
+        results = []
+        
+        for benchmark, n in (('dequeue', 1), ('dequeue_many', prefetch)):
+            self.queue.flush()
+            self.invoker.enqueue_many(self.get_commands(payload))
+            
+            start = time.time()
+            messages = self.invoker.read_many(n)
+            while messages:
+                for message in messages:
+                    self.invoker.ack(message)
+                messages = self.invoker.read_many(n)
+            results.append(self.result(benchmark, payload, time.time() - start))
+        
+        self.queue.flush()
+        return results
+    
+    def consume(self, payload, threads, timeout=60):
+        """
+        Time a consumer with 'threads' worker threads executing a queue full
+        of messages, and how long each message took from being enqueued to
+        being executed.  The whole backlog is enqueued before the consumer is
+        started, so the latencies include the time spent waiting for it
+        """
+        self.queue.flush()
+        BenchmarkCommand.latencies = []
+        
+        consumer = BenchmarkConsumer()
+        consumer.initialize_options(ObjectDict(
+            logfile='',
+            delay=.001,
+            backoff=1.15,
+            max_delay=.01,
+            no_periodic=True,
+            threads=threads,
+            prefetch=threads,
+            processes=0,
+            max_tasks_per_child=0,
+            min_threads=0,
+            max_threads=0,
+            queues='',
+            verbosity=0,
+        ))
+        
+        # the consumer reads from the global invoker
+        orig_queue = invoker.queue
+        invoker.queue = self.queue
+        try:
+            self.invoker.enqueue_many(self.get_commands(payload))
+            start = time.time()
+            consumer.start()
+            
+            while len(BenchmarkCommand.latencies) < self.messages and time.time() - start < timeout:
+                time.sleep(.001)
+            elapsed = time.time() - start
+            
+            consumer.shutdown()
+            consumer.stop()
+        finally:
+            invoker.queue = orig_queue
+        
+        latencies = sorted(BenchmarkCommand.latencies)
+        self.queue.flush()
+        
+        return [self.result('consume', payload, elapsed,
+            threads=threads,
+            executed=len(latencies),
+            ops_per_sec=elapsed and len(latencies) / elapsed,
+            latency_p50=percentile(latencies, 50),
+            latency_p95=percentile(latencies, 95),
+            latency_p99=percentile(latencies, 99),
+            latency_max=percentile(latencies, 100),
+        )]
+    
+    def run(self, payloads, threads):
+        results = []
+        for payload in payloads:
+            results.extend(self.enqueue(payload))
+            results.extend(self.dequeue(payload))
+            for thread_count in threads:
+                results.extend(self.consume(payload, thread_count))
+        return results
+
+
+# run in a fresh interpreter to time importing the queue, which every web
+# worker and management command that uses queue_command pays for
+STARTUP_SCRIPT = """
+import time
+start = time.time()
+from djutils.queue.decorators import queue_command
+print time.time() - start
+"""
+
+def measure_startup(runs=5):
+    """
+    Return the median time it takes to import the queue decorators, as a
+    result like those of the other benchmarks
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    timings = []
+    for i in xrange(runs):
+        process = subprocess.Popen([sys.executable, '-c', STARTUP_SCRIPT], stdout=subprocess.PIPE, env=env)
+        output = process.communicate()[0]
+        if process.returncode:
+            raise CommandError('Importing the queue failed')
+        timings.append(float(output))
+    timings.sort()
+    
+    queue_class = get_queue_class()
+    elapsed = percentile(timings, 50)
+    return {
+        'backend': '%s.%s' % (queue_class.__module__, queue_class.__name__),
+        'benchmark': 'startup',
+        'payload': 0,
+        'messages': runs,
+        'seconds': elapsed,
+        'ops_per_sec': elapsed and 1 / elapsed,
+    }
+
+
+def get_result_key(result):
+    return (result['backend'], result['benchmark'], result['payload'], result.get('threads'))
+
+def compare_results(previous, current):
+    """
+    Return a list of (result, previous ops/sec, change in percent) for each
+    result in 'current' that was also measured in 'previous'
+    """
+    if previous.get('version') != current['version']:
+        return []
+    
+    previous_results = dict(
+        (get_result_key(result), result) for result in previous['results']
+    )
+    
+    comparison = []
+    for result in current['results']:
+        old = previous_results.get(get_result_key(result))
+        if old and old['ops_per_sec']:
+            change = (result['ops_per_sec'] - old['ops_per_sec']) * 100.0 / old['ops_per_sec']
+            comparison.append((result, old['ops_per_sec'], change))
+    return comparison
+
+
+class Command(BaseCommand):
+    """
+    Benchmark the queue backends.  Example usage::
+    
+    To benchmark the database and in-memory queues and save the results:
+    
+    django-admin.py queue_benchmark --output=before.json
+    
+    To compare a later run against them:
+    
+    django-admin.py queue_benchmark --compare=before.json
+    """
+    
+    help = "Measure the throughput and latency of the queue backends"
+    option_list = BaseCommand.option_list + (
+        make_option('--backend',
+            dest='backends',
+            action='append',
+            help='Queue class to benchmark, may be given more than once (default: DatabaseQueue, MemoryQueue and SqliteQueue)'
+        ),
+        make_option('--connection',
+            dest='connection',
+            default=None,
+            help='Connection passed to the queue classes (default: QUEUE_CONNECTION)'
+        ),
+        make_option('--messages',
+            dest='messages',
+            default=1000,
+            type='int',
+            help='Number of messages per measurement'
+        ),
+        make_option('--payload',
+            dest='payloads',
+            action='append',
+            type='int',
+            help='Size of the message payload in bytes, may be given more than once (default: 100 and 10000)'
+        ),
+        make_option('--threads',
+            dest='threads',
+            action='append',
+            type='int',
+            help='Number of consumer threads, may be given more than once (default: 1 and 4)'
+        ),
+        make_option('--startup-runs',
+            dest='startup_runs',
+            default=5,
+            type='int',
+            help='Number of times to time importing the queue, 0 to skip'
+        ),
+        make_option('--output', '-o',
+            dest='output',
+            default='',
+            help='Write the results to this file rather than stdout'
+        ),
+        make_option('--compare', '-c',
+            dest='compare',
+            default='',
+            help='Print the change in ops/sec since the results in this file'
+        ),
+    )
+    
+    def handle(self, *args, **options):
+        backends = options['backends'] or [
+            'djutils.queue.backends.database.DatabaseQueue',
+            'djutils.queue.backends.memory.MemoryQueue',
+            'djutils.queue.backends.sqlite.SqliteQueue',
+        ]
+        payloads = options['payloads'] or [100, 10000]
+        threads = options['threads'] or [1, 4]
+        connection = options['connection'] or getattr(settings, 'QUEUE_CONNECTION', None)
+        
+        if options['messages'] < 1:
+            raise CommandError('messages must be at least 1')
+        
+        if min(threads) < 1:
+            raise CommandError('threads must be at least 1')
+        
+        if min(payloads) < 0:
+            raise CommandError('payload must not be negative')
+        
+        previous = None
+        if options['compare']:
+            fh = open(options['compare'])
+            previous = json.load(fh)
+            fh.close()
+        
+        results = {
+            'version': RESULTS_VERSION,
+            'started': time.time(),
+            'environment': {
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'platform': platform.platform(),
+                'database': settings.DATABASES['default']['ENGINE'],
+            },
+            'results': [],
+        }
+        
+        if options['startup_runs'] > 0:
+            results['results'].append(measure_startup(options['startup_runs']))
+        
+        for backend in backends:
+            queue_class = load_class(backend)
+            
+            # unless told otherwise, benchmark sqlite queues in a scratch file
+            filename = None
+            if issubclass(queue_class, SqliteQueue) and not options['connection']:
+                fd, filename = tempfile.mkstemp(suffix='.db')
+                os.close(fd)
+            
+            try:
+                benchmark = QueueBenchmark(queue_class, options['messages'], filename or connection)
+                results['results'].extend(benchmark.run(payloads, threads))
+            finally:
+                if filename:
+                    for suffix in ('', '-wal', '-shm'):
+                        if os.path.exists(filename + suffix):
+                            os.unlink(filename + suffix)
+        
+        if options['output']:
+            fh = open(options['output'], 'w')
+            json.dump(results, fh, indent=2, sort_keys=True)
+            fh.close()
+        else:
+            self.stdout.write(json.dumps(results, indent=2, sort_keys=True) + '\n')
+        
+        if previous is not None:
+            # written to stderr so stdout stays machine-readable
+            for result, old, change in compare_results(previous, results):
+                sys.stderr.write('%s %s payload=%d%s: %.1f -> %.1f ops/sec (%+.1f%%)\n' % (
+                    result['backend'].rsplit('.', 1)[-1],
+                    result['benchmark'],
+                    result['payload'],
+                    result.get('threads') and ' threads=%d' % result['threads'] or '',
+                    old,
+                    result['ops_per_sec'],
+                    change,
+                ))
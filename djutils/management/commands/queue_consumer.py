@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 
+import datetime
 import logging
+import multiprocessing
 import os
 import Queue
 import signal
@@ -11,18 +13,106 @@ from logging.handlers import RotatingFileHandler
 from optparse import make_option
 
 from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
 from django.db.models.loading import get_apps
 
 from djutils.queue import autodiscover
-from djutils.queue.exceptions import QueueException
-from djutils.queue.queue import invoker, queue_name, registry
+from djutils.queue.exceptions import QueueException, SoftTimeLimitExceeded, TimeLimitExceeded
+from djutils.queue.notify import get_notifier
+from djutils.queue.queue import get_queue_name, invoker, registry, validate_queue_name
+from djutils.queue.ratelimit import TokenBucket
+from djutils.queue.scheduler import PeriodicScheduler, get_tick_lock
+from djutils.queue.stats import stats
+from djutils.queue.timelimits import SignalTimeLimit, ThreadTimeLimit, call_with_time_limit
 from djutils.utils.helpers import ObjectDict
 
 
+def execute_command(message):
+    """
+    Load the command for a message and execute it -- module-level so it can
+    be sent to worker processes
+    """
+    command = registry.get_command_for_message(message)
+    limit = SignalTimeLimit(command.soft_time_limit, command.time_limit)
+    call_with_time_limit(limit, invoker.execute, command)
+
+def execute_batch(messages):
+    """
+    Load the commands for a batch of messages and execute them together
+    """
+    commands = [registry.get_command_for_message(message) for message in messages]
+    limit = SignalTimeLimit(commands[0].soft_time_limit, commands[0].time_limit)
+    call_with_time_limit(limit, invoker.execute_batch, commands)
+
+
+def parse_queues(value):
+    """
+    Parse a list of queue names and weights, i.e. 'images:1,email:5', into a
+    list of 2-tuples.  The weight defaults to 1
+    """
+    queues = []
+    for item in value.split(','):
+        if ':' in item:
+            name, weight = item.rsplit(':', 1)
+            weight = int(weight)
+        else:
+            name, weight = item, 1
+        
+        name = name.strip()
+        if not name or weight < 1:
+            raise ValueError('Invalid queue "%s"' % item)
+        validate_queue_name(name)
+        queues.append((name, weight))
+    
+    if len(set([name for name, weight in queues])) != len(queues):
+        raise ValueError('Each queue can only be listed once')
+    return queues
+
+
+class WeightedRoundRobin(object):
+    """
+    Picks each of a list of (name, weight) in proportion to its weight, with
+    the picks of each name spread out rather than bunched together
+    """
+    def __init__(self, weights):
+        self.weights = list(weights)
+        self.total = sum([weight for name, weight in self.weights])
+        self.current = dict((name, 0) for name, weight in self.weights)
+    
+    def next(self):
+        best = None
+        for name, weight in self.weights:
+            self.current[name] += weight
+            if best is None or self.current[name] > self.current[best]:
+                best = name
+        self.current[best] -= self.total
+        return best
+    
+    def order(self):
+        """
+        Return the next name, followed by the others in order of weight
+        """
+        first = self.next()
+        others = sorted(self.weights, key=lambda (name, weight): -weight)
+        return [first] + [name for name, weight in others if name != first]
+
+
 class IterableQueue(Queue.Queue):
     def __iter__(self):
         return self
     
+    def resize(self, maxsize):
+        """
+        Change how many items the queue holds, waking up any threads waiting
+        to put an item if it grew
+        """
+        self.mutex.acquire()
+        try:
+            self.maxsize = maxsize
+            self.not_full.notify_all()
+        finally:
+            self.mutex.release()
+    
     def next(self):
         result = self.get()
         if result is StopIteration:
@@ -76,10 +166,45 @@ class Command(BaseCommand):
             type='int',
             help='Number of worker threads'
         ),
+        make_option('--min-threads',
+            dest='min_threads',
+            default=0,
+            type='int',
+            help='Fewest worker threads to shrink to when idle, with --max-threads (default: 1)'
+        ),
+        make_option('--max-threads',
+            dest='max_threads',
+            default=0,
+            type='int',
+            help='Start more worker threads, up to this many, while messages are waiting'
+        ),
+        make_option('--prefetch', '-p',
+            dest='prefetch',
+            default=1,
+            type='int',
+            help='Number of messages to read from the queue at a time'
+        ),
+        make_option('--processes',
+            dest='processes',
+            default=0,
+            type='int',
+            help='Number of worker processes, use for CPU-bound commands'
+        ),
+        make_option('--max-tasks-per-child',
+            dest='max_tasks_per_child',
+            default=0,
+            type='int',
+            help='Replace a worker process after it executes this many messages, requires python 2.7'
+        ),
+        make_option('--queues', '-q',
+            dest='queues',
+            default='',
+            help='Queues to read from with their weights, i.e. images:1,email:5,default:2'
+        ),
     )
     
     def initialize_options(self, options):
-        self.queue_name = queue_name
+        self.queue_name = get_queue_name()
         
         self.logfile = options.logfile or '/var/log/djutils-%s.log' % self.queue_name
         
@@ -87,6 +212,11 @@ class Command(BaseCommand):
         self.max_delay = options.max_delay
         self.backoff_factor = options.backoff
         self.threads = options.threads
+        self.min_threads = options.min_threads
+        self.max_threads = options.max_threads
+        self.prefetch = options.prefetch
+        self.processes = options.processes
+        self.max_tasks_per_child = options.max_tasks_per_child
         self.periodic_commands = not options.no_periodic
 
         if self.backoff_factor < 1.0:
@@ -94,15 +224,115 @@ class Command(BaseCommand):
         
         if self.threads < 1:
             raise CommandError('threads must be at least 1')
-         
+        
+        if self.max_threads:
+            if self.processes:
+                raise CommandError('max-threads cannot be used with processes')
+            
+            self.min_threads = self.min_threads or 1
+            if not 1 <= self.min_threads <= self.max_threads:
+                raise CommandError('min-threads must be between 1 and max-threads')
+            
+            # start within the range
+            self.threads = min(max(self.threads, self.min_threads), self.max_threads)
+        elif self.min_threads:
+            raise CommandError('min-threads can only be used with max-threads')
+        
+        if self.prefetch < 1:
+            raise CommandError('prefetch must be at least 1')
+        
+        if self.processes < 0:
+            raise CommandError('processes must not be negative')
+        
+        if self.max_tasks_per_child < 0:
+            raise CommandError('max-tasks-per-child must not be negative')
+        
+        if self.max_tasks_per_child and sys.version_info < (2, 7):
+            raise CommandError('max-tasks-per-child requires python 2.7')
+        
+        try:
+            self.queues = parse_queues(options.queues or invoker.default_queue)
+        except ValueError, exc:
+            raise CommandError(str(exc))
+        
+        if self.processes:
+            # one thread per process, each dispatching a message and waiting
+            # for its process to execute it
+            self.threads = self.processes
+        
         # initialize delay
         self.delay = self.default_delay
         
+        # seconds between checks for scheduled messages, backing off to the
+        # maximum delay while nothing is scheduled
+        self.promote_interval = 1
+        self.promote_delay = self.promote_interval
+        
+        # longest the periodic thread sleeps before checking the clock again
+        self.max_periodic_sleep = 60
+        
+        # seconds between checks for batches that have waited long enough
+        self.batch_interval = .1
+        
+        # seconds between publishing stats to the cache, and the stats the
+        # executed commands are recorded in
+        self.stats_interval = 10
+        self.stats = stats
+        
+        # seconds to wait for the result of a command past its time limit,
+        # before giving up on the worker process executing it
+        self.time_limit_grace = 1
+        
+        # seconds between checks of whether to start or stop worker threads.
+        # Threads are added once every worker has been busy with messages
+        # waiting for scale_up_after checks in a row, and idle ones are
+        # removed once some have been idle, with nothing waiting, for
+        # scale_down_after checks in a row
+        self.autoscale_interval = 1
+        self.scale_up_after = 2
+        self.scale_down_after = 30
+        
         self.logger = self.get_logger(int(options.verbosity))
         
-        # queue to track messages to be processed
-        self._queue = IterableQueue()
-        self._pool = threading.BoundedSemaphore(self.threads)
+        # bounded buffer of messages waiting for a worker thread -- the
+        # processor blocks once every worker has a message waiting
+        self._queue = IterableQueue(self.threads)
+        
+        # the order queues are read from, and the queues themselves so that
+        # scheduled and unacknowledged messages in them are looked after
+        self._lanes = WeightedRoundRobin(self.queues)
+        for name, weight in self.queues:
+            invoker.get_queue(name)
+        
+        self._processor = None
+        self._handoff = threading.Lock()
+        self._workers = []
+        self._process_pool = None
+        
+        # results of jobs that ran past their time limit, whose process was
+        # killed -- they never arrive, so the pool cannot be closed cleanly
+        self._abandoned = []
+        self._abandoned_lock = threading.Lock()
+        
+        # number of worker threads executing a message, and the state of the
+        # autoscaler
+        self._busy = 0
+        self._busy_lock = threading.Lock()
+        self._autoscaler = None
+        self._busy_checks = 0
+        self._idle_checks = 0
+        self._spare = None
+        
+        # messages for batched commands waiting to be executed, keyed by
+        # command class, and the time the first message of each was added
+        self._batches = {}
+        self._batch_started = {}
+        self._batch_lock = threading.Lock()
+        self._batcher = None
+        
+        # token buckets for rate-limited commands, keyed by command class
+        self._buckets = {}
+        self._bucket_lock = threading.Lock()
         
         self._shutdown = threading.Event()
     
@@ -135,16 +365,108 @@ class Command(BaseCommand):
         return self.spawn(self.enqueue_periodic_commands)
 
     def enqueue_periodic_commands(self):
-        while 1:
-            start = time.time()
-            self.logger.debug('Enqueueing periodic commands')
+        scheduler = PeriodicScheduler(
+            registry.get_periodic_commands(),
+            lock=get_tick_lock(),
+            prefix='%s.' % self.queue_name,
+        )
+        
+        while len(scheduler) and not self._shutdown.is_set():
+            for dt, command in scheduler.pop_due():
+                command_str = registry.command_to_string(type(command))
+                
+                try:
+                    if not scheduler.claim(dt, command):
+                        self.logger.debug('Periodic command %s due at %s claimed by another consumer' % (command_str, dt))
+                        continue
+                    
+                    self.logger.debug('Enqueueing periodic command %s due at %s' % (command_str, dt))
+                    invoker.enqueue(command)
+                except:
+                    self.logger.error('Error enqueueing periodic commands', exc_info=1)
+            
+            # wake up at least once a minute in case the clock is changed
+            wait = scheduler.seconds_until_next()
+            if wait:
+                time.sleep(min(wait, self.max_periodic_sleep))
+    
+    def start_reaper_thread(self):
+        self.logger.info('Starting reaper thread')
+        return self.spawn(self.reap_messages)
+    
+    def reap_messages(self):
+        interval = invoker.queue.visibility_timeout / 2.0
+        
+        while not self._shutdown.is_set():
+            self.logger.debug('Requeueing unacknowledged messages')
             
             try:
-                invoker.enqueue_periodic_commands()
+                requeued = invoker.reap()
             except:
-                self.logger.error('Error enqueueing periodic commands', exc_info=1)
+                self.logger.error('Error requeueing unacknowledged messages', exc_info=1)
+            else:
+                if requeued:
+                    self.logger.warn('Requeued %d unacknowledged messages' % requeued)
             
-            time.sleep(60 - (time.time() - start))
+            self._shutdown.wait(interval)
+    
+    def start_promoter_thread(self):
+        self.logger.info('Starting scheduled message promotion thread')
+        return self.spawn(self.promote_messages)
+    
+    def promote_messages(self):
+        # the notifier's connection cannot be shared with the processor, so
+        # this thread listens for newly scheduled messages on one of its own
+        notifier = None
+        if invoker.notifier is not None:
+            notifier = get_notifier()
+            channels = [invoker.get_schedule_channel(invoker.get_queue(name)) for name, weight in self.queues]
+        
+        try:
+            while not self._shutdown.is_set():
+                try:
+                    timeout = self.promote_scheduled()
+                except:
+                    self.logger.error('Error promoting scheduled messages', exc_info=1)
+                    timeout = self.promote_interval
+                
+                if notifier is None:
+                    self._shutdown.wait(timeout)
+                    continue
+                
+                try:
+                    if notifier.wait(channels, timeout):
+                        self.promote_delay = self.promote_interval
+                except:
+                    self.logger.error('Error waiting for a notification', exc_info=1)
+                    self._shutdown.wait(timeout)
+        finally:
+            if notifier is not None:
+                notifier.close()
+    
+    def promote_scheduled(self):
+        """
+        Promote the scheduled messages that are due, returning how many
+        seconds to wait before checking again -- until the next message is
+        due, but backing off while nothing is scheduled
+        """
+        now = time.time()
+        eta = invoker.next_eta()
+        
+        if eta is not None and eta <= now:
+            promoted = invoker.promote()
+            self.promote_delay = self.promote_interval
+            if promoted:
+                self.logger.debug('Promoted %d scheduled messages' % promoted)
+                return 0
+            return self.promote_interval
+        
+        timeout = self.promote_delay
+        self.promote_delay = min(self.promote_delay * self.backoff_factor, self.max_delay)
+        
+        if eta is not None:
+            timeout = min(timeout, eta - now)
+        return timeout
     
     def start_processor(self):
         self.logger.info('Starting processor thread')
@@ -155,64 +477,443 @@ class Command(BaseCommand):
             self.process_message()
     
     def process_message(self):
-        message = invoker.read()
-        
-        if message:
-            self._pool.acquire()
+        # held while messages are in hand, so shutting down can wait for
+        # them to reach the buffer without waiting out the back-off
+        self._handoff.acquire()
+        try:
+            # read from the next queue in turn, or if it is empty from any
+            # other queue that has messages waiting
+            try:
+                queue, messages = invoker.read_first(self.prefetch, self._lanes.order())
+            except:
+                # i.e. the database went away, back off and try again
+                self.logger.error('Error reading messages', exc_info=1)
+                messages = []
             
-            self.logger.info('Processing: %s' % message)
+            for message in messages:
+                self.logger.info('Processing from %s: %s' % (queue, message))
+                
+                # hand the message off to the worker threads, waiting for
+                # room in the buffer if they are all busy
+                self._queue.put((queue, message))
+        finally:
+            self._handoff.release()
+        
+        if messages:
             self.delay = self.default_delay
-            
-            # put the message into the queue for the scheduler
-            self._queue.put(message)
-            
-            # wait to acknowledge receipt of the message
-            self.logger.debug('Waiting for receipt of message')
-            self._queue.join()
-        else:
+        elif not invoker.queue.blocking:
             if self.delay > self.max_delay:
                 self.delay = self.max_delay
             
             self.logger.debug('No messages, sleeping for: %s' % self.delay)
             
-            time.sleep(self.delay)
+            # with a notifier the consumer is woken as soon as a message is
+            # written, so the delay only bounds how long it waits
+            try:
+                if invoker.wait(self.delay, [name for name, weight in self.queues]):
+                    self.logger.debug('Woken by a notification')
+                    self.delay = self.default_delay
+                    return
+            except:
+                self.logger.error('Error waiting for a notification', exc_info=1)
+                time.sleep(self.delay)
+            
             self.delay *= self.backoff_factor
     
-    def start_scheduler(self):
-        self.logger.info('Starting scheduler thread')
-        return self.spawn(self.scheduler)
+    def start_workers(self):
+        self.logger.info('Starting %d worker threads' % self.threads)
+        return [self.spawn(self.worker) for i in range(self.threads)]
+    
+    def worker(self):
+        for queue, message in self._queue:
+            self.set_busy(1)
+            try:
+                self.execute_message(message, queue)
+            finally:
+                self.set_busy(-1)
+        
+        # the thread is stopping, so close its database connections rather
+        # than leave them open until the consumer exits
+        for connection in connections.all():
+            connection.close()
+    
+    def set_busy(self, n):
+        self._busy_lock.acquire()
+        try:
+            self._busy += n
+        finally:
+            self._busy_lock.release()
+    
+    def start_autoscaler_thread(self):
+        self.logger.info('Starting autoscaler thread, %d to %d worker threads' % (
+            self.min_threads, self.max_threads))
+        return self.spawn(self.autoscale_workers)
+    
+    def autoscale_workers(self):
+        while not self._shutdown.is_set():
+            try:
+                # only count the messages in the queues when the workers
+                # cannot keep up, so an idle consumer makes no extra queries
+                backlog = 0
+                if self._busy >= self.threads:
+                    backlog = sum([len(invoker.get_queue(name)) for name, weight in self.queues])
+                
+                change = self.autoscale(self._busy, self._queue.qsize(), backlog)
+                if change:
+                    self.logger.info('%s %d worker threads, %d busy, %d messages waiting' % (
+                        change > 0 and 'Starting' or 'Stopping', abs(change), self._busy,
+                        self._queue.qsize() + backlog))
+                    self.scale_workers(change)
+            except:
+                self.logger.error('Error scaling worker threads', exc_info=1)
+            
+            self._shutdown.wait(self.autoscale_interval)
+    
+    def autoscale(self, busy, buffered, backlog):
+        """
+        Return the number of worker threads to start, or to stop if negative,
+        given how many are busy and how many messages are waiting in the
+        buffer and in the queues
+        """
+        waiting = buffered + backlog
+        
+        if waiting and busy >= self.threads:
+            self._idle_checks = 0
+            self._spare = None
+            self._busy_checks += 1
+            if self._busy_checks >= self.scale_up_after and self.threads < self.max_threads:
+                self._busy_checks = 0
+                return min(waiting, self.max_threads - self.threads)
+        
+        elif not waiting and busy < self.threads:
+            self._busy_checks = 0
+            self._idle_checks += 1
+            
+            # only remove threads that were idle at every check
+            spare = self.threads - busy
+            if self._spare is None or spare < self._spare:
+                self._spare = spare
+            
+            if self._idle_checks >= self.scale_down_after and self.threads > self.min_threads:
+                spare, self._spare = self._spare, None
+                self._idle_checks = 0
+                return -min(spare, self.threads - self.min_threads)
+        
+        else:
+            self._busy_checks = self._idle_checks = 0
+            self._spare = None
+        
+        return 0
+    
+    def scale_workers(self, n):
+        """
+        Start 'n' more worker threads, or stop -n of them once they have
+        finished the message they are executing
+        """
+        self.threads += n
+        if n > 0:
+            self._workers.extend([self.spawn(self.worker) for i in range(n)])
+        else:
+            # there is room in the buffer until it is resized
+            for i in range(-n):
+                self._queue.put(StopIteration)
+        self._queue.resize(self.threads)
     
-    def scheduler(self):
-        for job in self._queue:
-            # spin up a worker with the given job
-            self.spawn(self.worker, job)
+    def start_process_pool(self):
+        self.logger.info('Starting %d worker processes' % self.processes)
+        
+        # the worker processes are forked from this one, so they inherit the
+        # registry as-is, but must open their own database connections
+        for connection in connections.all():
+            connection.close()
+        
+        kwargs = {}
+        if self.max_tasks_per_child:
+            kwargs['maxtasksperchild'] = self.max_tasks_per_child
+        return multiprocessing.Pool(self.processes, **kwargs)
     
-    def worker(self, message):        
-        # indicate receipt of the task
-        self._queue.task_done()
+    def stop_process_pool(self):
+        """
+        Wait for the worker processes to exit.  Closing the pool waits for
+        every job to finish, including those lost with a killed process, so
+        if there are any the pool is terminated instead
+        """
+        self._abandoned_lock.acquire()
+        try:
+            lost = [result for result in self._abandoned if not result.ready()]
+        finally:
+            self._abandoned_lock.release()
         
+        if lost:
+            self.logger.info('Terminating worker processes, %d jobs were lost' % len(lost))
+            self._process_pool.terminate()
+        else:
+            self._process_pool.close()
+        self._process_pool.join()
+    
+    def execute_message(self, message, queue=None):
+        batched = False
         try:
             command = registry.get_command_for_message(message)
-            command.execute()
+            
+            if not self.check_rate_limit(command):
+                # a copy was put back in the queue, the message that was read
+                # is acknowledged below
+                return
+            
+            if command.batch_size:
+                # acknowledged once the batch has been executed
+                batched = True
+                self.add_to_batch(command, message, queue)
+            else:
+                self.run_command(command, message)
+        except (SoftTimeLimitExceeded, TimeLimitExceeded):
+            self.logger.warn('time limit exceeded: %s' % message, exc_info=1)
+            self.retry_message(message)
         except QueueException:
             # log error
             self.logger.warn('queue exception raised', exc_info=1)
+            self.retry_message(message)
         except:
-            # log the error and raise, killing the worker
+            # log the error, the worker moves on to the next message
             self.logger.error('unhandled exception in worker thread', exc_info=1)
+            self.retry_message(message)
+        finally:
+            if not batched:
+                invoker.ack(message, queue)
+    
+    def run_command(self, command, message):
+        start = time.time()
+        success = timed_out = False
+        try:
+            if self._process_pool:
+                self.apply(execute_command, (message,), command.time_limit)
+            else:
+                limit = ThreadTimeLimit(command.soft_time_limit or command.time_limit)
+                call_with_time_limit(limit, invoker.execute, command)
+            success = True
+        except (SoftTimeLimitExceeded, TimeLimitExceeded):
+            timed_out = True
+            raise
+        finally:
+            self.record_stats([command], start, success, timed_out)
+    
+    def apply(self, func, args, time_limit=None):
+        """
+        Execute 'func' in a worker process.  A process that runs past the
+        time limit is killed and replaced by the pool, and its result never
+        arrives, so stop waiting for it shortly after the limit
+        """
+        result = self._process_pool.apply_async(func, args)
+        if not time_limit:
+            return result.get()
+        
+        try:
+            return result.get(time_limit + self.time_limit_grace)
+        except multiprocessing.TimeoutError:
+            self._abandoned_lock.acquire()
+            try:
+                self._abandoned = [r for r in self._abandoned if not r.ready()]
+                self._abandoned.append(result)
+            finally:
+                self._abandoned_lock.release()
+            raise TimeLimitExceeded('Exceeded the time limit of %ss' % time_limit)
+    
+    def record_stats(self, commands, start, success, timed_out=False):
+        run = time.time() - start
+        for command in commands:
+            if command.enqueued_at:
+                wait = start - command.enqueued_at / 1000.0
+            else:
+                wait = None
+            self.stats.record(registry.command_to_string(type(command)), wait, run, success, timed_out)
+    
+    def get_bucket(self, klass):
+        self._bucket_lock.acquire()
+        try:
+            if klass not in self._buckets:
+                self._buckets[klass] = TokenBucket.from_rate_limit(klass.rate_limit)
+            return self._buckets[klass]
+        finally:
+            self._bucket_lock.release()
+    
+    def check_rate_limit(self, command):
+        """
+        Return True if the command can be executed now.  Otherwise a call is
+        reserved for it in the future and it is put back in the queue until
+        then, so the worker can move on to other messages
+        """
+        if not command.rate_limit or command.rate_limit_reserved:
+            return True
+        
+        delay = self.get_bucket(type(command)).reserve()
+        if not delay:
+            return True
+        
+        self.logger.debug('Rate limit of %s reached, deferring for %.2fs' % (
+            registry.command_to_string(type(command)), delay,
+        ))
+        
+        command.rate_limit_reserved = True
+        eta = datetime.datetime.now() + datetime.timedelta(seconds=delay)
+        invoker.defer(command, eta)
+        return False
+    
+    def add_to_batch(self, command, message, queue=None):
+        klass = type(command)
+        
+        self._batch_lock.acquire()
+        try:
+            batch = self._batches.setdefault(klass, [])
+            if not batch:
+                self._batch_started[klass] = time.time()
+            batch.append((command, message, queue))
+            
+            if len(batch) >= klass.batch_size:
+                del(self._batches[klass])
+            else:
+                batch = None
+        finally:
+            self._batch_lock.release()
+        
+        if batch:
+            self.execute_batch(batch)
+    
+    def pop_batches(self, expired_only=True):
+        """
+        Remove and return the batches whose oldest message has waited for
+        the command's batch_wait, or every batch
+        """
+        now = time.time()
+        batches = []
+        
+        self._batch_lock.acquire()
+        try:
+            for klass in self._batches.keys():
+                if not expired_only or now - self._batch_started[klass] >= klass.batch_wait:
+                    batches.append(self._batches.pop(klass))
+        finally:
+            self._batch_lock.release()
+        
+        return batches
+    
+    def execute_batch(self, batch):
+        messages = [message for _, message, _ in batch]
+        self.logger.info('Processing batch of %d: %s' % (
+            len(batch), registry.command_to_string(type(batch[0][0]))
+        ))
+        
+        commands = [command for command, _, _ in batch]
+        klass = type(commands[0])
+        start = time.time()
+        success = timed_out = False
+        try:
+            if self._process_pool:
+                self.apply(execute_batch, (messages,), klass.time_limit)
+            else:
+                limit = ThreadTimeLimit(klass.soft_time_limit or klass.time_limit)
+                call_with_time_limit(limit, invoker.execute_batch, commands)
+            success = True
+        except (SoftTimeLimitExceeded, TimeLimitExceeded):
+            timed_out = True
+            self.logger.warn('time limit exceeded executing batch', exc_info=1)
+            for message in messages:
+                self.retry_message(message)
+        except:
+            self.logger.error('unhandled exception executing batch', exc_info=1)
+            for message in messages:
+                self.retry_message(message)
         finally:
-            self._pool.release()
+            self.record_stats(commands, start, success, timed_out)
+            for _, message, queue in batch:
+                invoker.ack(message, queue)
+    
+    def start_stats_thread(self):
+        self.logger.info('Starting stats thread')
+        return self.spawn(self.publish_stats)
+    
+    def publish_stats(self):
+        while not self._shutdown.is_set():
+            self.save_stats()
+            self._shutdown.wait(self.stats_interval)
+    
+    def save_stats(self):
+        try:
+            self.stats.publish(self.queue_name)
+        except:
+            self.logger.error('Error publishing stats', exc_info=1)
+    
+    def start_batch_thread(self):
+        self.logger.info('Starting batch thread')
+        return self.spawn(self.execute_expired_batches)
+    
+    def execute_expired_batches(self):
+        while not self._shutdown.is_set():
+            for batch in self.pop_batches():
+                self.execute_batch(batch)
+            
+            self._shutdown.wait(self.batch_interval)
+    
+    def retry_message(self, message):
+        try:
+            if invoker.retry(message):
+                self.logger.info('Retrying: %s' % message)
+            else:
+                self.logger.warn('Moved to the dead-letter queue: %s' % message)
+        except:
+            self.logger.error('Error retrying message', exc_info=1)
     
     def start(self):
+        # fork any worker processes before starting threads
+        if self.processes:
+            self._process_pool = self.start_process_pool()
+        
         if self.periodic_commands:
             self.start_periodic_command_thread()
         
-        self._scheduler = self.start_scheduler()
+        if invoker.queue.reliable:
+            self.start_reaper_thread()
+        
+        self.start_promoter_thread()
+        self._batcher = self.start_batch_thread()
+        self.start_stats_thread()
+        
+        self._workers = self.start_workers()
+        if self.max_threads:
+            self._autoscaler = self.start_autoscaler_thread()
         self._processor = self.start_processor()
     
+    def stop(self):
+        # wait for the processor to hand off any messages it has read, then
+        # let the workers drain the buffer before they exit
+        self._handoff.acquire()
+        
+        # threads stopped by the autoscaler are already on their way out
+        if self._autoscaler:
+            self._autoscaler.join()
+        
+        for i in range(self._workers and self.threads or 0):
+            self._queue.put(StopIteration)
+        
+        for worker in self._workers:
+            worker.join()
+        
+        # execute whatever is left of the batches
+        if self._batcher:
+            self._batcher.join()
+        for batch in self.pop_batches(expired_only=False):
+            self.execute_batch(batch)
+        
+        self.save_stats()
+        
+        if self._process_pool:
+            self.stop_process_pool()
+        
+        if invoker.notifier is not None:
+            invoker.notifier.close()
+    
     def shutdown(self):
         self._shutdown.set()
-        self._queue.put(StopIteration)
     
     def handle_signal(self, sig_num, frame):
         self.logger.info('Received SIGTERM, shutting down')
@@ -230,13 +931,24 @@ class Command(BaseCommand):
         
         self.initialize_options(ObjectDict(options))
         
-        self.logger.info('Initializing consumer with options:\nlogfile: %s\ndelay: %s\nbackoff: %s\nthreads: %s' % (
-            self.logfile, self.delay, self.backoff_factor, self.threads))
+        self.logger.info('Initializing consumer with options:\nlogfile: %s\ndelay: %s\nbackoff: %s\nthreads: %s\nprefetch: %s\nprocesses: %s\nqueues: %s' % (
+            self.logfile, self.delay, self.backoff_factor,
+            self.max_threads and '%d (%d-%d)' % (self.threads, self.min_threads, self.max_threads) or self.threads,
+            self.prefetch, self.processes,
+            ', '.join(['%s:%d' % queue for queue in self.queues])))
 
         self.logger.info('Loaded classes:\n%s' % '\n'.join([
             klass for klass in registry._registry
         ]))
         
+        if not self.processes:
+            hard_limited = sorted([
+                command_str for command_str, klass in registry._registry.items() if klass.time_limit
+            ])
+            if hard_limited:
+                self.logger.warn('Time limits can only kill worker processes, they are enforced as soft limits on:\n%s' % (
+                    '\n'.join(hard_limited)))
+        
         self.set_signal_handler()
         
         try:
@@ -251,3 +963,4 @@ class Command(BaseCommand):
             self.shutdown()
         
         self.logger.info('Shutdown...')
+        self.stop()
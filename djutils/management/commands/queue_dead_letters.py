@@ -0,0 +1,89 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from djutils.queue import autodiscover
+from djutils.queue.exceptions import QueueException
+from djutils.queue.queue import invoker, registry
+
+
+class Command(BaseCommand):
+    """
+    Inspect and replay the messages that failed once their retries were
+    used up.  Example usage::
+    
+    To list the messages in the dead-letter queue:
+    
+    django-admin.py queue_dead_letters
+    
+    To move them all back onto the queue, or only the first 100:
+    
+    django-admin.py queue_dead_letters --replay
+    django-admin.py queue_dead_letters --replay --limit=100
+    """
+    
+    help = "Inspect and replay the messages in the dead-letter queue"
+    
+    # number of messages listed unless a --limit is given
+    list_limit = 20
+    
+    option_list = BaseCommand.option_list + (
+        make_option('--replay', '-r',
+            dest='replay',
+            action='store_true',
+            default=False,
+            help='Move the messages back onto the queue to be executed again'
+        ),
+        make_option('--flush', '-f',
+            dest='flush',
+            action='store_true',
+            default=False,
+            help='Delete the messages'
+        ),
+        make_option('--limit', '-l',
+            dest='limit',
+            default=None,
+            type='int',
+            help='Number of messages to list (default: 20) or replay (default: all), 0 for all'
+        ),
+    )
+    
+    def describe(self, message):
+        try:
+            command = registry.get_command_for_message(message)
+        except QueueException, exc:
+            return 'unreadable message (%s)' % exc
+        
+        return '%s (retried %d times): %r' % (
+            registry.command_to_string(type(command)),
+            command.retry_count,
+            command.get_data(),
+        )
+    
+    def handle(self, *args, **options):
+        if options['replay'] and options['flush']:
+            raise CommandError('Specify either --replay or --flush')
+        
+        if options['limit'] is not None and options['limit'] < 0:
+            raise CommandError('Limit must be at least 0')
+        
+        autodiscover()
+        
+        dead_queue = invoker.get_dead_queue()
+        limit = options['limit']
+        
+        if options['replay']:
+            replayed = invoker.replay(limit or None)
+            self.stdout.write('Replayed %d messages\n' % replayed)
+        elif options['flush']:
+            dead_queue.flush()
+            self.stdout.write('Flushed the dead-letter queue\n')
+        else:
+            count = len(dead_queue)
+            self.stdout.write('%d messages in the dead-letter queue\n' % count)
+            
+            if limit is None:
+                limit = self.list_limit
+            
+            for message in dead_queue.peek(limit or count):
+                self.stdout.write('%s\n' % self.describe(message))
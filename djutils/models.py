@@ -11,6 +11,13 @@ class QueueMessage(models.Model):
     queue = models.CharField(max_length=255)
     message = models.TextField()
     created = models.DateTimeField(default=datetime.datetime.now, db_index=True)
+    priority = models.IntegerField(default=0, db_index=True)
+    
+    # set on messages scheduled for later, cleared once they are due
+    available_at = models.DateTimeField(blank=True, null=True, db_index=True)
+    
+    # set by a consumer to mark the message as taken before it is deleted
+    claim = models.CharField(max_length=32, blank=True, null=True, db_index=True)
     
     class Meta:
-        ordering = ('created',) # FIFO queue
+        ordering = ('-priority', 'created') # FIFO queue within each priority
@@ -2,8 +2,14 @@ class BaseQueue(object):
     """
     Base implementation for a Queue, all backends should subclass
     """
+    # blocking queues wait for a message in read_many(), and also accept
+    # read_many(n, block=False) and read_from(queues, n) so the consumer can
+    # wait on several queues at once
     blocking = False
     
+    # reliable queues hold on to messages until they are acknowledged
+    reliable = False
+    
     def __init__(self, name, connection):
         """
         Initialize the Queue - this happens once when the module is loaded
@@ -11,19 +17,103 @@ class BaseQueue(object):
         self.name = name
         self.connection = connection
     
-    def write(self, data):
+    def get_named_queue(self, name):
+        """
+        Return the queue called 'name' that is stored alongside this one,
+        using the same backend and connection
         """
-        Push 'data' onto the queue
+        return type(self)('%s.%s' % (self.name, name), self.connection)
+    
+    def write(self, data, priority=0):
+        """
+        Push 'data' onto the queue.  Messages with a higher priority should be
+        read before any messages with a lower priority
         """
         raise NotImplementedError
     
+    def write_many(self, messages, priority=0):
+        """
+        Push a list of messages onto the queue, preserving their order.
+        Backends that can store several messages in a single round-trip
+        should override this
+        """
+        for data in messages:
+            self.write(data, priority)
+    
+    def schedule(self, data, eta, priority=0):
+        """
+        Store 'data' so that it is not read until after the datetime 'eta',
+        and only once promote() has been called
+        """
+        raise NotImplementedError
+    
+    def promote(self):
+        """
+        Make any scheduled messages that are due available to read, returning
+        the number of messages promoted
+        """
+        return 0
+    
+    def next_eta(self):
+        """
+        Return the timestamp at which the earliest scheduled message is due,
+        or None if nothing is scheduled.  Backends that implement schedule()
+        must override this, as promote() is only called once it has passed
+        """
+        return None
+    
     def read(self):
         """
         Pop 'data' from the queue, returning None if no data is available --
-        an empty queue should not raise an Exception!
+        an empty queue should not raise an Exception!  The oldest message
+        with the highest priority is read first
         """
         raise NotImplementedError
     
+    def read_many(self, n):
+        """
+        Pop up to 'n' messages from the queue, returning them in the order
+        they were written.  An empty queue should return an empty list.
+        Backends that can fetch several messages in a single round-trip
+        should override this
+        """
+        messages = []
+        while len(messages) < n:
+            data = self.read()
+            if data is None:
+                break
+            messages.append(data)
+        return messages
+    
+    def peek(self, n):
+        """
+        Return up to 'n' messages in the order they would be read, without
+        removing them from the queue
+        """
+        raise NotImplementedError
+    
+    def remove(self, data):
+        """
+        Delete the oldest copy of a message that is waiting to be read, as
+        returned by peek(), returning whether one was found
+        """
+        raise NotImplementedError
+    
+    def ack(self, data):
+        """
+        Acknowledge that a message returned by read() has been processed.
+        Only meaningful for reliable queues
+        """
+        pass
+    
+    def reap(self):
+        """
+        Put messages that were read but never acknowledged back on the queue,
+        returning the number of messages requeued.  Only meaningful for
+        reliable queues
+        """
+        return 0
+    
     def flush(self):
         """
         Delete everything from the queue
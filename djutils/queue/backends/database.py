@@ -1,4 +1,10 @@
-from django.db import DatabaseError
+import base64
+import datetime
+import time
+import uuid
+
+from django.db import connections, router, transaction
+from django.db.models import Min
 
 from djutils.models import QueueMessage
 from djutils.queue.backends.base import BaseQueue
@@ -8,28 +14,215 @@ class DatabaseQueue(BaseQueue):
     """
     A simple Queue that uses the database for persistence, good for basic
     use-cases such as sending emails
+    
+    Messages are claimed atomically, so any number of consumers can safely
+    read from the same queue.  On PostgreSQL the oldest rows are deleted and
+    returned in a single statement, skipping any rows locked by another
+    consumer.  Other databases select the ids of the oldest rows, mark those
+    that are still unclaimed with a claim token, then read and delete the rows
+    carrying that token.  Rows claimed by another consumer in between are
+    replaced by selecting again, up to ``claim_attempts`` times
+    
+    Messages are binary, so they are stored base64-encoded
     """
+    # number of rows to write per INSERT statement -- keeps the number of
+    # query parameters under sqlite's limit of 999
+    insert_batch_size = 250
+    
+    # number of times to select rows again when other consumers claimed the
+    # selected rows first
+    claim_attempts = 3
     
     def _get_queryset(self):
-        return QueueMessage.objects.filter(queue=self.name)
+        return QueueMessage.objects.filter(queue=self.name, claim=None, available_at=None)
+    
+    def _get_connection(self):
+        db = router.db_for_write(QueueMessage)
+        return db, connections[db]
+    
+    def _encode(self, data):
+        return base64.b64encode(data)
+    
+    def _decode(self, message):
+        # messages written before they were base64-encoded contain a colon,
+        # which is not part of the base64 alphabet
+        if ':' in message:
+            return message
+        return base64.b64decode(message)
+    
+    def _insert_many(self, rows):
+        """
+        Write a list of dictionaries keyed by field name to the message table
+        using multi-row INSERT statements
+        """
+        db, connection = self._get_connection()
+        qn = connection.ops.quote_name
+        
+        fields = [QueueMessage._meta.get_field(name) for name in rows[0]]
+        names = [name for name in rows[0]]
+        
+        row_sql = '(%s)' % ', '.join(['%s'] * len(fields))
+        base_sql = 'INSERT INTO %s (%s) VALUES ' % (
+            qn(QueueMessage._meta.db_table),
+            ', '.join([qn(field.column) for field in fields]),
+        )
+        
+        cursor = connection.cursor()
+        for i in xrange(0, len(rows), self.insert_batch_size):
+            batch = rows[i:i + self.insert_batch_size]
+            params = []
+            for row in batch:
+                for name, field in zip(names, fields):
+                    params.append(field.get_db_prep_save(row[name], connection=connection))
+            cursor.execute(base_sql + ', '.join([row_sql] * len(batch)), params)
+        
+        transaction.commit_unless_managed(using=db)
+    
+    def write(self, data, priority=0):
+        QueueMessage.objects.create(queue=self.name, message=self._encode(data), priority=priority)
     
-    def write(self, data):
-        QueueMessage.objects.create(queue=self.name, message=data)
+    def write_many(self, messages, priority=0):
+        if not messages:
+            return
+        
+        # give each message a distinct timestamp so FIFO ordering on the
+        # created column is preserved within the batch
+        now = datetime.datetime.now()
+        self._insert_many([
+            dict(
+                queue=self.name,
+                message=self._encode(data),
+                priority=priority,
+                created=now + datetime.timedelta(microseconds=i),
+            ) for i, data in enumerate(messages)
+        ])
+    
+    def schedule(self, data, eta, priority=0):
+        QueueMessage.objects.create(
+            queue=self.name,
+            message=self._encode(data),
+            priority=priority,
+            available_at=eta,
+        )
+    
+    def promote(self):
+        return QueueMessage.objects.filter(
+            queue=self.name,
+            available_at__lte=datetime.datetime.now(),
+        ).update(available_at=None)
+    
+    def next_eta(self):
+        eta = QueueMessage.objects.filter(
+            queue=self.name,
+            available_at__isnull=False,
+        ).aggregate(eta=Min('available_at'))['eta']
+        if eta is not None:
+            return time.mktime(eta.timetuple()) + eta.microsecond / 1000000.0
+    
+    def _claim_skip_locked(self, db, connection, n):
+        qn = connection.ops.quote_name
+        opts = QueueMessage._meta
+        sql = (
+            'DELETE FROM %(table)s WHERE %(id)s IN ('
+                'SELECT %(id)s FROM %(table)s WHERE %(queue)s = %%s AND %(available_at)s IS NULL '
+                'ORDER BY %(priority)s DESC, %(created)s LIMIT %%s FOR UPDATE SKIP LOCKED'
+            ') RETURNING %(priority)s, %(created)s, %(message)s'
+        ) % {
+            'table': qn(opts.db_table),
+            'id': qn(opts.pk.column),
+            'queue': qn(opts.get_field('queue').column),
+            'created': qn(opts.get_field('created').column),
+            'priority': qn(opts.get_field('priority').column),
+            'available_at': qn(opts.get_field('available_at').column),
+            'message': qn(opts.get_field('message').column),
+        }
+        
+        cursor = connection.cursor()
+        cursor.execute(sql, [self.name, n])
+        rows = cursor.fetchall()
+        transaction.commit_unless_managed(using=db)
+        
+        # RETURNING makes no promises about order
+        rows.sort(key=lambda row: (-row[0], row[1]))
+        return [message for _, _, message in rows]
+    
+    def _select_pending(self, n):
+        # the ids are fetched first rather than used as a subquery -- MySQL
+        # refuses a LIMIT in an IN subquery, and selecting from the table
+        # being updated
+        return list(self._get_queryset().values_list('pk', flat=True)[:n])
+    
+    def _claim_with_token(self, db, connection, n):
+        token = uuid.uuid4().hex
+        
+        with transaction.commit_on_success(using=db):
+            claimed = 0
+            for attempt in range(self.claim_attempts):
+                pending = self._select_pending(n - claimed)
+                if not pending:
+                    break
+                
+                # only rows that are still unclaimed when the UPDATE runs are
+                # marked, so no two consumers can end up with the same message.
+                # rows taken by another consumer in the meantime are replaced
+                # by selecting again, rather than returning a short read
+                updated = QueueMessage.objects.filter(pk__in=pending, claim=None).update(claim=token)
+                claimed += updated
+                if updated == len(pending):
+                    break
+            
+            if not claimed:
+                return []
+            
+            messages = list(QueueMessage.objects.filter(claim=token).values_list('message', flat=True))
+            
+            connection.cursor().execute('DELETE FROM %s WHERE %s = %%s' % (
+                connection.ops.quote_name(QueueMessage._meta.db_table),
+                connection.ops.quote_name(QueueMessage._meta.get_field('claim').column),
+            ), [token])
+        
+        return messages
     
     def read(self):
-        try:
-            message = self._get_queryset()[0]
-        except IndexError:
-            data = None
-        except DatabaseError:
-            data = None
+        messages = self.read_many(1)
+        if messages:
+            return messages[0]
+    
+    def read_many(self, n):
+        db, connection = self._get_connection()
+        
+        if connection.vendor == 'postgresql':
+            claim = self._claim_skip_locked
         else:
-            data = message.message
-            message.delete()
-        return data
+            claim = self._claim_with_token
+        
+        return [self._decode(message) for message in claim(db, connection, n)]
+    
+    def peek(self, n):
+        messages = self._get_queryset().values_list('message', flat=True)[:n]
+        return [self._decode(message) for message in messages]
+    
+    def remove(self, data):
+        stored = [self._encode(data)]
+        
+        # messages written before they were base64-encoded are stored as-is,
+        # and were always text
+        if ':' in data:
+            try:
+                stored.append(data.decode('utf-8'))
+            except UnicodeDecodeError:
+                pass
+        
+        pks = list(self._get_queryset().filter(
+            message__in=stored,
+        ).values_list('pk', flat=True)[:1])
+        if not pks:
+            return False
+        QueueMessage.objects.filter(pk=pks[0], claim=None).delete()
+        return True
     
     def flush(self):
-        self._get_queryset().delete()
+        QueueMessage.objects.filter(queue=self.name).delete()
     
     def __len__(self):
         return self._get_queryset().count()
@@ -0,0 +1,111 @@
+import heapq
+import itertools
+import threading
+import time
+
+from djutils.queue.backends.base import BaseQueue
+
+
+class MemoryQueue(BaseQueue):
+    """
+    A Queue that keeps messages in a heap in memory, for single-process
+    deployments, tests and benchmarks.  Messages are lost when the process
+    exits and are not visible to other processes
+    """
+    def __init__(self, name, connection):
+        super(MemoryQueue, self).__init__(name, connection)
+        
+        # entries are (-priority, sequence, message), so the oldest message
+        # with the highest priority is at the top of the heap
+        self._heap = []
+        
+        # entries are (timestamp, sequence, priority, message)
+        self._scheduled = []
+        
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+    
+    def write(self, data, priority=0):
+        self.write_many([data], priority)
+    
+    def write_many(self, messages, priority=0):
+        self._lock.acquire()
+        try:
+            for data in messages:
+                heapq.heappush(self._heap, (-priority, self._counter.next(), data))
+        finally:
+            self._lock.release()
+    
+    def schedule(self, data, eta, priority=0):
+        timestamp = time.mktime(eta.timetuple()) + eta.microsecond / 1000000.0
+        
+        self._lock.acquire()
+        try:
+            heapq.heappush(self._scheduled, (timestamp, self._counter.next(), priority, data))
+        finally:
+            self._lock.release()
+    
+    def promote(self):
+        now = time.time()
+        promoted = 0
+        
+        self._lock.acquire()
+        try:
+            while self._scheduled and self._scheduled[0][0] <= now:
+                _, _, priority, data = heapq.heappop(self._scheduled)
+                heapq.heappush(self._heap, (-priority, self._counter.next(), data))
+                promoted += 1
+        finally:
+            self._lock.release()
+        
+        return promoted
+    
+    def next_eta(self):
+        self._lock.acquire()
+        try:
+            if self._scheduled:
+                return self._scheduled[0][0]
+        finally:
+            self._lock.release()
+    
+    def read(self):
+        messages = self.read_many(1)
+        if messages:
+            return messages[0]
+    
+    def read_many(self, n):
+        self._lock.acquire()
+        try:
+            return [heapq.heappop(self._heap)[2] for i in xrange(min(n, len(self._heap)))]
+        finally:
+            self._lock.release()
+    
+    def peek(self, n):
+        self._lock.acquire()
+        try:
+            return [entry[2] for entry in heapq.nsmallest(n, self._heap)]
+        finally:
+            self._lock.release()
+    
+    def remove(self, data):
+        self._lock.acquire()
+        try:
+            entries = [entry for entry in self._heap if entry[2] == data]
+            if not entries:
+                return False
+            self._heap.remove(min(entries))
+            heapq.heapify(self._heap)
+            return True
+        finally:
+            self._lock.release()
+    
+    def flush(self):
+        self._lock.acquire()
+        try:
+            self._heap = []
+            self._scheduled = []
+        finally:
+            self._lock.release()
+    
+    def __len__(self):
+        return len(self._heap)
@@ -1,40 +1,219 @@
+import os
 import re
-import redis
+import socket
+import threading
+import time
+import uuid
+
+from django.conf import settings
 
 from djutils.queue.backends.base import BaseQueue
+from djutils.queue.connections import get_redis_connection
+
+
+# lua function returning the names of the lists making up a queue, highest
+# priority first -- KEYS[1] is the list for priority 0, other priorities are
+# stored in the sorted set KEYS[2] and suffixed to the name of that list
+QUEUE_NAMES_SCRIPT = """
+local function queue_names()
+    local names = {}
+    local default_added = false
+    for _, priority in ipairs(redis.call('ZREVRANGEBYSCORE', KEYS[2], '+inf', '-inf')) do
+        if not default_added and tonumber(priority) < 0 then
+            table.insert(names, KEYS[1])
+            default_added = true
+        end
+        table.insert(names, KEYS[1] .. '.' .. priority)
+    end
+    if not default_added then
+        table.insert(names, KEYS[1])
+    end
+    return names
+end
+"""
+
+# pop up to ARGV[1] messages, oldest first, from the highest priority lists
+READ_SCRIPT = QUEUE_NAMES_SCRIPT + """
+local messages = {}
+for _, name in ipairs(queue_names()) do
+    local count = tonumber(ARGV[1]) - #messages
+    if count <= 0 then
+        break
+    end
+    local batch = redis.call('LRANGE', name, -count, -1)
+    if #batch > 0 then
+        redis.call('LTRIM', name, 0, -(#batch + 1))
+        for i = #batch, 1, -1 do
+            table.insert(messages, batch[i])
+        end
+    end
+end
+return messages
+"""
+
+# move up to ARGV[2] scheduled messages due by ARGV[1] from the sorted set
+# KEYS[3] onto the lists for their priorities
+PROMOTE_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[3], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, member in ipairs(due) do
+    local sep = string.find(member, ':', 1, true)
+    local priority_sep = string.find(member, ':', sep + 1, true)
+    local priority = string.sub(member, sep + 1, priority_sep - 1)
+    local name = KEYS[1]
+    if tonumber(priority) ~= 0 then
+        redis.call('ZADD', KEYS[2], priority, priority)
+        name = KEYS[1] .. '.' .. priority
+    end
+    redis.call('LPUSH', name, string.sub(member, priority_sep + 1))
+end
+if #due > 0 then
+    redis.call('ZREM', KEYS[3], unpack(due))
+end
+return #due
+"""
+
+LENGTH_SCRIPT = QUEUE_NAMES_SCRIPT + """
+local length = 0
+for _, name in ipairs(queue_names()) do
+    length = length + redis.call('LLEN', name)
+end
+return length
+"""
+
+FLUSH_SCRIPT = QUEUE_NAMES_SCRIPT + """
+for _, name in ipairs(queue_names()) do
+    redis.call('DEL', name)
+end
+redis.call('DEL', KEYS[2])
+"""
 
 
 class RedisQueue(BaseQueue):
     """
-    A simple Queue that uses the redis to store messages
+    A simple Queue that uses the redis to store messages.  Each priority has
+    its own list, and the priorities in use are tracked in a sorted set
     """
-    def __init__(self, name, connection):
+    # maximum number of messages to send with a single LPUSH
+    write_batch_size = 1000
+    
+    # maximum number of scheduled messages to promote per script call
+    promote_batch_size = 1000
+    
+    def __init__(self, name, connection, key=None):
         """
-        QUEUE_CONNECTION = 'host:port:database' or defaults to localhost:6379:0
+        QUEUE_CONNECTION = 'host:port:database', a redis:// or unix:// url, or
+        defaults to localhost:6379:0
+        
+        The keys are named after the queue, stripped of anything but lower
+        case letters and digits, unless a 'key' is given
         """
         super(RedisQueue, self).__init__(name, connection)
         
-        if not connection:
-            connection = 'localhost:6379:0'
+        self.queue_name = key or 'djutils.redis.%s' % re.sub('[^a-z0-9]', '', name)
         
-        self.queue_name = 'djutils.redis.%s' % re.sub('[^a-z0-9]', '', name)
-        host, port, db = connection.split(':')
-
-        self.conn = redis.Redis(
-            host=host, port=int(port), db=int(db)
-        )
+        # clients with the same connection share a pool of connections
+        self.conn = get_redis_connection(connection)
+        
+        self.priorities_key = '%s.priorities' % self.queue_name
+        self.queue_keys = [self.queue_name, self.priorities_key]
+        self.schedule_key = '%s.schedule' % self.queue_name
+        
+        self._read_script = self.conn.register_script(READ_SCRIPT)
+        self._promote_script = self.conn.register_script(PROMOTE_SCRIPT)
+        self._length_script = self.conn.register_script(LENGTH_SCRIPT)
+        self._flush_script = self.conn.register_script(FLUSH_SCRIPT)
+    
+    def get_named_queue(self, name):
+        # the name is appended as-is, so named queues that only differ in
+        # the characters stripped from queue names get lists of their own
+        return type(self)('%s.%s' % (self.name, name), self.connection, '%s:%s' % (self.queue_name, name))
     
-    def write(self, data):
-        self.conn.lpush(self.queue_name, data)
+    def get_list_name(self, priority):
+        if priority:
+            return '%s.%d' % (self.queue_name, priority)
+        return self.queue_name
+    
+    def get_queue_names(self):
+        """
+        Python equivalent of QUEUE_NAMES_SCRIPT
+        """
+        priorities = [int(p) for p in self.conn.zrevrangebyscore(self.priorities_key, '+inf', '-inf')]
+        names = [self.get_list_name(p) for p in priorities if p > 0]
+        names.append(self.queue_name)
+        names.extend([self.get_list_name(p) for p in priorities if p < 0])
+        return names
+    
+    def write(self, data, priority=0):
+        self.write_many([data], priority)
+    
+    def write_many(self, messages, priority=0):
+        # LPUSH is variadic, so each chunk is a single command, and the
+        # pipeline sends all the chunks in a single round-trip
+        pipe = self.conn.pipeline()
+        if priority:
+            pipe.execute_command('ZADD', self.priorities_key, priority, priority)
+        list_name = self.get_list_name(priority)
+        for i in xrange(0, len(messages), self.write_batch_size):
+            pipe.lpush(list_name, *messages[i:i + self.write_batch_size])
+        pipe.execute()
+    
+    def schedule(self, data, eta, priority=0):
+        # scheduled messages are stored in a sorted set by timestamp, the
+        # random prefix keeps identical messages distinct
+        timestamp = time.mktime(eta.timetuple()) + eta.microsecond / 1000000.0
+        member = '%s:%d:%s' % (uuid.uuid4().hex, priority, data)
+        self.conn.execute_command('ZADD', self.schedule_key, '%.6f' % timestamp, member)
+    
+    def promote(self):
+        now = '%.6f' % time.time()
+        promoted = 0
+        
+        while True:
+            batch = self._promote_script(
+                keys=self.queue_keys + [self.schedule_key],
+                args=[now, self.promote_batch_size],
+            )
+            promoted += batch
+            if batch < self.promote_batch_size:
+                return promoted
+    
+    def next_eta(self):
+        due = self.conn.zrange(self.schedule_key, 0, 0, withscores=True)
+        if due:
+            return due[0][1]
     
     def read(self):
-        return self.conn.rpop(self.queue_name)
+        messages = self.read_many(1)
+        if messages:
+            return messages[0]
+    
+    def read_many(self, n):
+        return self._read_script(keys=self.queue_keys, args=[n])
+    
+    def peek(self, n):
+        # messages are pushed on the left and read from the right
+        messages = []
+        for list_name in self.get_queue_names():
+            if len(messages) >= n:
+                break
+            batch = self.conn.lrange(list_name, -(n - len(messages)), -1)
+            batch.reverse()
+            messages.extend(batch)
+        return messages
+    
+    def remove(self, data):
+        # messages are read from the right, so the oldest copy is the last
+        for list_name in self.get_queue_names():
+            if self.conn.execute_command('LREM', list_name, -1, data):
+                return True
+        return False
     
     def flush(self):
-        self.conn.delete(self.queue_name)
+        self._flush_script(keys=self.queue_keys)
+        self.conn.delete(self.schedule_key)
     
     def __len__(self):
-        return self.conn.llen(self.queue_name)
+        return self._length_script(keys=self.queue_keys)
 
 
 class RedisBlockingQueue(RedisQueue):
@@ -44,6 +223,177 @@ class RedisBlockingQueue(RedisQueue):
     being polled for
     """
     blocking = True
+    
+    # seconds to block for before giving up and returning None, so that
+    # the consumer gets a chance to notice it is shutting down
+    block_timeout = 1
 
     def read(self):
-        return self.conn.brpop(self.queue_name)
+        # brpop checks the lists in the order given, so the highest priority
+        # message is returned -- the result is a 2-tuple of (key, value), or
+        # None on timeout
+        result = self.conn.brpop(self.get_queue_names(), timeout=self.block_timeout)
+        if result:
+            return result[1]
+    
+    def read_many(self, n, block=True):
+        # block until at least one message is available, then grab as many
+        # of the remaining messages as are immediately available
+        if not block:
+            return super(RedisBlockingQueue, self).read_many(n)
+        return self.read_from([self], n)[1]
+    
+    def read_from(self, queues, n):
+        """
+        Block until any of the RedisBlockingQueues in 'queues', which must be
+        stored on the same server, has a message.  Returns a 2-tuple of that
+        queue and up to 'n' messages read from it, or (None, []) on timeout
+        """
+        names = []
+        owners = {}
+        for queue in queues:
+            for name in queue.get_queue_names():
+                names.append(name)
+                owners[name] = queue
+        
+        result = self.conn.brpop(names, timeout=self.block_timeout)
+        if not result:
+            return None, []
+        
+        queue = owners[result[0]]
+        messages = [result[1]]
+        if n > 1:
+            messages.extend(RedisQueue.read_many(queue, n - 1))
+        return queue, messages
+
+
+# move up to ARGV[2] messages from the highest priority lists onto a
+# processing list, tagging each one with the time it was read and the list
+# it came from
+RELIABLE_READ_SCRIPT = QUEUE_NAMES_SCRIPT + """
+local entries = {}
+for _, name in ipairs(queue_names()) do
+    while #entries < tonumber(ARGV[2]) do
+        local msg = redis.call('RPOP', name)
+        if not msg then
+            break
+        end
+        local entry = ARGV[1] .. ':' .. name .. ':' .. msg
+        redis.call('LPUSH', KEYS[3], entry)
+        table.insert(entries, entry)
+    end
+end
+if #entries > 0 then
+    redis.call('SADD', KEYS[4], KEYS[3])
+end
+return entries
+"""
+
+# push any entries on a processing list read before ARGV[1] back onto the
+# lists they came from, oldest first, so they are the next messages read
+RELIABLE_REAP_SCRIPT = """
+local requeued = 0
+local entries = redis.call('LRANGE', KEYS[1], 0, -1)
+for _, entry in ipairs(entries) do
+    local sep = string.find(entry, ':', 1, true)
+    if tonumber(string.sub(entry, 1, sep - 1)) < tonumber(ARGV[1]) then
+        local name_sep = string.find(entry, ':', sep + 1, true)
+        redis.call('LREM', KEYS[1], 1, entry)
+        redis.call('RPUSH', string.sub(entry, sep + 1, name_sep - 1), string.sub(entry, name_sep + 1))
+        requeued = requeued + 1
+    end
+end
+if redis.call('LLEN', KEYS[1]) == 0 then
+    redis.call('SREM', KEYS[2], KEYS[1])
+end
+return requeued
+"""
+
+
+class RedisReliableQueue(RedisQueue):
+    """
+    A redis queue with at-least-once delivery.  Reading a message atomically
+    moves it onto a processing list belonging to the consumer, and it stays
+    there until the consumer acknowledges it.  Messages that have not been
+    acknowledged within QUEUE_VISIBILITY_TIMEOUT seconds, for example because
+    the consumer died, are put back on the queue by :meth:`reap`
+    """
+    reliable = True
+    
+    def __init__(self, name, connection, key=None):
+        super(RedisReliableQueue, self).__init__(name, connection, key)
+        
+        self.processing_set = '%s.processing' % self.queue_name
+        self.visibility_timeout = getattr(settings, 'QUEUE_VISIBILITY_TIMEOUT', 300)
+        
+        self._reliable_read_script = self.conn.register_script(RELIABLE_READ_SCRIPT)
+        self._reap_script = self.conn.register_script(RELIABLE_REAP_SCRIPT)
+        
+        # processing list entries for the messages read by this process,
+        # keyed by message
+        self._entries = {}
+        self._lock = threading.Lock()
+    
+    def get_processing_name(self):
+        # evaluated on every call, a forked process gets its own list
+        return '%s.%s.%s' % (self.processing_set, socket.gethostname(), os.getpid())
+    
+    def read(self):
+        messages = self.read_many(1)
+        if messages:
+            return messages[0]
+    
+    def read_many(self, n):
+        entries = self._reliable_read_script(
+            keys=self.queue_keys + [self.get_processing_name(), self.processing_set],
+            args=['%.6f' % time.time(), n],
+        )
+        
+        messages = []
+        self._lock.acquire()
+        try:
+            for entry in entries:
+                data = entry.split(':', 2)[2]
+                self._entries.setdefault(data, []).append(entry)
+                messages.append(data)
+        finally:
+            self._lock.release()
+        
+        return messages
+    
+    def ack(self, data):
+        self._lock.acquire()
+        try:
+            entries = self._entries.get(data)
+            if not entries:
+                return
+            # older entries may have been reaped and the message read again,
+            # the newest entry is the one still on the processing list
+            entry = entries.pop()
+            if not entries:
+                del(self._entries[data])
+        finally:
+            self._lock.release()
+        
+        self.conn.execute_command('LREM', self.get_processing_name(), 1, entry)
+    
+    def reap(self):
+        cutoff = '%.6f' % (time.time() - self.visibility_timeout)
+        requeued = 0
+        for processing_name in self.conn.smembers(self.processing_set):
+            requeued += self._reap_script(
+                keys=[processing_name, self.processing_set],
+                args=[cutoff],
+            )
+        return requeued
+    
+    def flush(self):
+        pipe = self.conn.pipeline()
+        for processing_name in self.conn.smembers(self.processing_set):
+            pipe.delete(processing_name)
+        pipe.delete(self.processing_set)
+        pipe.execute()
+        
+        super(RedisReliableQueue, self).flush()
+        
+        self._entries = {}
@@ -0,0 +1,204 @@
+import os
+import sqlite3
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from djutils.queue.backends.base import BaseQueue
+
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        queue TEXT NOT NULL,
+        priority INTEGER NOT NULL DEFAULT 0,
+        available_at REAL,
+        claimed_at REAL,
+        message BLOB NOT NULL
+    )""",
+    """CREATE INDEX IF NOT EXISTS messages_read
+        ON messages (queue, available_at, claimed_at, priority DESC, id)""",
+]
+
+
+class SqliteQueue(BaseQueue):
+    """
+    A durable Queue stored in a SQLite database file, for consumers running
+    on the same machine as the site.  The database is put in write-ahead
+    logging mode, so readers and writers do not block each other, and every
+    write is a single short transaction without the overhead of the ORM
+    
+    Messages are delivered at least once.  Reading a message marks it as
+    claimed, and it is only deleted once acknowledged.  Messages that have
+    not been acknowledged within QUEUE_VISIBILITY_TIMEOUT seconds are made
+    available again by :meth:`reap`
+    """
+    reliable = True
+    
+    # seconds to wait for another process to finish writing
+    busy_timeout = 10
+    
+    def __init__(self, name, connection):
+        """
+        QUEUE_CONNECTION = '/path/to/queue.db'
+        """
+        super(SqliteQueue, self).__init__(name, connection)
+        
+        if not connection:
+            raise ImproperlyConfigured('QUEUE_CONNECTION must be the path to the SqliteQueue database')
+        
+        self.filename = connection
+        self.visibility_timeout = getattr(settings, 'QUEUE_VISIBILITY_TIMEOUT', 300)
+        
+        # sqlite connections cannot be shared between threads or processes
+        self._local = threading.local()
+        
+        # ids of the messages read by this process, keyed by message
+        self._entries = {}
+        self._lock = threading.Lock()
+    
+    def get_connection(self):
+        pid = os.getpid()
+        if getattr(self._local, 'pid', None) != pid:
+            conn = sqlite3.connect(self.filename, timeout=self.busy_timeout, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            for sql in SCHEMA:
+                conn.execute(sql)
+            self._local.conn = conn
+            self._local.pid = pid
+        return self._local.conn
+    
+    def execute(self, sql, params=()):
+        return self.get_connection().execute(sql, params)
+    
+    def write(self, data, priority=0):
+        self.write_many([data], priority)
+    
+    def write_many(self, messages, priority=0):
+        conn = self.get_connection()
+        
+        # a single transaction, rather than one per message
+        conn.execute('BEGIN')
+        try:
+            conn.executemany(
+                'INSERT INTO messages (queue, priority, message) VALUES (?, ?, ?)',
+                [(self.name, priority, buffer(data)) for data in messages],
+            )
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+    
+    def schedule(self, data, eta, priority=0):
+        timestamp = time.mktime(eta.timetuple()) + eta.microsecond / 1000000.0
+        self.execute(
+            'INSERT INTO messages (queue, priority, available_at, message) VALUES (?, ?, ?, ?)',
+            (self.name, priority, timestamp, buffer(data)),
+        )
+    
+    def promote(self):
+        return self.execute(
+            'UPDATE messages SET available_at = NULL WHERE queue = ? AND available_at <= ?',
+            (self.name, time.time()),
+        ).rowcount
+    
+    def next_eta(self):
+        return self.execute(
+            'SELECT MIN(available_at) FROM messages WHERE queue = ? AND available_at IS NOT NULL',
+            (self.name,),
+        ).fetchone()[0]
+    
+    def read(self):
+        messages = self.read_many(1)
+        if messages:
+            return messages[0]
+    
+    def read_many(self, n):
+        conn = self.get_connection()
+        
+        # take the write lock up front, so two consumers cannot select the
+        # same rows
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            rows = conn.execute(
+                'SELECT id, message FROM messages '
+                'WHERE queue = ? AND available_at IS NULL AND claimed_at IS NULL '
+                'ORDER BY priority DESC, id LIMIT ?',
+                (self.name, n),
+            ).fetchall()
+            if rows:
+                conn.execute(
+                    'UPDATE messages SET claimed_at = ? WHERE id IN (%s)' % ', '.join(['?'] * len(rows)),
+                    [time.time()] + [pk for pk, _ in rows],
+                )
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        
+        messages = []
+        self._lock.acquire()
+        try:
+            for pk, message in rows:
+                data = str(message)
+                self._entries.setdefault(data, []).append(pk)
+                messages.append(data)
+        finally:
+            self._lock.release()
+        
+        return messages
+    
+    def peek(self, n):
+        rows = self.execute(
+            'SELECT message FROM messages '
+            'WHERE queue = ? AND available_at IS NULL AND claimed_at IS NULL '
+            'ORDER BY priority DESC, id LIMIT ?',
+            (self.name, n),
+        ).fetchall()
+        return [str(message) for message, in rows]
+    
+    def remove(self, data):
+        return self.execute(
+            'DELETE FROM messages WHERE id = ('
+                'SELECT id FROM messages '
+                'WHERE queue = ? AND message = ? AND available_at IS NULL AND claimed_at IS NULL '
+                'ORDER BY priority DESC, id LIMIT 1'
+            ')',
+            (self.name, buffer(data)),
+        ).rowcount > 0
+    
+    def ack(self, data):
+        self._lock.acquire()
+        try:
+            entries = self._entries.get(data)
+            if not entries:
+                return
+            # older entries may have been reaped and the message read again,
+            # the newest entry is the one still claimed by this consumer
+            pk = entries.pop()
+            if not entries:
+                del(self._entries[data])
+        finally:
+            self._lock.release()
+        
+        self.execute('DELETE FROM messages WHERE id = ?', (pk,))
+    
+    def reap(self):
+        return self.execute(
+            'UPDATE messages SET claimed_at = NULL WHERE queue = ? AND claimed_at < ?',
+            (self.name, time.time() - self.visibility_timeout),
+        ).rowcount
+    
+    def flush(self):
+        self.execute('DELETE FROM messages WHERE queue = ?', (self.name,))
+        self._entries = {}
+    
+    def __len__(self):
+        return self.execute(
+            'SELECT COUNT(*) FROM messages '
+            'WHERE queue = ? AND available_at IS NULL AND claimed_at IS NULL',
+            (self.name,),
+        ).fetchone()[0]
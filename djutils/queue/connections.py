@@ -0,0 +1,143 @@
+import threading
+import urlparse
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+from django.core.exceptions import ImproperlyConfigured
+
+
+DEFAULT_CONNECTION = 'localhost:6379:0'
+
+# seconds to wait for redis to accept a connection and to answer a command,
+# so a stalled server cannot hang the threads talking to it forever
+DEFAULT_CONNECT_TIMEOUT = 5
+DEFAULT_TIMEOUT = 30
+
+# query string parameters accepted in a connection url, and their types
+URL_OPTIONS = {
+    'db': int,
+    'max_connections': int,
+    'pool_timeout': float,
+    'timeout': float,
+    'connect_timeout': float,
+}
+
+# connection pools shared by every client in the process, keyed by spec
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def parse_connection(spec):
+    """
+    Parse a redis connection spec into a dictionary of options, the spec is
+    either 'host:port:database' or a url:
+    
+    redis://[:password@]host[:port][/database][?option=value&...]
+    unix://[:password@]/path/to/redis.sock[?db=database&option=value&...]
+    
+    Options are max_connections, the size of the pool, pool_timeout, seconds
+    to wait for a connection from a full pool, and timeout and
+    connect_timeout, seconds to wait for redis
+    """
+    spec = spec or DEFAULT_CONNECTION
+    options = {
+        'host': 'localhost',
+        'port': 6379,
+        'path': None,
+        'password': None,
+        'db': 0,
+        'max_connections': None,
+        'pool_timeout': 20,
+        'timeout': DEFAULT_TIMEOUT,
+        'connect_timeout': DEFAULT_CONNECT_TIMEOUT,
+    }
+    
+    if '://' not in spec:
+        try:
+            host, port, db = spec.split(':')
+            options.update(host=host, port=int(port), db=int(db))
+        except ValueError:
+            raise ImproperlyConfigured('Invalid redis connection "%s", expected host:port:database' % spec)
+        return options
+    
+    # urlparse only splits the query string of schemes it knows about
+    scheme, rest = spec.split('://', 1)
+    url = urlparse.urlparse('http://' + rest)
+    
+    if scheme == 'redis':
+        options['host'] = url.hostname or 'localhost'
+        options['port'] = url.port or 6379
+        if url.path.strip('/'):
+            options['db'] = url.path.strip('/')
+    elif scheme == 'unix':
+        options['path'] = url.path
+        if not options['path']:
+            raise ImproperlyConfigured('Invalid redis connection "%s", no socket path' % spec)
+    else:
+        raise ImproperlyConfigured('Invalid redis connection "%s", unknown scheme %s' % (spec, scheme))
+    
+    options['password'] = url.password
+    
+    for key, values in urlparse.parse_qs(url.query).items():
+        if key not in URL_OPTIONS:
+            raise ImproperlyConfigured('Invalid redis connection "%s", unknown option %s' % (spec, key))
+        options[key] = values[-1]
+    
+    try:
+        for key, type_ in URL_OPTIONS.items():
+            if options[key] is not None:
+                options[key] = type_(options[key])
+    except ValueError:
+        raise ImproperlyConfigured('Invalid redis connection "%s"' % spec)
+    
+    return options
+
+def get_connection_pool(spec):
+    """
+    Return the connection pool for a connection spec, which is shared by
+    every client in the process using the same spec
+    """
+    spec = spec or DEFAULT_CONNECTION
+    
+    _pools_lock.acquire()
+    try:
+        if spec not in _pools:
+            options = parse_connection(spec)
+            
+            kwargs = dict(
+                db=options['db'],
+                password=options['password'],
+                socket_timeout=options['timeout'],
+            )
+            if options['path']:
+                kwargs.update(connection_class=redis.UnixDomainSocketConnection, path=options['path'])
+            else:
+                kwargs.update(
+                    host=options['host'],
+                    port=options['port'],
+                    socket_connect_timeout=options['connect_timeout'],
+                )
+            
+            if options['max_connections']:
+                # wait for a connection to be returned rather than failing
+                _pools[spec] = redis.BlockingConnectionPool(
+                    max_connections=options['max_connections'],
+                    timeout=options['pool_timeout'],
+                    **kwargs
+                )
+            else:
+                _pools[spec] = redis.ConnectionPool(**kwargs)
+        return _pools[spec]
+    finally:
+        _pools_lock.release()
+
+def get_redis_connection(spec):
+    """
+    Return a redis client for a connection spec, see :func:`parse_connection`
+    """
+    if redis is None:
+        raise ImproperlyConfigured('The redis module is required to connect to "%s"' % spec)
+    return redis.Redis(connection_pool=get_connection_pool(spec))
@@ -1,9 +1,12 @@
+import bisect
 import datetime
 import re
 
+from django.core.exceptions import ValidationError
 from django.utils.functional import wraps
 
-from djutils.queue.queue import invoker, QueueCommand, PeriodicQueueCommand
+from djutils.queue.queue import invoker, validate_queue_name, QueueCommand, PeriodicQueueCommand
+from djutils.queue.ratelimit import parse_rate_limit
 
 
 def create_command(command_class, func, **kwargs):
@@ -26,20 +29,163 @@ def create_command(command_class, func, **kwargs):
     
     return klass
 
-def queue_command(func):
+def queue_command(func=None, priority=0, result_ttl=None, retries=0, retry_delay=0, backoff=2,
+                  unique=False, key=None, debounce=0, batch_size=0, batch_wait=1.0,
+                  rate_limit=None, queue=None, time_limit=None, soft_time_limit=None):
     """
     Decorator to execute a function out-of-band via the consumer.  Usage::
     
     @queue_command
     def send_email(user, message):
         ... this code executed when dequeued by the consumer ...
+    
+    Commands with a higher priority are executed before any commands with a
+    lower priority that are waiting in the queue::
+    
+    @queue_command(priority=10)
+    def send_password_reset(user):
+        ...
+    
+    To enqueue a batch of calls at once, pass an iterable of argument tuples
+    to the decorated function's map() method::
+    
+    send_email.map([(user, message) for user in users])
+    
+    To execute a call later, pass either a delay in seconds or a datetime to
+    the decorated function's schedule() method::
+    
+    send_email.schedule((user, message), delay=3600)
+    
+    If a QUEUE_RESULT_STORE is configured, calling the decorated function
+    returns an AsyncResult that can be used to fetch the function's return
+    value -- 'result_ttl' overrides how many seconds the value is kept
+    
+    Commands that raise an exception can be retried, waiting 'retry_delay'
+    seconds before the first retry and multiplying the wait by 'backoff'
+    before each retry after that.  Once its retries are used up the message
+    is moved to the dead-letter queue::
+    
+    @queue_command(retries=3, retry_delay=60)
+    def fetch_feed(url):
+        ...
+    
+    Unique commands are dropped when an identical call is already waiting in
+    the queue.  By default calls with the same arguments are identical, pass
+    a 'key' function accepting the same arguments to change that.  A
+    'debounce' delays execution by that many seconds, so a burst of identical
+    calls is coalesced into one::
+    
+    @queue_command(unique=True, key=lambda obj_id, **kwargs: obj_id, debounce=1)
+    def rebuild_cache(obj_id, force=False):
+        ...
+    
+    Batched commands are buffered by the consumer and the function is called
+    with a list of argument tuples, once 'batch_size' calls are waiting or
+    the oldest has waited 'batch_wait' seconds.  Keyword arguments are not
+    supported::
+    
+    @queue_command(batch_size=500, batch_wait=2.0)
+    def index_documents(calls):
+        search.index([doc_id for (doc_id,) in calls])
+    
+    index_documents(doc.id)
+    
+    A 'rate_limit' such as '100/m' (or '/s', '/h') limits how often each
+    consumer executes the command, calls over the limit are put back in the
+    queue until they can be executed::
+    
+    @queue_command(rate_limit='10/s')
+    def check_comment(comment_id):
+        ...
+    
+    Commands are written to the default queue unless they name another
+    'queue', so slow commands can be given consumers of their own::
+    
+    @queue_command(queue='images')
+    def generate_thumbnails(photo_id):
+        ...
+    
+    A 'soft_time_limit' raises SoftTimeLimitExceeded inside the command once
+    it has run that many seconds, giving it a chance to clean up.  When the
+    consumer runs worker processes, a command still running after its
+    'time_limit' has its process killed and replaced.  Threads cannot be
+    killed, so without worker processes the time limit is enforced as a soft
+    limit::
+    
+    @queue_command(soft_time_limit=30, time_limit=60)
+    def fetch_feed(url):
+        ...
     """
-    klass = create_command(QueueCommand, func)
+    if rate_limit:
+        # fail early on an invalid rate limit
+        parse_rate_limit(rate_limit)
+    
+    if time_limit and soft_time_limit and soft_time_limit >= time_limit:
+        raise ValueError('soft_time_limit must be less than time_limit')
+    
+    if queue:
+        validate_queue_name(queue)
+    
+    def decorator(func):
+        attrs = dict(
+            priority=priority,
+            result_ttl=result_ttl,
+            retries=retries,
+            retry_delay=retry_delay,
+            backoff=backoff,
+            unique=unique or bool(debounce),
+            debounce=debounce,
+            batch_size=batch_size,
+            batch_wait=batch_wait,
+            rate_limit=rate_limit,
+            queue=queue,
+            time_limit=time_limit,
+            soft_time_limit=soft_time_limit,
+        )
+        
+        if batch_size:
+            def execute(self):
+                args, kwargs = self.data
+                return func([args])
+            
+            def execute_batch(cls, commands):
+                return func([command.data[0] for command in commands])
+            
+            attrs['execute'] = execute
+            attrs['execute_batch'] = classmethod(execute_batch)
+        
+        if key is not None:
+            def get_unique_key(self):
+                args, kwargs = self.data or ((), {})
+                return key(*args, **kwargs)
+            attrs['get_unique_key'] = get_unique_key
+        
+        klass = create_command(QueueCommand, func, **attrs)
+        
+        @wraps(func)
+        def inner_run(*args, **kwargs):
+            if batch_size and kwargs:
+                raise TypeError('Batched commands do not accept keyword arguments')
+            return invoker.enqueue(klass((args, kwargs)))
+        
+        def map(iterable):
+            return invoker.enqueue_many([klass((tuple(args), {})) for args in iterable])
+        
+        def schedule(args=None, kwargs=None, delay=None, eta=None):
+            if (delay is None) == (eta is None):
+                raise ValueError('Specify either a delay or an eta')
+            if eta is None:
+                eta = datetime.datetime.now() + datetime.timedelta(seconds=delay)
+            return invoker.schedule(klass((tuple(args or ()), kwargs or {})), eta)
+        
+        inner_run.map = map
+        inner_run.schedule = schedule
+        inner_run.command_class = klass
+        return inner_run
     
-    @wraps(func)
-    def inner_run(*args, **kwargs):
-        invoker.enqueue(klass((args, kwargs)))
-    return inner_run
+    if func is None:
+        return decorator
+    return decorator(func)
 
 def periodic_command(validate_datetime):
     """
@@ -58,24 +204,121 @@ def periodic_command(validate_datetime):
         def method_validate(self, dt):
             return validate_datetime(dt)
         
-        klass = create_command(
-            PeriodicQueueCommand,
-            func,
-            validate_datetime=method_validate
-        )
+        attrs = {'validate_datetime': method_validate}
+        
+        # schedules created by crontab() know when they next fire
+        if hasattr(validate_datetime, 'next_fire_after'):
+            def method_next_fire_after(self, dt):
+                return validate_datetime.next_fire_after(dt)
+            attrs['next_fire_after'] = method_next_fire_after
+        
+        klass = create_command(PeriodicQueueCommand, func, **attrs)
         
+        func.command_class = klass
         return func
     return decorator
 
 
+class CronSchedule(object):
+    """
+    A compiled crontab schedule.  Calling it with a datetime returns True if
+    the schedule matches, and next_fire_after() returns the next datetime it
+    matches without having to test every minute in between
+    """
+    # give up looking for the next match after this many years, enough to
+    # find february 29th
+    search_years = 8
+    
+    def __init__(self, months, days, days_of_week, hours, minutes, seconds=None):
+        self.months = months
+        self.days = days
+        self.days_of_week = days_of_week
+        self.hours = hours
+        self.minutes = minutes
+        
+        # schedules without seconds fire at the start of the minute but
+        # match any datetime within it
+        self.check_seconds = seconds is not None
+        self.seconds = seconds or [0]
+    
+    def __call__(self, dt):
+        _, m, d, H, M, S, w, _, _ = dt.timetuple()
+        
+        # fix the weekday to be sunday=0
+        w = (w + 1) % 7
+        
+        pieces = [m, d, w, H, M]
+        cron_settings = [self.months, self.days, self.days_of_week, self.hours, self.minutes]
+        if self.check_seconds:
+            pieces.append(S)
+            cron_settings.append(self.seconds)
+        
+        for (date_piece, selection) in zip(pieces, cron_settings):
+            if date_piece not in selection:
+                return False
+        
+        return True
+    
+    def _next_value(self, selection, value):
+        """
+        Return the first value in the sorted 'selection' that is not less
+        than 'value', or None
+        """
+        i = bisect.bisect_left(selection, value)
+        if i < len(selection):
+            return selection[i]
+    
+    def next_fire_after(self, dt):
+        """
+        Return the first datetime after 'dt' matched by the schedule, or None
+        if it never matches (e.g. february 30th)
+        """
+        dt = dt.replace(microsecond=0) + datetime.timedelta(seconds=1)
+        last_year = dt.year + self.search_years
+        
+        while dt.year <= last_year:
+            if dt.month not in self.months:
+                if dt.month == 12:
+                    dt = datetime.datetime(dt.year + 1, 1, 1)
+                else:
+                    dt = datetime.datetime(dt.year, dt.month + 1, 1)
+                continue
+            
+            if dt.day not in self.days or dt.isoweekday() % 7 not in self.days_of_week:
+                dt = datetime.datetime(dt.year, dt.month, dt.day) + datetime.timedelta(days=1)
+                continue
+            
+            hour = self._next_value(self.hours, dt.hour)
+            if hour is None:
+                dt = datetime.datetime(dt.year, dt.month, dt.day) + datetime.timedelta(days=1)
+                continue
+            if hour != dt.hour:
+                dt = dt.replace(hour=hour, minute=0, second=0)
+            
+            minute = self._next_value(self.minutes, dt.minute)
+            if minute is None:
+                dt = dt.replace(minute=0, second=0) + datetime.timedelta(hours=1)
+                continue
+            if minute != dt.minute:
+                dt = dt.replace(minute=minute, second=0)
+            
+            second = self._next_value(self.seconds, dt.second)
+            if second is None:
+                dt = dt.replace(second=0) + datetime.timedelta(minutes=1)
+                continue
+            
+            return dt.replace(second=second)
+
+
 dash_re = re.compile('(\d+)-(\d+)')
 every_re = re.compile('\*\/(\d+)')
 
-def crontab(month='*', day='*', day_of_week='*', hour='*', minute='*'):
+def crontab(month='*', day='*', day_of_week='*', hour='*', minute='*', second=None):
     """
-    Convert a "crontab"-style set of parameters into a test function that will
-    return True when the given datetime matches the parameters set forth in
-    the crontab.
+    Convert a "crontab"-style set of parameters into a :class:`CronSchedule`
+    that will return True when called with a datetime matching the parameters
+    set forth in the crontab.  Passing 'second' allows schedules that fire
+    more than once a minute, i.e. second='*/10'
     
     Acceptable inputs:
     * = every distinct value
@@ -88,7 +331,8 @@ def crontab(month='*', day='*', day_of_week='*', hour='*', minute='*'):
         ('d', day, range(1, 32)),
         ('w', day_of_week, range(7)),
         ('H', hour, range(24)),
-        ('M', minute, range(60))
+        ('M', minute, range(60)),
+        ('S', second or '0', range(60)),
     )
     cron_settings = []
     min_interval = None
@@ -126,16 +370,8 @@ def crontab(month='*', day='*', day_of_week='*', hour='*', minute='*'):
         
         cron_settings.append(sorted(list(settings)))
     
-    def validate_date(dt):
-        _, m, d, H, M, _, w, _, _ = dt.timetuple()
-        
-        # fix the weekday to be sunday=0
-        w = (w + 1) % 7
-        
-        for (date_piece, selection) in zip([m, d, w, H, M], cron_settings):
-            if date_piece not in selection:
-                return False
-        
-        return True
+    months, days, days_of_week, hours, minutes, seconds = cron_settings
+    if second is None:
+        seconds = None
     
-    return validate_date
+    return CronSchedule(months, days, days_of_week, hours, minutes, seconds)
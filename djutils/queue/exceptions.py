@@ -1,2 +1,18 @@
 class QueueException(Exception):
     pass
+
+
+class ResultTimeout(QueueException):
+    pass
+
+
+class CommandFailed(QueueException):
+    pass
+
+
+class SoftTimeLimitExceeded(QueueException):
+    pass
+
+
+class TimeLimitExceeded(QueueException):
+    pass
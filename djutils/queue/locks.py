@@ -0,0 +1,76 @@
+try:
+    import redis
+except ImportError:
+    redis = None
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from djutils.queue.connections import get_redis_connection
+from djutils.utils.helpers import load_class
+
+
+class BaseLock(object):
+    """
+    A lock shared by your site and every consumer, used to make sure only
+    one of them does something -- i.e. enqueues a tick of a periodic
+    command or enqueues a unique command
+    """
+    def acquire(self, key, ttl):
+        """
+        Atomically claim 'key' for 'ttl' seconds, returning False if it is
+        already claimed
+        """
+        raise NotImplementedError
+    
+    def release(self, key):
+        """
+        Release 'key' so it can be claimed again
+        """
+        raise NotImplementedError
+
+
+class CacheLock(BaseLock):
+    """
+    Uses django's cache.add() -- the cache must be shared by your site and
+    the consumers, so memcached will work but locmem will not
+    """
+    def __init__(self):
+        # loading the cache backend reads the settings, so it is imported
+        # when the lock is created rather than when the queue is imported
+        from django.core.cache import cache
+        self.cache = cache
+    
+    def acquire(self, key, ttl):
+        return bool(self.cache.add(key, 1, ttl))
+    
+    def release(self, key):
+        self.cache.delete(key)
+
+
+class RedisLock(BaseLock):
+    """
+    Uses redis' SET NX:
+    
+    QUEUE_LOCK_CONNECTION = 'host:port:database', a redis:// or unix:// url,
+    or defaults to localhost:6379:0
+    """
+    def __init__(self):
+        if redis is None:
+            raise ImproperlyConfigured('The redis library is required to use the RedisLock')
+        
+        self.conn = get_redis_connection(getattr(settings, 'QUEUE_LOCK_CONNECTION', None))
+    
+    def acquire(self, key, ttl):
+        return bool(self.conn.execute_command('SET', key, 1, 'NX', 'EX', int(ttl)))
+    
+    def release(self, key):
+        self.conn.delete(key)
+
+
+def get_lock(setting):
+    """
+    Return an instance of the lock class named by the given setting, or None
+    """
+    if getattr(settings, setting, None):
+        return load_class(getattr(settings, setting))()
@@ -0,0 +1,230 @@
+import errno
+import glob
+import os
+import select
+import socket
+import tempfile
+import uuid
+
+try:
+    import psycopg2
+    import psycopg2.extensions
+except ImportError:
+    psycopg2 = None
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.hashcompat import sha_constructor
+
+from djutils.utils.helpers import load_class
+
+
+class BaseNotifier(object):
+    """
+    Tells consumers that messages have been written to a queue, so rather
+    than polling an empty queue they can wait to be notified
+    """
+    def notify(self, name):
+        """
+        Wake up the consumers waiting on the queue called 'name'
+        """
+        raise NotImplementedError
+    
+    def wait(self, names, timeout):
+        """
+        Block until one of the queues in the list 'names' is notified, or for
+        'timeout' seconds, returning True if it was notified.  Notifications
+        sent while nobody was waiting may be lost, so callers should read the
+        queues before waiting
+        """
+        raise NotImplementedError
+    
+    def close(self):
+        """
+        Stop listening for notifications
+        """
+        pass
+
+
+class PostgresNotifier(BaseNotifier):
+    """
+    Uses PostgreSQL's NOTIFY, sent on the same database connection as the
+    messages are written with, so consumers are only woken once the
+    transaction writing the messages has committed.  Consumers LISTEN on a
+    connection of their own:
+    
+    QUEUE_NOTIFIER_CONNECTION = the alias of the database, defaults to the
+    one the messages of the DatabaseQueue are written to
+    """
+    # longest channel name postgres accepts
+    max_channel_length = 63
+    
+    def __init__(self):
+        from django.db import connections, router
+        from djutils.models import QueueMessage
+        
+        self.using = getattr(settings, 'QUEUE_NOTIFIER_CONNECTION', None) or router.db_for_write(QueueMessage)
+        if connections[self.using].vendor != 'postgresql':
+            raise ImproperlyConfigured('The PostgresNotifier needs a PostgreSQL database, try the SocketNotifier')
+        
+        self._conn = None
+        self._channels = set()
+    
+    def get_channel(self, name):
+        if len(name) > self.max_channel_length:
+            return sha_constructor(name).hexdigest()
+        return name
+    
+    def notify(self, name):
+        from django.db import connections, transaction
+        
+        cursor = connections[self.using].cursor()
+        cursor.execute('SELECT pg_notify(%s, %s)', [self.get_channel(name), ''])
+        transaction.commit_unless_managed(using=self.using)
+    
+    def connect(self):
+        """
+        Open a connection in autocommit mode, so notifications are delivered
+        as soon as they arrive rather than when a transaction ends
+        """
+        if psycopg2 is None:
+            raise ImproperlyConfigured('The psycopg2 library is required to use the PostgresNotifier')
+        
+        from django.db import connections
+        settings_dict = connections[self.using].settings_dict
+        
+        kwargs = {'database': settings_dict['NAME']}
+        for key, setting in (('user', 'USER'), ('password', 'PASSWORD'), ('host', 'HOST'), ('port', 'PORT')):
+            if settings_dict[setting]:
+                kwargs[key] = settings_dict[setting]
+        
+        conn = psycopg2.connect(**kwargs)
+        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        return conn
+    
+    def listen(self, channels):
+        if self._conn is None:
+            self._conn = self.connect()
+            self._channels = set()
+        
+        cursor = self._conn.cursor()
+        for channel in channels:
+            if channel not in self._channels:
+                cursor.execute('LISTEN "%s"' % channel.replace('"', '""'))
+                self._channels.add(channel)
+    
+    def wait(self, names, timeout):
+        try:
+            self.listen([self.get_channel(name) for name in names])
+            
+            if not self._conn.notifies:
+                select.select([self._conn], [], [], timeout)
+                self._conn.poll()
+            
+            notified = bool(self._conn.notifies)
+            del(self._conn.notifies[:])
+            return notified
+        except:
+            # listen again on a new connection next time
+            self.close()
+            raise
+    
+    def close(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            finally:
+                self._conn = None
+
+
+class SocketNotifier(BaseNotifier):
+    """
+    A stand-in for databases without notifications, which only works when
+    the consumers run on the same machine as the site.  Each consumer binds
+    a unix socket in a directory for every queue it waits on, and writing a
+    message to a queue sends a datagram to each of its sockets:
+    
+    QUEUE_NOTIFIER_CONNECTION = '/path/to/directory', created if it does not
+    exist and writable by the site and the consumers.  Defaults to a
+    directory in the system's temporary directory
+    """
+    def __init__(self):
+        self.path = getattr(settings, 'QUEUE_NOTIFIER_CONNECTION', None) or \
+            os.path.join(tempfile.gettempdir(), 'djutils-queue')
+        
+        # bound sockets and their paths, keyed by queue name
+        self._sockets = {}
+    
+    def get_channel(self, name):
+        # socket paths are limited to around 100 characters
+        return sha_constructor(name).hexdigest()[:16]
+    
+    def notify(self, name):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        try:
+            for path in glob.glob(os.path.join(self.path, '%s.*.sock' % self.get_channel(name))):
+                try:
+                    sock.sendto('', path)
+                except socket.error, exc:
+                    # the message has been written either way, a consumer
+                    # that is not nudged reads it once its delay is up
+                    if exc.errno == errno.ECONNREFUSED:
+                        # left behind by a consumer that did not exit cleanly
+                        try:
+                            os.unlink(path)
+                        except OSError:
+                            pass
+        finally:
+            sock.close()
+    
+    def listen(self, names):
+        for name in names:
+            if name in self._sockets:
+                continue
+            
+            if not os.path.isdir(self.path):
+                try:
+                    os.makedirs(self.path)
+                except OSError, exc:
+                    if exc.errno != errno.EEXIST:
+                        raise
+            
+            path = os.path.join(self.path, '%s.%d.%s.sock' % (
+                self.get_channel(name), os.getpid(), uuid.uuid4().hex[:8]))
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            sock.setblocking(False)
+            sock.bind(path)
+            self._sockets[name] = (sock, path)
+    
+    def wait(self, names, timeout):
+        self.listen(names)
+        
+        readable = select.select([self._sockets[name][0] for name in names], [], [], timeout)[0]
+        
+        # a burst of writes only needs to wake the consumer once
+        for sock in readable:
+            try:
+                while True:
+                    sock.recv(1)
+            except socket.error:
+                pass
+        
+        return bool(readable)
+    
+    def close(self):
+        sockets, self._sockets = self._sockets, {}
+        for sock, path in sockets.values():
+            sock.close()
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+
+def get_notifier():
+    """
+    Return an instance of the QUEUE_NOTIFIER class, or None
+    """
+    if getattr(settings, 'QUEUE_NOTIFIER', None):
+        return load_class(settings.QUEUE_NOTIFIER)()
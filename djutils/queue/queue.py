@@ -1,10 +1,20 @@
 import datetime
 import os
+import re
+import threading
+import time
+import uuid
 
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.functional import LazyObject
+from django.utils.hashcompat import sha_constructor
 
 from djutils.queue.exceptions import QueueException
+from djutils.queue.locks import get_lock
+from djutils.queue.notify import get_notifier
 from djutils.queue.registry import registry
+from djutils.queue.results import AsyncResult
 from djutils.utils.helpers import load_class
 
 
@@ -19,6 +29,23 @@ def get_queue_name():
     else:
         return 'queue-%s' % (os.path.basename(settings.DATABASES['default']['NAME']))
 
+def get_result_store():
+    if getattr(settings, 'QUEUE_RESULT_STORE', None):
+        return load_class(settings.QUEUE_RESULT_STORE)()
+
+# named queues are stored as '<QUEUE_NAME>.<name>', so these would clash with
+# the queues the invoker keeps for itself
+RESERVED_QUEUE_NAMES = ('dead',)
+
+# and their names must be safe to use in the keys of any backend
+queue_name_re = re.compile('^[A-Za-z0-9_-]+$')
+
+def validate_queue_name(name):
+    if name in RESERVED_QUEUE_NAMES:
+        raise ValueError('"%s" is a reserved queue name' % name)
+    if not queue_name_re.match(name):
+        raise ValueError('Invalid queue name "%s", use letters, digits, "_" and "-"' % name)
+
 
 class Invoker(object):
     """
@@ -27,33 +54,441 @@ class Invoker(object):
     up the proper :class:`QueueCommand` for each message
     """
     
-    def __init__(self, queue):
+    # prefix of the keys claimed by unique commands
+    unique_prefix = 'djutils.queue.unique.'
+    
+    # name of the queue commands are written to unless they name another
+    default_queue = 'default'
+    
+    def __init__(self, queue, result_store=None, unique_lock=None, notifier=None):
         self.queue = queue
+        self.result_store = result_store
+        self.unique_lock = unique_lock
+        self.notifier = notifier
+        self._dead_queue = None
+        
+        # other named queues, keyed by name
+        self._queues = {}
+        self._queues_lock = threading.Lock()
+    
+    def get_queue(self, name=None):
+        """
+        Return the queue with the given name, which is stored alongside the
+        default queue using the same backend and connection
+        """
+        if not name or name == self.default_queue:
+            return self.queue
+        
+        validate_queue_name(name)
+        
+        # every thread must share the same instance, reliable queues keep
+        # track of the messages they have read
+        self._queues_lock.acquire()
+        try:
+            if name not in self._queues:
+                self._queues[name] = self.queue.get_named_queue(name)
+            return self._queues[name]
+        finally:
+            self._queues_lock.release()
+    
+    def get_queues(self):
+        """
+        Return the default queue and every named queue used so far
+        """
+        self._queues_lock.acquire()
+        try:
+            return [self.queue] + [self._queues[name] for name in sorted(self._queues)]
+        finally:
+            self._queues_lock.release()
+    
+    def write(self, msg, priority=0, queue=None):
+        queue = self.get_queue(queue)
+        queue.write(msg, priority)
+        self.notify(queue)
+    
+    def notify(self, queue):
+        """
+        Let consumers waiting on the queue know it has messages to read
+        """
+        if self.notifier is not None:
+            self.notifier.notify(queue.name)
+    
+    def get_schedule_channel(self, queue):
+        """
+        Return the name consumers are notified on when a message is
+        scheduled in the queue, which cannot clash with a queue name
+        """
+        return '%s:scheduled' % queue.name
+    
+    def notify_scheduled(self, queue):
+        """
+        Let consumers know a message has been scheduled in the queue, as it
+        may be due before they were going to check again
+        """
+        if self.notifier is not None:
+            self.notifier.notify(self.get_schedule_channel(queue))
+    
+    def wait(self, timeout, queues=None):
+        """
+        Block until messages are written to one of the named queues, or for
+        'timeout' seconds if there is no notifier or nothing is written
+        """
+        if self.notifier is None:
+            time.sleep(timeout)
+            return False
+        
+        names = [self.get_queue(name).name for name in queues or [None]]
+        return self.notifier.wait(names, timeout)
+    
+    def _get_result(self, command):
+        """
+        Give the command an id and return a handle on its result, or None if
+        results are not being stored
+        """
+        if self.result_store is not None:
+            command.task_id = uuid.uuid4().hex
+            return AsyncResult(command.task_id, self.result_store)
+    
+    def _acquire_unique(self, command):
+        """
+        Claim the key of a unique command, returning False if an identical
+        command is already waiting in the queue
+        """
+        if not command.unique:
+            return True
+        
+        if self.unique_lock is None:
+            raise ImproperlyConfigured('QUEUE_UNIQUE_LOCK must be set to enqueue unique commands')
+        
+        command.unique_key = sha_constructor('%s:%s:%s' % (
+            self.queue.name,
+            registry.command_to_string(type(command)),
+            command.get_unique_key(),
+        )).hexdigest()
+        
+        return self.unique_lock.acquire(
+            self.unique_prefix + command.unique_key,
+            command.unique_ttl + command.debounce,
+        )
     
-    def write(self, msg):
-        self.queue.write(msg)
+    def _release_unique(self, commands):
+        """
+        Release the keys claimed by the unique commands in 'commands', so an
+        identical command can be enqueued
+        """
+        if self.unique_lock is not None:
+            for command in commands:
+                if command.unique_key:
+                    self.unique_lock.release(self.unique_prefix + command.unique_key)
+    
+    def _get_message(self, command, eta=None):
+        # stamp the message with the time it can be read, in milliseconds,
+        # so the consumer can tell how long it waited in the queue
+        if eta is None:
+            timestamp = time.time()
+        else:
+            timestamp = time.mktime(eta.timetuple()) + eta.microsecond / 1000000.0
+        command.enqueued_at = int(timestamp * 1000)
+        
+        return registry.get_message_for_command(command)
+    
+    def _write_command(self, command):
+        if command.debounce:
+            # identical commands enqueued during the wait are dropped
+            eta = datetime.datetime.now() + datetime.timedelta(seconds=command.debounce)
+            self.defer(command, eta)
+        else:
+            self.write(self._get_message(command), command.priority, command.queue)
+    
+    def defer(self, command, eta):
+        """
+        Store a command so that it is not read until after the datetime 'eta'
+        """
+        queue = self.get_queue(command.queue)
+        queue.schedule(self._get_message(command, eta), eta, command.priority)
+        self.notify_scheduled(queue)
+    
+    def _store_result(self, command, success, value):
+        if self.result_store is not None and command.task_id:
+            ttl = command.result_ttl or getattr(settings, 'QUEUE_RESULT_TTL', 3600)
+            self.result_store.put(command.task_id, (success, value), ttl)
+    
+    def _execute(self, commands, func):
+        # once a unique command starts executing an identical one can be
+        # enqueued again
+        self._release_unique(commands)
+        
+        try:
+            result = func()
+        except Exception, exc:
+            error = '%s: %s' % (type(exc).__name__, exc)
+            for command in commands:
+                # commands that will be retried have no result yet
+                if command.retry_count >= command.retries:
+                    self._store_result(command, False, error)
+            raise
+        
+        for command in commands:
+            self._store_result(command, True, result)
+        return result
+    
+    def execute(self, command):
+        """
+        Execute a command, storing whatever it returns (or the error it
+        raised) if the command has an id and results are being stored
+        """
+        return self._execute([command], command.execute)
+    
+    def execute_batch(self, commands):
+        """
+        Execute a list of commands of the same class in one go, storing the
+        value returned for the whole batch as the result of each command
+        """
+        return self._execute(commands, lambda: type(commands[0]).execute_batch(commands))
     
     def enqueue(self, command):
+        result = self._get_result(command)
+        
         if getattr(settings, 'QUEUE_ALWAYS_EAGER', False):
             # if the queue is set to always eager, run commands in-process --
             # useful if you're running DEBUG
-            return command.execute()
+            value = self.execute(command)
+            return result or value
+        
+        if not self._acquire_unique(command):
+            return None
+        
+        try:
+            self._write_command(command)
+        except:
+            # nothing was enqueued, so a retry must not be dropped
+            self._release_unique([command])
+            raise
+        return result
+    
+    def enqueue_many(self, commands):
+        """
+        Enqueue a list of commands, letting the backend store them all in as
+        few round-trips as possible
+        """
+        results = [self._get_result(command) for command in commands]
+        
+        if getattr(settings, 'QUEUE_ALWAYS_EAGER', False):
+            values = [self.execute(command) for command in commands]
+            if self.result_store is None:
+                return values
+            return results
+        
+        # group the messages by queue and priority, preserving their order
+        groups = []
+        grouped = {}
+        
+        # commands whose unique key has been claimed, until they are written
+        pending = {}
+        try:
+            for i, command in enumerate(commands):
+                if not self._acquire_unique(command):
+                    results[i] = None
+                    continue
+                pending[id(command)] = command
+                
+                if command.debounce:
+                    self._write_command(command)
+                    del(pending[id(command)])
+                    continue
+                
+                group = (command.queue, command.priority)
+                if group not in grouped:
+                    groups.append(group)
+                    grouped[group] = []
+                grouped[group].append((command, self._get_message(command)))
+            
+            for queue, priority in groups:
+                group = grouped[(queue, priority)]
+                self.get_queue(queue).write_many([message for command, message in group], priority)
+                for command, message in group:
+                    del(pending[id(command)])
+        except:
+            self._release_unique(pending.values())
+            raise
+        
+        # once every message is written, so none are missed by a consumer
+        # that wakes up straight away
+        notified = []
+        for queue, priority in groups:
+            if queue not in notified:
+                self.notify(self.get_queue(queue))
+                notified.append(queue)
+        
+        if self.result_store is not None:
+            return results
+    
+    def schedule(self, command, eta):
+        """
+        Enqueue a command to be executed once the datetime 'eta' has passed
+        """
+        result = self._get_result(command)
+        
+        if getattr(settings, 'QUEUE_ALWAYS_EAGER', False):
+            value = self.execute(command)
+            return result or value
+        
+        if not self._acquire_unique(command):
+            return None
+        
+        try:
+            self.defer(command, eta)
+        except:
+            self._release_unique([command])
+            raise
+        return result
+    
+    def next_eta(self):
+        """
+        Return the timestamp at which the earliest message scheduled in any
+        of the queues used so far is due, or None
+        """
+        etas = [eta for eta in [queue.next_eta() for queue in self.get_queues()] if eta is not None]
+        if etas:
+            return min(etas)
+    
+    def promote(self):
+        promoted = 0
+        for queue in self.get_queues():
+            count = queue.promote()
+            if count:
+                self.notify(queue)
+                promoted += count
+        return promoted
+    
+    def read(self, queue=None):
+        return self.get_queue(queue).read()
+    
+    def read_many(self, n, queue=None):
+        return self.get_queue(queue).read_many(n)
+    
+    def read_first(self, n, queues):
+        """
+        Read up to 'n' messages from the first of the named 'queues' that has
+        any waiting, returning a 2-tuple of the name of the queue and the
+        messages.  Blocking queues are read without blocking first, then
+        block once on all of the queues at the same time
+        """
+        for name in queues:
+            if self.queue.blocking:
+                messages = self.get_queue(name).read_many(n, block=False)
+            else:
+                messages = self.read_many(n, name)
+            if messages:
+                return name, messages
         
-        self.write(registry.get_message_for_command(command))
+        if self.queue.blocking:
+            instances = [self.get_queue(name) for name in queues]
+            queue, messages = self.queue.read_from(instances, n)
+            if messages:
+                return queues[instances.index(queue)], messages
+        
+        return None, []
+    
+    def ack(self, msg, queue=None):
+        self.get_queue(queue).ack(msg)
     
-    def read(self):
-        return self.queue.read()
+    def reap(self):
+        return sum([queue.reap() for queue in self.get_queues()])
     
     def dequeue(self):
         msg = self.read()
         
         if msg:
-            command = registry.get_command_for_message(msg)
-            command.execute()
+            try:
+                command = registry.get_command_for_message(msg)
+                self.execute(command)
+            except:
+                self.retry(msg)
+                raise
+            finally:
+                self.ack(msg)
             return msg
     
+    def get_dead_queue(self):
+        """
+        Return the queue that failed messages are parked in once they have
+        used up their retries
+        """
+        if self._dead_queue is None:
+            self._dead_queue = self.queue.get_named_queue(RESERVED_QUEUE_NAMES[0])
+        return self._dead_queue
+    
+    def retry(self, msg):
+        """
+        Called when executing a message fails.  If the command has retries
+        left it is enqueued again after a delay that grows with each retry,
+        otherwise the message is parked in the dead-letter queue.  Returns
+        True if the command will be retried
+        """
+        try:
+            command = registry.get_command_for_message(msg)
+        except QueueException:
+            # the message cannot be loaded, so it will never succeed
+            self.get_dead_queue().write(msg)
+            return False
+        
+        if command.retry_count >= command.retries:
+            self.get_dead_queue().write(msg)
+            return False
+        
+        delay = command.retry_delay * (command.backoff ** command.retry_count)
+        command.retry_count += 1
+        command.unique_key = None
+        command.rate_limit_reserved = False
+        
+        if delay > 0:
+            self.defer(command, datetime.datetime.now() + datetime.timedelta(seconds=delay))
+        else:
+            self.write(self._get_message(command), command.priority, command.queue)
+        return True
+    
+    def replay(self, limit=None):
+        """
+        Move messages from the dead-letter queue back onto the queue, giving
+        each command its full number of retries again.  Returns the number of
+        messages moved
+        """
+        dead_queue = self.get_dead_queue()
+        replayed = 0
+        
+        # messages that fail again while replaying are not replayed twice
+        if limit is None:
+            limit = len(dead_queue)
+        
+        while replayed < limit:
+            # messages are only removed from the dead-letter queue once they
+            # have been written back, so a crash in between leaves a message
+            # in both queues rather than in neither
+            messages = dead_queue.peek(min(100, limit - replayed))
+            if not messages:
+                break
+            
+            for msg in messages:
+                try:
+                    command = registry.get_command_for_message(msg)
+                except QueueException:
+                    # put it back as-is, the command may be importable later
+                    self.write(msg)
+                else:
+                    command.retry_count = 0
+                    command.unique_key = None
+                    command.rate_limit_reserved = False
+                    self.write(self._get_message(command), command.priority, command.queue)
+                dead_queue.remove(msg)
+            
+            replayed += len(messages)
+        
+        return replayed
+    
     def flush(self):
-        self.queue.flush()
+        for queue in self.get_queues():
+            queue.flush()
     
     def enqueue_periodic_commands(self, dt=None):
         dt = dt or datetime.datetime.now()
@@ -97,6 +532,62 @@ class QueueCommand(object):
     
     __metaclass__ = QueueCommandMetaClass
     
+    # commands with a higher priority are executed before those with a
+    # lower priority
+    priority = 0
+    
+    # set when results are being stored, used to look up the result
+    task_id = None
+    
+    # seconds to keep the result around, defaults to QUEUE_RESULT_TTL
+    result_ttl = None
+    
+    # number of times to retry the command if it raises an exception, the
+    # n-th retry is delayed by retry_delay * (backoff ** (n - 1)) seconds
+    retries = 0
+    retry_delay = 0
+    backoff = 2
+    
+    # number of times the command has been retried
+    retry_count = 0
+    
+    # unique commands are not enqueued while an identical command, one with
+    # the same get_unique_key(), is waiting in the queue.  Commands with a
+    # debounce wait that many seconds before they can be read, so identical
+    # commands enqueued in the meantime are coalesced
+    unique = False
+    debounce = 0
+    
+    # seconds after which the claim on a unique command's key is given up,
+    # in case the message is lost
+    unique_ttl = 3600
+    
+    # set when a unique command is enqueued, released when it executes
+    unique_key = None
+    
+    # commands with a batch_size are buffered by the consumer and executed
+    # together by execute_batch(), once batch_size of them are waiting or
+    # the oldest has waited batch_wait seconds
+    batch_size = 0
+    batch_wait = 1.0
+    
+    # the most times each consumer will execute the command, i.e. '100/m'.
+    # Commands over the limit are put back in the queue until a call has
+    # been reserved for them
+    rate_limit = None
+    rate_limit_reserved = False
+    
+    # milliseconds since the epoch when the message became available to read
+    enqueued_at = None
+    
+    # name of the queue the command is written to, None for the default
+    queue = None
+    
+    # seconds the command may run before SoftTimeLimitExceeded is raised in
+    # it, and before the worker process executing it is killed
+    soft_time_limit = None
+    time_limit = None
+    
     def __init__(self, data=None):
         """
         Initialize the command object with a receiver and optional data.  The
@@ -115,17 +606,130 @@ class QueueCommand(object):
     def execute(self):
         """Execute any arbitary code here"""
         raise NotImplementedError
+    
+    @classmethod
+    def execute_batch(cls, commands):
+        """Execute a list of commands, by default one at a time"""
+        for command in commands:
+            command.execute()
+    
+    def get_unique_key(self):
+        """Identical commands return the same key, by default a hash of the data"""
+        # djutils.cache pulls in the ORM and template system, which would slow
+        # down importing the queue
+        from djutils.cache import key_from_args
+        return key_from_args(self.get_data())
 
 
 class PeriodicQueueCommand(QueueCommand):
     def validate_datetime(self, dt):
         """Validate that the command should execute at the given datetime"""
         return False
+    
+    def next_fire_after(self, dt):
+        """
+        Return the next datetime after 'dt' the command should be validated
+        at -- by default the start of the next minute
+        """
+        return dt.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+
+
+class LazyInvoker(LazyObject):
+    """
+    The global :class:`Invoker`, which loads the Queue class we're using and
+    connects to the backend the first time it is used rather than when this
+    module is imported
+    """
+    _lock = threading.Lock()
+    
+    def _setup(self):
+        # every thread must share the same instance, reliable queues keep
+        # track of the messages they have read
+        self._lock.acquire()
+        try:
+            if self._wrapped is None:
+                queue = get_queue_class()(get_queue_name(), getattr(settings, 'QUEUE_CONNECTION', None))
+                self._wrapped = Invoker(
+                    queue,
+                    get_result_store(),
+                    get_lock('QUEUE_UNIQUE_LOCK'),
+                    get_notifier(),
+                )
+        finally:
+            self._lock.release()
+
+
+class LazyQueue(LazyObject):
+    """
+    The queue used by the global invoker
+    """
+    def _setup(self):
+        self._wrapped = invoker.queue
+    
+    def __len__(self):
+        if self._wrapped is None:
+            self._setup()
+        return len(self._wrapped)
+
+
+class LazyQueueClass(LazyObject):
+    """
+    The Queue class configured by ``QUEUE_CLASS`` -- deprecated, use
+    :func:`get_queue_class` instead
+    """
+    def _setup(self):
+        self._wrapped = get_queue_class()
+    
+    def __call__(self, *args, **kwargs):
+        if self._wrapped is None:
+            self._setup()
+        return self._wrapped(*args, **kwargs)
+
+
+class LazyQueueName(LazyObject):
+    """
+    The name of the default queue -- deprecated, use :func:`get_queue_name`
+    instead
+    """
+    def _setup(self):
+        self._wrapped = get_queue_name()
+    
+    def _get_name(self):
+        if self._wrapped is None:
+            self._setup()
+        return self._wrapped
+    
+    def __str__(self):
+        return str(self._get_name())
+    
+    def __unicode__(self):
+        return unicode(self._get_name())
+    
+    def __repr__(self):
+        return repr(self._get_name())
+    
+    def __eq__(self, other):
+        return self._get_name() == other
+    
+    def __ne__(self, other):
+        return self._get_name() != other
+    
+    def __hash__(self):
+        return hash(self._get_name())
+    
+    def __len__(self):
+        return len(self._get_name())
+    
+    def __add__(self, other):
+        return self._get_name() + other
+    
+    def __radd__(self, other):
+        return other + self._get_name()
 
 
-# dynamically load up an instance of the Queue class we're using
-Queue = get_queue_class()
+invoker = LazyInvoker()
+queue = LazyQueue()
 
-queue_name = get_queue_name()
-queue = Queue(queue_name, getattr(settings, 'QUEUE_CONNECTION', None))
-invoker = Invoker(queue)
+# kept for code that imported these before settings were read lazily
+Queue = LazyQueueClass()
+queue_name = LazyQueueName()
@@ -0,0 +1,59 @@
+import re
+import threading
+import time
+
+
+rate_limit_re = re.compile('^(\d+)/([smh])$')
+
+periods = {
+    's': 1,
+    'm': 60,
+    'h': 3600,
+}
+
+def parse_rate_limit(rate_limit):
+    """
+    Convert a rate limit like '100/m' into a 2-tuple of the number of calls
+    and the period in seconds, raising a ValueError if it is invalid
+    """
+    match = rate_limit_re.match(rate_limit)
+    if not match or not int(match.group(1)):
+        raise ValueError('Rate limits look like "100/s", "100/m" or "100/h", not "%s"' % rate_limit)
+    return int(match.group(1)), periods[match.group(2)]
+
+
+class TokenBucket(object):
+    """
+    Holds up to 'capacity' tokens, refilled at 'rate' tokens per second.
+    Tokens can be reserved ahead of time, in which case the bucket goes
+    into debt that is paid off as it refills
+    """
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.time()
+        self._lock = threading.Lock()
+    
+    @classmethod
+    def from_rate_limit(cls, rate_limit):
+        calls, period = parse_rate_limit(rate_limit)
+        return cls(float(calls) / period, calls)
+    
+    def reserve(self, now=None):
+        """
+        Take a token, returning 0 if one was available, otherwise the number
+        of seconds until the token taken will have been refilled
+        """
+        self._lock.acquire()
+        try:
+            now = now or time.time()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+        finally:
+            self._lock.release()
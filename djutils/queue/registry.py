@@ -2,10 +2,21 @@ try:
     import cPickle as pickle
 except ImportError:
     import pickle
+import zlib
 
 from django.conf import settings
 
 from djutils.queue.exceptions import QueueException
+from djutils.queue.serializers import JSONSerializer, MsgpackSerializer, PickleSerializer
+from djutils.utils.helpers import load_class
+
+
+# every message starts with this byte, followed by the envelope version, a
+# byte of flags and the code of the serializer used for the data
+ENVELOPE_MAGIC = '\xd7'
+ENVELOPE_VERSION = 2
+
+FLAG_COMPRESSED = 1
 
 
 class CommandRegistry(object):
@@ -18,7 +29,20 @@ class CommandRegistry(object):
     _registry = {}
     _periodic_commands = []
     
-    message_template = '%(CLASS)s:%(DATA)s'
+    # serializers keyed by code, used to decode messages
+    _serializers = {}
+    
+    message_template = '%(HEADER)s%(CLASS)s:%(META)s:%(DATA)s'
+    
+    # command attributes stored in the message alongside the data, as a
+    # tuple of key in the message, attribute name and type
+    meta_attributes = (
+        ('id', 'task_id', str),
+        ('retry', 'retry_count', int),
+        ('uniq', 'unique_key', str),
+        ('rl', 'rate_limit_reserved', int),
+        ('ts', 'enqueued_at', long),
+    )
 
     def command_to_string(self, command):
         return '%s.%s' % (command.__module__, command.__name__)
@@ -43,26 +67,119 @@ class CommandRegistry(object):
                 if isinstance(command, command_class):
                     self._periodic_commands.remove(command)
     
+    def get_queue_names(self):
+        """
+        Return the names of the named queues registered commands are routed to
+        """
+        names = set()
+        for command_class in self._registry.values():
+            if getattr(command_class, 'queue', None):
+                names.add(command_class.queue)
+        return sorted(names)
+    
     def __contains__(self, command_class):
         return str(command_class) in self._registry
 
+    def get_serializer(self):
+        """
+        Return an instance of the serializer configured by QUEUE_SERIALIZER,
+        pickle by default
+        """
+        serializer_class = load_class(getattr(
+            settings, 'QUEUE_SERIALIZER', 'djutils.queue.serializers.PickleSerializer'
+        ))
+        
+        serializer = self._serializers.get(serializer_class.code)
+        if type(serializer) is not serializer_class:
+            serializer = self._serializers[serializer_class.code] = serializer_class()
+        return serializer
+    
+    def get_serializer_for_code(self, code):
+        if code not in self._serializers:
+            for serializer_class in (PickleSerializer, JSONSerializer, MsgpackSerializer):
+                if serializer_class.code == code:
+                    self._serializers[code] = serializer_class()
+                    break
+            else:
+                # a custom QUEUE_SERIALIZER, which is cached under its code
+                if self.get_serializer().code != code:
+                    raise QueueException, 'No serializer found for code %r' % code
+        return self._serializers[code]
+    
     def get_message_for_command(self, command):
         """Convert a command object to a message for storage in the queue"""
+        serializer = self.get_serializer()
+        data = serializer.dumps(command.get_data())
+        flags = 0
+        
+        threshold = getattr(settings, 'QUEUE_COMPRESSION_THRESHOLD', 1024)
+        if threshold and len(data) > threshold:
+            compressed = zlib.compress(data)
+            if len(compressed) < len(data):
+                data = compressed
+                flags |= FLAG_COMPRESSED
+        
         return self.message_template % {
+            'HEADER': ENVELOPE_MAGIC + chr(ENVELOPE_VERSION) + chr(flags) + serializer.code,
             'CLASS': self.command_to_string(type(command)),
-            'DATA': pickle.dumps(command.get_data())
+            'META': self.get_meta_for_command(command),
+            'DATA': data,
         }
+    
+    def get_meta_for_command(self, command):
+        meta = []
+        for key, attr, type_ in self.meta_attributes:
+            value = getattr(command, attr, None)
+            if value:
+                meta.append('%s=%s' % (key, type_(value)))
+        return ','.join(meta)
+    
+    def set_meta_for_command(self, command, meta):
+        if not meta:
+            return
+        
+        converters = dict((key, (attr, type_)) for key, attr, type_ in self.meta_attributes)
+        for pair in meta.split(','):
+            key, value = pair.split('=', 1)
+            if key in converters:
+                attr, type_ = converters[key]
+                setattr(command, attr, type_(value))
 
     def get_command_for_message(self, msg):
         """Convert a message from the queue into a command"""
-        # parse out the pieces from the enqueued message
-        klass_str, data = msg.split(':', 1)
+        msg = str(msg)
+        
+        if not msg.startswith(ENVELOPE_MAGIC):
+            # a message enqueued before the envelope was introduced
+            klass_str, data = msg.split(':', 1)
+            return self.get_command_class(klass_str)(pickle.loads(data))
+        
+        version, flags, code = ord(msg[1]), ord(msg[2]), msg[3]
         
+        # parse out the pieces from the enqueued message -- version 1 had
+        # no metadata
+        if version == ENVELOPE_VERSION:
+            klass_str, meta, data = msg[4:].split(':', 2)
+        elif version == 1:
+            klass_str, data = msg[4:].split(':', 1)
+            meta = ''
+        else:
+            raise QueueException, 'Unsupported message version %d' % version
+        
+        klass = self.get_command_class(klass_str)
+        
+        if flags & FLAG_COMPRESSED:
+            data = zlib.decompress(data)
+        
+        command = klass(self.get_serializer_for_code(code).loads(data))
+        self.set_meta_for_command(command, meta)
+        return command
+    
+    def get_command_class(self, klass_str):
         klass = self._registry.get(klass_str)
         if not klass:
             raise QueueException, '%s not found in CommandRegistry' % klass_str
-        
-        return klass(pickle.loads(str(data)))
+        return klass
     
     def get_periodic_commands(self):
         return self._periodic_commands
@@ -0,0 +1,159 @@
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+import time
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from djutils.queue.connections import get_redis_connection
+from djutils.queue.exceptions import CommandFailed, ResultTimeout
+
+
+class BaseResultStore(object):
+    """
+    Stores the values returned by commands executed by the consumer, keyed by
+    the id of the command.  Values are stored as a 2-tuple of a success flag
+    and either the return value or a description of the error
+    """
+    def put(self, task_id, value, ttl):
+        """
+        Store 'value' for 'ttl' seconds
+        """
+        raise NotImplementedError
+    
+    def get_many(self, task_ids):
+        """
+        Return a dictionary of the stored values for the given ids, ids that
+        have no value yet should be left out
+        """
+        raise NotImplementedError
+
+
+class CacheResultStore(BaseResultStore):
+    """
+    Stores results using django's cache -- the cache must be shared by the
+    consumer and your site, so memcached will work but locmem will not
+    """
+    key_prefix = 'djutils.queue.result.'
+    
+    def __init__(self):
+        # loading the cache backend reads the settings, so it is imported
+        # when the store is created rather than when the queue is imported
+        from django.core.cache import cache
+        self.cache = cache
+    
+    def put(self, task_id, value, ttl):
+        self.cache.set(self.key_prefix + task_id, value, ttl)
+    
+    def get_many(self, task_ids):
+        values = self.cache.get_many([self.key_prefix + task_id for task_id in task_ids])
+        return dict(
+            (key[len(self.key_prefix):], value) for key, value in values.items()
+        )
+
+
+class RedisResultStore(BaseResultStore):
+    """
+    Stores results in redis:
+    
+    QUEUE_RESULT_CONNECTION = 'host:port:database', a redis:// or unix:// url,
+    or defaults to localhost:6379:0
+    """
+    key_prefix = 'djutils.queue.result.'
+    
+    def __init__(self):
+        if redis is None:
+            raise ImproperlyConfigured('The redis library is required to use the RedisResultStore')
+        
+        self.conn = get_redis_connection(getattr(settings, 'QUEUE_RESULT_CONNECTION', None))
+    
+    def put(self, task_id, value, ttl):
+        self.conn.setex(self.key_prefix + task_id, int(ttl), pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+    
+    def get_many(self, task_ids):
+        values = self.conn.mget([self.key_prefix + task_id for task_id in task_ids])
+        return dict(
+            (task_id, pickle.loads(value)) for task_id, value in zip(task_ids, values)
+            if value is not None
+        )
+
+
+class AsyncResult(object):
+    """
+    A handle on the result of a command executed by the consumer
+    """
+    # seconds to wait between checks for the result
+    poll_interval = .1
+    
+    def __init__(self, task_id, store):
+        self.task_id = task_id
+        self.store = store
+        self._value = None
+        self._ready = False
+    
+    def _set_value(self, value):
+        self._value = value
+        self._ready = True
+    
+    def ready(self):
+        """
+        Return True if the command has finished executing
+        """
+        if not self._ready:
+            values = self.store.get_many([self.task_id])
+            if self.task_id in values:
+                self._set_value(values[self.task_id])
+        return self._ready
+    
+    def get(self, timeout=None):
+        """
+        Return the value returned by the command, waiting up to 'timeout'
+        seconds (or forever) for it to finish executing.  Raises ResultTimeout
+        if the timeout is reached, and CommandFailed if the command raised an
+        exception
+        """
+        return get_many([self], timeout)[0]
+
+
+def get_many(handles, timeout=None):
+    """
+    Wait for a list of results, returning their values in the same order.
+    Each check for results fetches every pending result in a single call
+    """
+    if timeout is not None:
+        deadline = time.time() + timeout
+    
+    while True:
+        pending = {}
+        for handle in handles:
+            if not handle._ready:
+                pending.setdefault(handle.store, []).append(handle)
+        
+        for store, store_handles in pending.items():
+            values = store.get_many([handle.task_id for handle in store_handles])
+            for handle in store_handles:
+                if handle.task_id in values:
+                    handle._set_value(values[handle.task_id])
+        
+        if all([handle._ready for handle in handles]):
+            break
+        
+        if timeout is not None and time.time() >= deadline:
+            raise ResultTimeout('Timed out waiting for results')
+        
+        time.sleep(AsyncResult.poll_interval)
+    
+    results = []
+    for handle in handles:
+        success, value = handle._value
+        if not success:
+            raise CommandFailed(value)
+        results.append(value)
+    return results
@@ -0,0 +1,102 @@
+import datetime
+import heapq
+
+from djutils.queue.locks import get_lock
+from djutils.queue.registry import registry
+
+
+def get_tick_lock():
+    return get_lock('QUEUE_PERIODIC_LOCK')
+
+
+class PeriodicScheduler(object):
+    """
+    Keeps periodic commands in a heap ordered by the next time each one is
+    due, so the consumer can sleep until exactly then instead of checking
+    every command once a minute
+    """
+    # ticks of a single command that will be caught up after a pause, any
+    # older ticks are skipped
+    max_catchup = 60
+    
+    # seconds to hold on to the claim on each tick, must be longer than the
+    # clocks on the consumers' hosts can disagree
+    lock_ttl = 3600
+    
+    def __init__(self, commands, start=None, lock=None, prefix=''):
+        self._heap = []
+        
+        # used to claim each tick when several consumers enqueue periodic
+        # commands, keys are namespaced by 'prefix'
+        self.lock = lock
+        self.prefix = prefix
+        
+        start = start or datetime.datetime.now()
+        for i, command in enumerate(commands):
+            self._push(command.next_fire_after(start), i, command)
+    
+    def _push(self, dt, i, command):
+        # commands that will never fire again are dropped, the index breaks
+        # ties so commands are never compared
+        if dt is not None:
+            heapq.heappush(self._heap, (dt, i, command))
+    
+    def __len__(self):
+        return len(self._heap)
+    
+    def next_run(self):
+        """
+        Return the datetime the next command is due, or None
+        """
+        if self._heap:
+            return self._heap[0][0]
+    
+    def seconds_until_next(self, now=None):
+        """
+        Return the number of seconds until the next command is due, or None
+        """
+        next_run = self.next_run()
+        if next_run is not None:
+            delta = next_run - (now or datetime.datetime.now())
+            # timedelta.total_seconds() is new in python 2.7
+            seconds = delta.days * 86400 + delta.seconds + delta.microseconds / 1000000.0
+            return max(seconds, 0)
+    
+    def claim(self, dt, command):
+        """
+        Return True if this consumer should enqueue the tick of 'command' due
+        at 'dt', False if another consumer has already claimed it
+        """
+        if self.lock is None:
+            return True
+        
+        key = 'djutils.queue.periodic.%s%s.%s' % (
+            self.prefix,
+            registry.command_to_string(type(command)),
+            dt.strftime('%Y%m%d%H%M%S'),
+        )
+        return self.lock.acquire(key, self.lock_ttl)
+    
+    def pop_due(self, now=None):
+        """
+        Return a list of (datetime, command) for every tick due at or before
+        'now', including any missed while the consumer was paused, and
+        schedule each command's next tick
+        """
+        now = now or datetime.datetime.now()
+        due = []
+        ticks = {}
+        
+        while self._heap and self._heap[0][0] <= now:
+            dt, i, command = heapq.heappop(self._heap)
+            
+            if command.validate_datetime(dt):
+                due.append((dt, command))
+            
+            ticks[i] = ticks.get(i, 0) + 1
+            if ticks[i] < self.max_catchup:
+                self._push(command.next_fire_after(dt), i, command)
+            else:
+                self._push(command.next_fire_after(now), i, command)
+        
+        return due
@@ -0,0 +1,75 @@
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from django.core.exceptions import ImproperlyConfigured
+
+
+class BaseSerializer(object):
+    """
+    Converts the data attached to a command to and from a string.  Each
+    serializer has a single-character code that is stored in every message,
+    so a consumer can decode messages written with any serializer
+    """
+    code = None
+    
+    def dumps(self, data):
+        raise NotImplementedError
+    
+    def loads(self, data):
+        raise NotImplementedError
+
+
+class PickleSerializer(BaseSerializer):
+    """
+    Pickles data using the highest protocol available -- supports anything
+    that can be pickled, including model instances
+    """
+    code = 'p'
+    
+    def dumps(self, data):
+        return pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+    
+    def loads(self, data):
+        return pickle.loads(data)
+
+
+class JSONSerializer(BaseSerializer):
+    """
+    Only supports basic types, and tuples come back as lists
+    """
+    code = 'j'
+    
+    def dumps(self, data):
+        return json.dumps(data, separators=(',', ':'))
+    
+    def loads(self, data):
+        return json.loads(data)
+
+
+class MsgpackSerializer(BaseSerializer):
+    """
+    A compact binary alternative to JSON, requires the msgpack library
+    """
+    code = 'm'
+    
+    def __init__(self):
+        if msgpack is None:
+            raise ImproperlyConfigured('The msgpack library is required to use the MsgpackSerializer')
+    
+    def dumps(self, data):
+        return msgpack.packb(data)
+    
+    def loads(self, data):
+        return msgpack.unpackb(data)
@@ -0,0 +1,304 @@
+import math
+import os
+import socket
+import threading
+import time
+
+from django.core.cache import cache
+
+from djutils.queue.queue import get_queue_name
+
+
+class Histogram(object):
+    """
+    Counts values in buckets that grow by 'factor', so memory use stays
+    constant and percentiles are accurate to within that factor
+    """
+    def __init__(self, smallest=.001, factor=1.1):
+        self.smallest = smallest
+        self.factor = factor
+        self.counts = {}
+        self.count = 0
+        self.max = 0
+    
+    def add(self, value):
+        if value <= self.smallest:
+            bucket = 0
+        else:
+            bucket = int(math.ceil(math.log(value / self.smallest, self.factor)))
+        
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1
+        self.max = max(self.max, value)
+    
+    def merge(self, other):
+        """
+        Add the values counted by another histogram with the same buckets
+        """
+        for bucket, count in other.counts.items():
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+        self.count += other.count
+        self.max = max(self.max, other.max)
+    
+    def subtract(self, other):
+        """
+        Remove the values counted by an earlier copy of this histogram, which
+        leaves the values added since.  The max cannot be taken back, so it
+        stays the largest value ever added
+        """
+        for bucket, count in other.counts.items():
+            remaining = self.counts.get(bucket, 0) - count
+            if remaining > 0:
+                self.counts[bucket] = remaining
+            elif bucket in self.counts:
+                del(self.counts[bucket])
+        self.count = sum(self.counts.values())
+    
+    def to_dict(self):
+        return {'counts': dict(self.counts), 'count': self.count, 'max': self.max}
+    
+    @classmethod
+    def from_dict(cls, data):
+        histogram = cls()
+        histogram.counts = dict(data['counts'])
+        histogram.count = data['count']
+        histogram.max = data['max']
+        return histogram
+    
+    def percentile(self, p):
+        """
+        Return the value that p percent of the values are at or below
+        """
+        if not self.count:
+            return 0
+        
+        threshold = self.count * p / 100.0
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= threshold:
+                return min(self.smallest * self.factor ** bucket, self.max)
+        return self.max
+    
+    def summary(self):
+        return {
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+            'max': self.max,
+        }
+
+
+class CommandStats(object):
+    """
+    Counters and histograms of the time spent waiting in the queue and
+    executing, in seconds, for a single command class
+    """
+    def __init__(self):
+        self.executed = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.wait = Histogram()
+        self.run = Histogram()
+    
+    def record(self, wait, run, success, timed_out=False):
+        if success:
+            self.executed += 1
+        else:
+            self.failed += 1
+        if timed_out:
+            self.timeouts += 1
+        
+        if wait is not None:
+            self.wait.add(max(wait, 0))
+        self.run.add(run)
+    
+    def merge(self, other):
+        self.executed += other.executed
+        self.failed += other.failed
+        self.timeouts += other.timeouts
+        self.wait.merge(other.wait)
+        self.run.merge(other.run)
+    
+    def to_dict(self):
+        return {
+            'executed': self.executed,
+            'failed': self.failed,
+            'timeouts': self.timeouts,
+            'wait': self.wait.to_dict(),
+            'run': self.run.to_dict(),
+        }
+    
+    @classmethod
+    def from_dict(cls, data):
+        command_stats = cls()
+        command_stats.executed = data['executed']
+        command_stats.failed = data['failed']
+        command_stats.timeouts = data['timeouts']
+        command_stats.wait = Histogram.from_dict(data['wait'])
+        command_stats.run = Histogram.from_dict(data['run'])
+        return command_stats
+    
+    def summary(self):
+        return {
+            'executed': self.executed,
+            'failed': self.failed,
+            'timeouts': self.timeouts,
+            'wait': self.wait.summary(),
+            'run': self.run.summary(),
+        }
+
+
+class QueueStats(object):
+    """
+    Collects statistics about the commands executed by a consumer, keyed by
+    command class.  Each consumer publishes its stats under a key of its own,
+    and reading them adds up the stats of every consumer of the queue
+    """
+    # seconds to keep stats published to the cache -- consumers that have
+    # not published for this long are no longer counted
+    cache_timeout = 300
+    
+    def __init__(self):
+        self._commands = {}
+        self._lock = threading.Lock()
+        self.started = time.time()
+    
+    def record(self, command_str, wait, run, success=True, timed_out=False):
+        """
+        Record that a command waited 'wait' seconds in the queue (or None if
+        unknown) and took 'run' seconds to execute, and whether it failed by
+        exceeding its time limit
+        """
+        self._lock.acquire()
+        try:
+            if command_str not in self._commands:
+                self._commands[command_str] = CommandStats()
+            self._commands[command_str].record(wait, run, success, timed_out)
+        finally:
+            self._lock.release()
+    
+    def get_consumer_id(self):
+        return '%s:%d' % (socket.gethostname(), os.getpid())
+    
+    def dump(self):
+        """
+        Return the raw counters and histograms of each command class, which
+        unlike a snapshot can be merged with those of other consumers
+        """
+        self._lock.acquire()
+        try:
+            commands = dict(
+                (command_str, stats.to_dict()) for command_str, stats in self._commands.items()
+            )
+        finally:
+            self._lock.release()
+        
+        return {
+            'consumer': self.get_consumer_id(),
+            'started': self.started,
+            'updated': time.time(),
+            'commands': commands,
+        }
+    
+    def merge(self, dumps):
+        """
+        Add up a list of dumps into a snapshot.  'consumers' maps the id of
+        each consumer to when it was started and last updated, and the number
+        of commands it executed and failed
+        """
+        commands = {}
+        consumers = {}
+        for dump in dumps:
+            executed = failed = 0
+            for command_str, data in dump['commands'].items():
+                command_stats = CommandStats.from_dict(data)
+                if command_str in commands:
+                    commands[command_str].merge(command_stats)
+                else:
+                    commands[command_str] = command_stats
+                executed += command_stats.executed
+                failed += command_stats.failed
+            
+            consumers[dump['consumer']] = {
+                'started': dump['started'],
+                'updated': dump['updated'],
+                'executed': executed,
+                'failed': failed,
+            }
+        
+        return {
+            'consumers': consumers,
+            'started': min([dump['started'] for dump in dumps]),
+            'updated': max([dump['updated'] for dump in dumps]),
+            'commands': dict(
+                (command_str, stats.summary()) for command_str, stats in commands.items()
+            ),
+        }
+    
+    def snapshot(self):
+        """
+        Return a dictionary of the counters and p50/p95/p99/max wait and run
+        times of each command class
+        """
+        return self.merge([self.dump()])
+    
+    def reset(self):
+        self._lock.acquire()
+        try:
+            self._commands = {}
+            self.started = time.time()
+        finally:
+            self._lock.release()
+    
+    def get_cache_key(self, queue_name, consumer_id):
+        return 'djutils.queue.stats.%s.%s' % (queue_name, consumer_id)
+    
+    def get_index_key(self, queue_name):
+        return 'djutils.queue.stats.%s.consumers' % queue_name
+    
+    def publish(self, queue_name):
+        """
+        Store a dump in the cache, so the stats can be read by other
+        processes, and add the consumer to the index of the queue's consumers
+        """
+        dump = self.dump()
+        cache.set(self.get_cache_key(queue_name, dump['consumer']), dump, self.cache_timeout)
+        
+        # the index maps consumers to when they last published, a consumer
+        # that is dropped by a concurrent update adds itself back next time
+        index_key = self.get_index_key(queue_name)
+        cutoff = dump['updated'] - self.cache_timeout
+        index = dict([
+            (consumer_id, updated) for consumer_id, updated in (cache.get(index_key) or {}).items()
+            if updated > cutoff
+        ])
+        index[dump['consumer']] = dump['updated']
+        cache.set(index_key, index, self.cache_timeout)
+    
+    def get_dumps(self, queue_name):
+        """
+        Return the dumps published by every consumer of the queue, or a dump
+        of the stats collected in this process if there are none
+        """
+        index = cache.get(self.get_index_key(queue_name)) or {}
+        dumps = cache.get_many([
+            self.get_cache_key(queue_name, consumer_id) for consumer_id in index
+        ]).values()
+        return dumps or [self.dump()]
+    
+    def get(self, queue_name):
+        """
+        Return a snapshot of the stats published by every consumer of the
+        queue, or of the stats collected in this process if there are none
+        """
+        return self.merge(self.get_dumps(queue_name))
+
+
+stats = QueueStats()
+
+def get_stats():
+    """
+    Return the stats of the consumers executing messages from the queue
+    """
+    return stats.get(get_queue_name())
@@ -0,0 +1,110 @@
+import ctypes
+import signal
+import thread
+import threading
+
+from djutils.queue.exceptions import SoftTimeLimitExceeded
+
+
+def set_async_exc(thread_id, exc_class):
+    """
+    Raise 'exc_class' in the thread with the given id the next time it
+    executes python code, or clear a pending exception if it is None
+    """
+    return ctypes.pythonapi.PyThreadState_SetAsyncExc(
+        ctypes.c_long(thread_id),
+        exc_class and ctypes.py_object(exc_class),
+    )
+
+def call_with_time_limit(limit, func, *args):
+    limit.start()
+    try:
+        return func(*args)
+    finally:
+        limit.cancel()
+
+
+class ThreadTimeLimit(object):
+    """
+    Raises SoftTimeLimitExceeded in the thread that started it once 'seconds'
+    have passed, unless cancelled first.  Threads cannot be killed, and the
+    exception is only raised between bytecodes, so a thread blocked in a
+    system call sees it once the call returns
+    """
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expired = False
+        self._thread_id = None
+        self._timer = None
+        self._lock = threading.Lock()
+    
+    def start(self):
+        if not self.seconds:
+            return
+        
+        self._thread_id = thread.get_ident()
+        self._timer = threading.Timer(self.seconds, self.expire)
+        self._timer.daemon = True
+        self._timer.start()
+    
+    def expire(self):
+        self._lock.acquire()
+        try:
+            if self._timer is not None:
+                self.expired = True
+                set_async_exc(self._thread_id, SoftTimeLimitExceeded)
+        finally:
+            self._lock.release()
+    
+    def cancel(self):
+        self._lock.acquire()
+        try:
+            timer, self._timer = self._timer, None
+            if timer is not None:
+                timer.cancel()
+            
+            # the exception may still be pending if the limit expired just as
+            # the function returned, it must not be raised outside of it
+            if self.expired:
+                set_async_exc(self._thread_id, None)
+        finally:
+            self._lock.release()
+
+
+class SignalTimeLimit(object):
+    """
+    Enforces time limits with SIGALRM, so it can only be used in the main
+    thread of a process, i.e. in a worker process.  The soft limit raises
+    SoftTimeLimitExceeded, interrupting blocking system calls.  The hard
+    limit, counted from the start, lets SIGALRM take its default action of
+    terminating the process, which works even when it is stuck in C code
+    """
+    def __init__(self, soft=None, hard=None):
+        self.soft = soft
+        self.hard = hard
+        self._previous = None
+    
+    def start(self):
+        if not (self.soft or self.hard):
+            return
+        
+        self._previous = signal.getsignal(signal.SIGALRM)
+        if self.soft:
+            signal.signal(signal.SIGALRM, self.handle_soft_limit)
+            signal.setitimer(signal.ITIMER_REAL, self.soft)
+        else:
+            signal.signal(signal.SIGALRM, signal.SIG_DFL)
+            signal.setitimer(signal.ITIMER_REAL, self.hard)
+    
+    def handle_soft_limit(self, signum, frame):
+        if self.hard:
+            signal.signal(signal.SIGALRM, signal.SIG_DFL)
+            signal.setitimer(signal.ITIMER_REAL, max(self.hard - self.soft, .001))
+        raise SoftTimeLimitExceeded('Exceeded the soft time limit of %ss' % self.soft)
+    
+    def cancel(self):
+        if not (self.soft or self.hard):
+            return
+        
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, self._previous or signal.SIG_DFL)
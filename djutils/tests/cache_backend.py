@@ -8,14 +8,21 @@ class CacheClass(BaseCache):
     def __init__(self, *args, **kwargs):
         self._cache = {}
 
-    def get(self, key, default=None):
+    def get(self, key, default=None, *args, **kwargs):
         self.validate_key(key)
         return self._cache.get(key, default)
 
-    def set(self, key, value, timeout=None):
+    def set(self, key, value, timeout=None, *args, **kwargs):
         self.validate_key(key)
         self._cache[key] = value
 
+    def add(self, key, value, timeout=None, *args, **kwargs):
+        self.validate_key(key)
+        if key in self._cache:
+            return False
+        self._cache[key] = value
+        return True
+    
     def delete(self, key, *args, **kwargs):
         self.validate_key(key)
         if key in self._cache:
@@ -1,27 +1,48 @@
 import datetime
 import logging
+import os
+import tempfile
 import threading
 import time
+from StringIO import StringIO
 
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.core.management import call_command
 from django.core.management.base import CommandError
+from django.db import connection, DatabaseError
 
-from djutils.management.commands.queue_consumer import Command as QueueConsumer
+from djutils.dashboard.contrib.panels import QueueDepth, QueueLatency, QueueThroughput
+from djutils.management.commands.queue_benchmark import QueueBenchmark, compare_results, measure_startup, percentile
+from djutils.management.commands.queue_consumer import Command as QueueConsumer, IterableQueue, WeightedRoundRobin, parse_queues
+from djutils.models import QueueMessage
+from djutils.queue import queue as queue_module
+from djutils.queue.connections import get_connection_pool, get_redis_connection, parse_connection
 from djutils.queue.decorators import crontab, queue_command, periodic_command
-from djutils.queue.queue import QueueCommand, PeriodicQueueCommand, QueueException, invoker
-from djutils.queue.registry import registry
+from djutils.queue.queue import Invoker, LazyInvoker, QueueCommand, PeriodicQueueCommand, QueueException, invoker
+from djutils.queue.exceptions import CommandFailed, ResultTimeout, SoftTimeLimitExceeded
+from djutils.queue.registry import registry, ENVELOPE_MAGIC, FLAG_COMPRESSED
+from djutils.queue.backends.memory import MemoryQueue
+from djutils.queue.backends.redis_backend import RedisQueue, RedisBlockingQueue, RedisReliableQueue
+from djutils.queue.backends.sqlite import SqliteQueue
+from djutils.queue.results import CacheResultStore, get_many
+from djutils.queue.locks import CacheLock
+from djutils.queue.notify import BaseNotifier, SocketNotifier
+from djutils.queue.serializers import BaseSerializer
+from djutils.queue.ratelimit import TokenBucket, parse_rate_limit
+from djutils.queue.scheduler import PeriodicScheduler
+from djutils.queue.stats import Histogram, QueueStats, stats, get_stats
 from djutils.test import TestCase
 from djutils.utils.helpers import ObjectDict
 
 class DummyThreadQueue():
     """A replacement for the stdlib Queue.Queue"""
-    def put(self, message):
+    def put(self, item):
+        queue, message = item
         command = registry.get_command_for_message(message)
         command.execute()
-    
-    def join(self):
-        pass
 
 
 class TestQueueConsumer(QueueConsumer):
@@ -47,13 +68,120 @@ def user_command(user, data):
     user.save()
 
 
+@queue_command(priority=10)
+def urgent_user_command(user, data):
+    user.email = data
+    user.save()
+
+executed = []
+
+@queue_command
+def record_thread(value):
+    time.sleep(.05)
+    executed.append((value, threading.current_thread()))
+
+
+@queue_command
+def record_pid(filename):
+    fh = open(filename, 'a')
+    fh.write('%d\n' % os.getpid())
+    fh.close()
+
+
 class BampfException(Exception):
     pass
 
+@queue_command
+def add_numbers(a, b):
+    return a + b
+
+
 @queue_command
 def throw_error():
     raise BampfException('bampf')
 
+attempts = []
+
+@queue_command(retries=2)
+def flaky(value):
+    attempts.append(value)
+    if len(attempts) < 3:
+        raise BampfException('flaky')
+
+
+rebuilt = []
+
+@queue_command(unique=True, key=lambda obj_id, **kwargs: obj_id, retries=1)
+def rebuild(obj_id, force=False):
+    rebuilt.append(obj_id)
+
+
+@queue_command(debounce=5)
+def debounced(value):
+    rebuilt.append(value)
+
+
+batches = []
+
+@queue_command(batch_size=3, batch_wait=.1, retries=1)
+def index_documents(calls):
+    batches.append(calls)
+    if ('bad',) in calls:
+        raise BampfException('bad document')
+    return len(calls)
+
+
+@queue_command(rate_limit='2/m')
+def limited(value):
+    rebuilt.append(value)
+
+
+@queue_command(queue='images', retries=1)
+def resize(value):
+    rebuilt.append(value)
+    if value == 'bad':
+        raise BampfException('bad image')
+
+
+@queue_command(retries=2, retry_delay=10, backoff=3)
+def broken(value):
+    raise BampfException('broken')
+
+
+@queue_command(soft_time_limit=.2)
+def spin(seconds):
+    end = time.time() + seconds
+    while time.time() < end:
+        pass
+
+
+@queue_command(soft_time_limit=.2, time_limit=.5)
+def hang(ignore_soft_limit):
+    try:
+        time.sleep(5)
+    except SoftTimeLimitExceeded:
+        if not ignore_soft_limit:
+            raise
+        time.sleep(5)
+
+
+class ReprSerializer(BaseSerializer):
+    code = 'x'
+    
+    def dumps(self, data):
+        return repr(data)
+    
+    def loads(self, data):
+        return eval(data)
+
+
+class RecordingNotifier(BaseNotifier):
+    def __init__(self):
+        self.notified = []
+    
+    def notify(self, name):
+        self.notified.append(name)
+
 
 class TestPeriodicCommand(PeriodicQueueCommand):
     def execute(self):
@@ -80,6 +208,12 @@ class QueueTest(TestCase):
             max_delay=.4,
             no_periodic=False,
             threads=2,
+            prefetch=1,
+            processes=0,
+            max_tasks_per_child=0,
+            min_threads=0,
+            max_threads=0,
+            queues='',
             verbosity=1,
         )
         invoker.flush()
@@ -124,6 +258,244 @@ class QueueTest(TestCase):
         self.assertEqual(dummy.email, 'decor@ted.com')
         self.assertEqual(len(invoker.queue), 0)
     
+    def test_enqueue_many(self):
+        other = User.objects.create_user('other', 'other@example.com', 'password')
+        
+        invoker.enqueue_many([
+            UserCommand((self.dummy, self.dummy.email, 'first@example.com')),
+            UserCommand((other, other.email, 'second@example.com')),
+            UserCommand((self.dummy, 'first@example.com', 'third@example.com')),
+        ])
+        self.assertEqual(len(invoker.queue), 3)
+        
+        # messages are dequeued in the order they were written
+        invoker.dequeue()
+        self.assertEqual(User.objects.get(username='username').email, 'first@example.com')
+        
+        invoker.dequeue()
+        self.assertEqual(User.objects.get(username='other').email, 'second@example.com')
+        
+        invoker.dequeue()
+        self.assertEqual(User.objects.get(username='username').email, 'third@example.com')
+        self.assertEqual(len(invoker.queue), 0)
+        
+        # enqueueing nothing is a no-op
+        invoker.enqueue_many([])
+        self.assertEqual(len(invoker.queue), 0)
+    
+    def test_decorated_function_map(self):
+        users = [
+            User.objects.create_user('user%d' % i, 'user%d@example.com' % i, 'password')
+            for i in range(5)
+        ]
+        user_command.map([(user, 'mapped%d@example.com' % i) for i, user in enumerate(users)])
+        self.assertEqual(len(invoker.queue), 5)
+        
+        while invoker.dequeue():
+            pass
+        
+        for i in range(5):
+            user = User.objects.get(username='user%d' % i)
+            self.assertEqual(user.email, 'mapped%d@example.com' % i)
+    
+    def test_message_envelope(self):
+        message = registry.get_message_for_command(UserCommand(('a', 'b', 'c')))
+        
+        # magic byte, version, flags and serializer code precede the class
+        # and the metadata
+        self.assertEqual(message[:4], ENVELOPE_MAGIC + '\x02\x00p')
+        self.assertTrue(message[4:].startswith('djutils.tests.queue.UserCommand::'))
+        
+        command = registry.get_command_for_message(message)
+        self.assertTrue(isinstance(command, UserCommand))
+        self.assertEqual(command.get_data(), ('a', 'b', 'c'))
+        
+        # messages written before the envelope are still understood
+        command = registry.get_command_for_message(
+            'djutils.tests.queue.UserCommand:(S\'a\'\np1\nS\'b\'\np2\ntp3\n.'
+        )
+        self.assertEqual(command.get_data(), ('a', 'b'))
+        
+        # as are messages written by the first version of the envelope
+        command = registry.get_command_for_message(
+            ENVELOPE_MAGIC + '\x01\x00pdjutils.tests.queue.UserCommand:' + message.split(':', 2)[2]
+        )
+        self.assertEqual(command.get_data(), ('a', 'b', 'c'))
+        
+        # the id of the command is stored in the metadata
+        command = UserCommand(('a', 'b', 'c'))
+        command.task_id = 'abc123'
+        message = registry.get_message_for_command(command)
+        self.assertTrue(message[4:].startswith('djutils.tests.queue.UserCommand:id=abc123:'))
+        self.assertEqual(registry.get_command_for_message(message).task_id, 'abc123')
+        
+        self.assertRaises(QueueException, registry.get_command_for_message,
+            ENVELOPE_MAGIC + '\x7f\x00pdjutils.tests.queue.UserCommand:')
+        self.assertRaises(QueueException, registry.get_command_for_message,
+            ENVELOPE_MAGIC + '\x01\x00pdjutils.tests.queue.Missing:')
+    
+    def test_message_compression(self):
+        small = registry.get_message_for_command(UserCommand('x' * 100))
+        self.assertFalse(ord(small[2]) & FLAG_COMPRESSED)
+        
+        large = registry.get_message_for_command(UserCommand('x' * 10000))
+        self.assertTrue(ord(large[2]) & FLAG_COMPRESSED)
+        self.assertTrue(len(large) < 1000)
+        self.assertEqual(registry.get_command_for_message(large).get_data(), 'x' * 10000)
+        
+        # compressed messages survive a trip through the queue
+        invoker.enqueue(UserCommand('x' * 10000))
+        self.assertEqual(registry.get_command_for_message(invoker.read()).get_data(), 'x' * 10000)
+    
+    def test_json_serializer(self):
+        orig_serializer = getattr(settings, 'QUEUE_SERIALIZER', None)
+        settings.QUEUE_SERIALIZER = 'djutils.queue.serializers.JSONSerializer'
+        try:
+            message = registry.get_message_for_command(UserCommand({'key': [1, 2]}))
+        finally:
+            if orig_serializer:
+                settings.QUEUE_SERIALIZER = orig_serializer
+            else:
+                del(settings.QUEUE_SERIALIZER)
+        
+        self.assertEqual(message[3], 'j')
+        self.assertTrue(message.endswith(':{"key":[1,2]}'))
+        
+        # the message can be read regardless of the configured serializer
+        command = registry.get_command_for_message(message)
+        self.assertEqual(command.get_data(), {'key': [1, 2]})
+    
+    def test_custom_serializer(self):
+        orig_serializers = dict(registry._serializers)
+        settings.QUEUE_SERIALIZER = 'djutils.tests.queue.ReprSerializer'
+        try:
+            message = registry.get_message_for_command(UserCommand({'key': [1, 2]}))
+            self.assertEqual(message[3], 'x')
+            
+            # a consumer that has not written any messages yet
+            registry._serializers.clear()
+            command = registry.get_command_for_message(message)
+            self.assertEqual(command.get_data(), {'key': [1, 2]})
+            
+            registry._serializers.clear()
+            self.assertRaises(QueueException, registry.get_serializer_for_code, 'z')
+        finally:
+            del(settings.QUEUE_SERIALIZER)
+            registry._serializers.clear()
+            registry._serializers.update(orig_serializers)
+    
+    def test_priority(self):
+        self.assertEqual(UserCommand.priority, 0)
+        
+        user_command(self.dummy, 'normal@example.com')
+        urgent_user_command(self.dummy, 'urgent@example.com')
+        invoker.enqueue_many([
+            UserCommand((self.dummy, None, 'batch@example.com')),
+            urgent_user_command.command_class(((self.dummy, 'urgent-batch@example.com'), {})),
+        ])
+        invoker.write('low-priority', -1)
+        self.assertEqual(len(invoker.queue), 5)
+        
+        # the urgent messages are executed first, in the order they were
+        # enqueued, then the others
+        invoker.dequeue()
+        self.assertEqual(User.objects.get(username='username').email, 'urgent@example.com')
+        invoker.dequeue()
+        self.assertEqual(User.objects.get(username='username').email, 'urgent-batch@example.com')
+        invoker.dequeue()
+        self.assertEqual(User.objects.get(username='username').email, 'normal@example.com')
+        invoker.dequeue()
+        self.assertEqual(User.objects.get(username='username').email, 'batch@example.com')
+        self.assertEqual(invoker.read(), 'low-priority')
+    
+    def test_schedule(self):
+        now = datetime.datetime.now()
+        
+        user_command.schedule((self.dummy, 'later@example.com'), delay=3600)
+        user_command.schedule((self.dummy, 'due@example.com'), eta=now - datetime.timedelta(seconds=1))
+        self.assertRaises(ValueError, user_command.schedule, (self.dummy, 'x'))
+        
+        # scheduled messages cannot be read until they are promoted
+        self.assertEqual(len(invoker.queue), 0)
+        self.assertEqual(invoker.dequeue(), None)
+        
+        # only the message that is due gets promoted
+        self.assertEqual(invoker.promote(), 1)
+        self.assertEqual(invoker.promote(), 0)
+        self.assertEqual(len(invoker.queue), 1)
+        
+        invoker.dequeue()
+        self.assertEqual(User.objects.get(username='username').email, 'due@example.com')
+        self.assertEqual(invoker.dequeue(), None)
+        
+        # flushing removes scheduled messages too
+        invoker.flush()
+        self.assertEqual(QueueMessage.objects.count(), 0)
+        self.assertEqual(invoker.next_eta(), None)
+        
+        # the consumer only promotes messages once they are due, and checks
+        # less often while nothing is scheduled
+        consumer = TestQueueConsumer()
+        consumer.initialize_options(self.consumer_options)
+        orig_debug = settings.DEBUG
+        settings.DEBUG = True
+        try:
+            del(connection.queries[:])
+            self.assertEqual(consumer.promote_scheduled(), 1)
+            self.assertEqual(consumer.promote_scheduled(), consumer.max_delay)
+            self.assertFalse([q for q in connection.queries if q['sql'].startswith('UPDATE')])
+        finally:
+            settings.DEBUG = orig_debug
+        
+        user_command.schedule((self.dummy, 'soon@example.com'), delay=.5)
+        eta = time.time() + .5
+        self.assertTrue(abs(invoker.next_eta() - eta) < .1)
+        self.assertTrue(0 < consumer.promote_scheduled() <= .5)
+        
+        time.sleep(.5)
+        self.assertEqual(consumer.promote_scheduled(), 0)
+        self.assertEqual(len(invoker.queue), 1)
+        self.assertEqual(invoker.next_eta(), None)
+        self.assertEqual(consumer.promote_scheduled(), 1)
+        invoker.flush()
+        
+        # eager mode runs scheduled commands immediately
+        settings.QUEUE_ALWAYS_EAGER = True
+        user_command.schedule((self.dummy, 'eager@example.com'), delay=3600)
+        self.assertEqual(User.objects.get(username='username').email, 'eager@example.com')
+    
+    def test_results(self):
+        # no results are stored by default
+        self.assertEqual(add_numbers(1, 2), None)
+        self.assertEqual(registry.get_command_for_message(invoker.read()).task_id, None)
+        
+        invoker.result_store = CacheResultStore()
+        try:
+            result = add_numbers(1, 2)
+            self.assertFalse(result.ready())
+            self.assertRaises(ResultTimeout, result.get, 0)
+            
+            invoker.dequeue()
+            self.assertTrue(result.ready())
+            self.assertEqual(result.get(), 3)
+            
+            # results for a batch of commands are fetched together
+            results = add_numbers.map([(i, i) for i in range(5)])
+            for i in range(5):
+                invoker.dequeue()
+            self.assertEqual(get_many(results, 1), [0, 2, 4, 6, 8])
+            
+            # errors are re-raised when the result is fetched
+            result = throw_error()
+            self.assertRaises(BampfException, invoker.dequeue)
+            self.assertRaises(CommandFailed, result.get)
+            
+            # eager mode stores results too
+            settings.QUEUE_ALWAYS_EAGER = True
+            self.assertEqual(add_numbers(2, 3).get(), 5)
+        finally:
+            invoker.result_store = None
+    
     def test_always_eager(self):
         settings.QUEUE_ALWAYS_EAGER = True
         
@@ -139,6 +511,879 @@ class QueueTest(TestCase):
         
         self.assertRaises(BampfException, invoker.dequeue)
     
+    def test_retries(self):
+        del(attempts[:])
+        
+        # each failure enqueues the command again until it succeeds
+        flaky('a')
+        self.assertRaises(BampfException, invoker.dequeue)
+        message = invoker.read()
+        self.assertEqual(registry.get_command_for_message(message).retry_count, 1)
+        
+        invoker.write(message)
+        self.assertRaises(BampfException, invoker.dequeue)
+        invoker.dequeue()
+        self.assertEqual(attempts, ['a', 'a', 'a'])
+        self.assertEqual(len(invoker.queue), 0)
+        self.assertEqual(len(invoker.get_dead_queue()), 0)
+        
+        # retries are delayed, with the delay growing each time
+        broken('b')
+        start = datetime.datetime.now()
+        self.assertRaises(BampfException, invoker.dequeue)
+        self.assertEqual(len(invoker.queue), 0)
+        
+        retry = QueueMessage.objects.get(queue=invoker.queue.name)
+        self.assertTrue(start + datetime.timedelta(seconds=9) < retry.available_at)
+        self.assertTrue(retry.available_at < start + datetime.timedelta(seconds=11))
+        
+        retry.available_at = datetime.datetime.now()
+        retry.save()
+        invoker.promote()
+        self.assertRaises(BampfException, invoker.dequeue)
+        
+        retry = QueueMessage.objects.get(queue=invoker.queue.name)
+        self.assertTrue(start + datetime.timedelta(seconds=29) < retry.available_at)
+        
+        # once the retries are used up the message is parked
+        retry.available_at = datetime.datetime.now()
+        retry.save()
+        invoker.promote()
+        self.assertRaises(BampfException, invoker.dequeue)
+        self.assertEqual(QueueMessage.objects.filter(queue=invoker.queue.name).count(), 0)
+        
+        dead_queue = invoker.get_dead_queue()
+        self.assertEqual(dead_queue.name, invoker.queue.name + '.dead')
+        self.assertEqual(len(dead_queue), 1)
+        
+        command = registry.get_command_for_message(dead_queue.peek(1)[0])
+        self.assertEqual(command.retry_count, 2)
+        self.assertEqual(command.get_data(), (('b',), {}))
+        
+        # commands without retries are parked straight away
+        throw_error()
+        self.assertRaises(BampfException, invoker.dequeue)
+        self.assertEqual(len(dead_queue), 2)
+        dead_queue.flush()
+    
+    def test_dead_letter_replay(self):
+        dead_queue = invoker.get_dead_queue()
+        
+        del(attempts[:])
+        command = flaky.command_class((('c',), {}))
+        command.retry_count = 2
+        for i in range(3):
+            invoker.retry(registry.get_message_for_command(command))
+        invoker.retry('djutils.tests.queue.Missing:data')
+        self.assertEqual(len(dead_queue), 4)
+        
+        # messages stay in the dead-letter queue until they are written back
+        def broken(*args):
+            raise DatabaseError('connection lost')
+        invoker.write = broken
+        try:
+            self.assertRaises(DatabaseError, invoker.replay)
+        finally:
+            del(invoker.write)
+        self.assertEqual(len(dead_queue), 4)
+        self.assertEqual(len(invoker.queue), 0)
+        
+        # replaying moves the messages back with their retries reset
+        self.assertEqual(invoker.replay(2), 2)
+        self.assertEqual(len(dead_queue), 2)
+        self.assertEqual(len(invoker.queue), 2)
+        
+        self.assertEqual(invoker.replay(), 2)
+        self.assertEqual(len(dead_queue), 0)
+        self.assertEqual(len(invoker.queue), 4)
+        
+        message = invoker.read()
+        self.assertEqual(registry.get_command_for_message(message).retry_count, 0)
+        invoker.flush()
+        
+        # the management command replays every message unless given a limit
+        for i in range(25):
+            invoker.retry(registry.get_message_for_command(command))
+        
+        # the command autodiscovers the commands of every installed app
+        orig_registry = dict(registry._registry)
+        orig_periodic = list(registry._periodic_commands)
+        try:
+            output = StringIO()
+            call_command('queue_dead_letters', replay=True, limit=5, stdout=output)
+            self.assertEqual(output.getvalue(), 'Replayed 5 messages\n')
+            self.assertEqual(len(dead_queue), 20)
+            
+            output = StringIO()
+            call_command('queue_dead_letters', stdout=output)
+            self.assertEqual(len(output.getvalue().splitlines()), 21)
+            
+            output = StringIO()
+            call_command('queue_dead_letters', replay=True, stdout=output)
+            self.assertEqual(output.getvalue(), 'Replayed 20 messages\n')
+            self.assertEqual(len(dead_queue), 0)
+            self.assertEqual(len(invoker.queue), 25)
+        finally:
+            registry._registry.clear()
+            registry._registry.update(orig_registry)
+            registry._periodic_commands[:] = orig_periodic
+        invoker.flush()
+        
+        # the consumer retries failed messages
+        consumer = TestQueueConsumer()
+        consumer.initialize_options(self.consumer_options)
+        
+        flaky('d')
+        consumer.execute_message(invoker.read())
+        self.assertEqual(len(invoker.queue), 1)
+        consumer.execute_message(invoker.read())
+        consumer.execute_message(invoker.read())
+        self.assertEqual(attempts, ['d', 'd', 'd'])
+        
+        throw_error()
+        consumer.execute_message(invoker.read())
+        self.assertEqual(len(invoker.queue), 0)
+        self.assertEqual(len(dead_queue), 1)
+        dead_queue.flush()
+    
+    def test_unique_commands(self):
+        del(rebuilt[:])
+        
+        # a lock must be configured
+        self.assertRaises(ImproperlyConfigured, rebuild, 1)
+        
+        invoker.unique_lock = CacheLock()
+        try:
+            # identical calls are dropped while one is waiting in the queue
+            rebuild(1)
+            rebuild(1, force=True)
+            rebuild(2)
+            rebuild.map([(1,), (2,), (3,)])
+            self.assertEqual(len(invoker.queue), 3)
+            
+            # the key is released when the command starts executing
+            invoker.dequeue()
+            rebuild(1)
+            self.assertEqual(len(invoker.queue), 3)
+            
+            while invoker.dequeue():
+                pass
+            self.assertEqual(rebuilt, [1, 2, 3, 1])
+            
+            # retries can be enqueued even though the key is released
+            command = rebuild.command_class(((4,), {}))
+            invoker.enqueue(command)
+            self.assertTrue(command.unique_key)
+            message = invoker.read()
+            invoker.execute(registry.get_command_for_message(message))
+            self.assertTrue(invoker.retry(message))
+            rebuild(4)
+            self.assertEqual(len(invoker.queue), 2)
+            self.assertEqual(registry.get_command_for_message(invoker.read()).unique_key, None)
+            
+            # debounced commands wait before they can be read, coalescing
+            # identical calls made in the meantime
+            invoker.flush()
+            start = datetime.datetime.now()
+            debounced('a')
+            debounced('a')
+            debounced('b')
+            self.assertEqual(len(invoker.queue), 0)
+            
+            messages = QueueMessage.objects.filter(queue=invoker.queue.name)
+            self.assertEqual(messages.count(), 2)
+            for message in messages:
+                self.assertTrue(message.available_at > start + datetime.timedelta(seconds=4))
+            
+            # keys are released when the message cannot be written, so the
+            # call can be made again
+            invoker.flush()
+            def broken(*args):
+                raise QueueException('write failed')
+            
+            calls = (
+                ('write', lambda: rebuild(10)),
+                ('write_many', lambda: rebuild.map([(11,), (12,)])),
+                ('schedule', lambda: rebuild.schedule((13,), delay=60)),
+            )
+            for method, call in calls:
+                setattr(invoker.queue, method, broken)
+                try:
+                    self.assertRaises(QueueException, call)
+                finally:
+                    delattr(invoker.queue, method)
+                call()
+            self.assertEqual(len(invoker.queue), 3)
+            self.assertEqual(QueueMessage.objects.filter(queue=invoker.queue.name).count(), 4)
+            
+            # eager mode does not check for duplicates
+            settings.QUEUE_ALWAYS_EAGER = True
+            del(rebuilt[:])
+            debounced('a')
+            self.assertEqual(rebuilt, ['a'])
+        finally:
+            invoker.unique_lock = None
+    
+    def test_batched_commands(self):
+        del(batches[:])
+        
+        # outside the consumer each call is executed as a batch of one
+        self.assertRaises(TypeError, index_documents, 1, foo='bar')
+        index_documents(1)
+        invoker.dequeue()
+        self.assertEqual(batches, [[(1,)]])
+        del(batches[:])
+        
+        consumer = TestQueueConsumer()
+        consumer.initialize_options(self.consumer_options)
+        
+        # calls are buffered until the batch fills up
+        index_documents.map([(i,) for i in range(5)])
+        user_command(self.dummy, 'unbatched@example.com')
+        for i in range(6):
+            consumer.execute_message(invoker.read())
+        self.assertEqual(batches, [[(0,), (1,), (2,)]])
+        self.assertEqual(User.objects.get(username='username').email, 'unbatched@example.com')
+        
+        # or until the oldest call has waited long enough
+        self.assertEqual(consumer.pop_batches(), [])
+        time.sleep(.1)
+        for batch in consumer.pop_batches():
+            consumer.execute_batch(batch)
+        self.assertEqual(batches, [[(0,), (1,), (2,)], [(3,), (4,)]])
+        
+        # each call in a failed batch is retried
+        index_documents.map([('good',), ('bad',)])
+        for i in range(2):
+            consumer.execute_message(invoker.read())
+        for batch in consumer.pop_batches(expired_only=False):
+            consumer.execute_batch(batch)
+        self.assertEqual(len(invoker.queue), 2)
+        
+        # results are stored for every call in the batch
+        invoker.flush()
+        invoker.result_store = CacheResultStore()
+        try:
+            results = index_documents.map([('x',), ('y',), ('z',)])
+            for i in range(3):
+                consumer.execute_message(invoker.read())
+            self.assertEqual(get_many(results, 1), [3, 3, 3])
+        finally:
+            invoker.result_store = None
+    
+    def test_token_bucket(self):
+        self.assertEqual(parse_rate_limit('100/m'), (100, 60))
+        self.assertEqual(parse_rate_limit('5/h'), (5, 3600))
+        for rate_limit in ('100', '0/s', '10/d', 'x/s'):
+            self.assertRaises(ValueError, parse_rate_limit, rate_limit)
+        self.assertRaises(ValueError, queue_command, rate_limit='100/d')
+        
+        bucket = TokenBucket.from_rate_limit('2/s')
+        now = bucket.updated
+        
+        # the bucket starts full
+        self.assertEqual(bucket.reserve(now), 0)
+        self.assertEqual(bucket.reserve(now), 0)
+        
+        # reservations beyond that are spaced out at the rate
+        self.assertEqual(bucket.reserve(now), .5)
+        self.assertEqual(bucket.reserve(now), 1)
+        
+        # and paid off as the bucket refills
+        self.assertEqual(bucket.reserve(now + 1.5), 0)
+        self.assertEqual(bucket.reserve(now + 1.5), .5)
+        
+        # but it never holds more than its capacity
+        self.assertEqual(bucket.reserve(now + 100), 0)
+        self.assertEqual(bucket.reserve(now + 100), 0)
+        self.assertEqual(bucket.reserve(now + 100), .5)
+    
+    def test_rate_limit(self):
+        del(rebuilt[:])
+        
+        consumer = TestQueueConsumer()
+        consumer.initialize_options(self.consumer_options)
+        
+        limited.map([(i,) for i in range(4)])
+        user_command(self.dummy, 'unlimited@example.com')
+        start = datetime.datetime.now()
+        for i in range(5):
+            consumer.execute_message(invoker.read())
+        
+        # commands over the limit are scheduled for when a call is available,
+        # while other commands are unaffected
+        self.assertEqual(rebuilt, [0, 1])
+        self.assertEqual(User.objects.get(username='username').email, 'unlimited@example.com')
+        self.assertEqual(len(invoker.queue), 0)
+        
+        deferred = QueueMessage.objects.filter(queue=invoker.queue.name).order_by('available_at')
+        self.assertEqual(deferred.count(), 2)
+        self.assertTrue(start + datetime.timedelta(seconds=29) < deferred[0].available_at)
+        self.assertTrue(start + datetime.timedelta(seconds=59) < deferred[1].available_at)
+        
+        # deferred commands have a call reserved, so they run once they are due
+        deferred.update(available_at=datetime.datetime.now())
+        invoker.promote()
+        for i in range(2):
+            consumer.execute_message(invoker.read())
+        self.assertEqual(rebuilt, [0, 1, 2, 3])
+    
+    def test_histogram(self):
+        histogram = Histogram()
+        self.assertEqual(histogram.percentile(50), 0)
+        
+        for i in range(1, 101):
+            histogram.add(i / 100.0)
+        
+        # percentiles are accurate to within the growth factor of the buckets
+        for p in (50, 95, 99):
+            value = histogram.percentile(p)
+            self.assertTrue(p / 100.0 <= value <= p / 100.0 * histogram.factor)
+        self.assertEqual(histogram.percentile(100), 1.0)
+        self.assertEqual(histogram.summary()['max'], 1.0)
+        
+        # values below the smallest bucket are counted in the first one
+        histogram = Histogram()
+        histogram.add(0)
+        self.assertEqual(histogram.percentile(50), 0)
+        
+        # subtracting an earlier copy leaves the values added since
+        earlier = Histogram.from_dict(histogram.to_dict())
+        histogram.add(.5)
+        histogram.subtract(earlier)
+        self.assertEqual(histogram.count, 1)
+        self.assertEqual(histogram.percentile(50), .5)
+    
+    def test_stats(self):
+        stats.reset()
+        
+        consumer = TestQueueConsumer()
+        consumer.initialize_options(self.consumer_options)
+        
+        # messages record the time they were enqueued
+        add_numbers(1, 2)
+        add_numbers(3, 4)
+        throw_error()
+        message = invoker.read()
+        command = registry.get_command_for_message(message)
+        self.assertTrue(abs(command.enqueued_at / 1000.0 - time.time()) < 5)
+        
+        consumer.execute_message(message)
+        consumer.execute_message(invoker.read())
+        consumer.execute_message(invoker.read())
+        
+        snapshot = stats.snapshot()
+        add_stats = snapshot['commands']['djutils.tests.queue.queuecmd_add_numbers']
+        self.assertEqual(add_stats['executed'], 2)
+        self.assertEqual(add_stats['failed'], 0)
+        self.assertTrue(0 <= add_stats['wait']['p95'] < 5)
+        self.assertTrue(0 <= add_stats['run']['max'] < 5)
+        
+        error_stats = snapshot['commands']['djutils.tests.queue.queuecmd_throw_error']
+        self.assertEqual(error_stats['executed'], 0)
+        self.assertEqual(error_stats['failed'], 1)
+        
+        # stats published by the consumer can be read by other processes
+        cache.delete(stats.get_index_key(invoker.queue.name))
+        stats.publish(invoker.queue.name)
+        stats.reset()
+        self.assertEqual(get_stats()['commands'], snapshot['commands'])
+        
+        throughput = QueueThroughput()
+        self.assertEqual(throughput.get_data(), {'executed': 2, 'failed': 1})
+        
+        # every consumer publishes its own stats, which are added up
+        other = QueueStats()
+        other.get_consumer_id = lambda: 'otherhost:1'
+        other.record('djutils.tests.queue.queuecmd_add_numbers', .5, 2.0)
+        other.publish(invoker.queue.name)
+        
+        merged = get_stats()
+        self.assertEqual(sorted(merged['consumers']), sorted([stats.get_consumer_id(), 'otherhost:1']))
+        self.assertEqual(merged['consumers']['otherhost:1']['executed'], 1)
+        
+        add_stats = merged['commands']['djutils.tests.queue.queuecmd_add_numbers']
+        self.assertEqual(add_stats['executed'], 3)
+        self.assertEqual(add_stats['run']['max'], 2.0)
+        self.assertTrue(add_stats['wait']['p50'] < .5)
+        self.assertTrue(.45 < add_stats['wait']['p99'] <= .5)
+        
+        # the throughput panel adds up what each consumer did since it was
+        # last updated
+        for i in range(5):
+            other.record('djutils.tests.queue.queuecmd_add_numbers', 0, 0)
+        other.record('djutils.tests.queue.queuecmd_add_numbers', 0, 0, success=False)
+        other.publish(invoker.queue.name)
+        self.assertEqual(throughput.get_data(), {'executed': 6, 'failed': 1})
+        self.assertEqual(throughput.get_data(), {'executed': 0, 'failed': 0})
+        
+        # a consumer's counters start over when it is restarted, as the
+        # stats of this process were
+        for i in range(5):
+            stats.record('djutils.tests.queue.queuecmd_add_numbers', 0, 0)
+            other.record('djutils.tests.queue.queuecmd_add_numbers', 0, 0)
+        stats.publish(invoker.queue.name)
+        other.publish(invoker.queue.name)
+        self.assertEqual(throughput.get_data(), {'executed': 10, 'failed': 0})
+        
+        # the latency panel reports the times of the commands executed since
+        # it was last updated, rather than since the consumers started
+        latency = QueueLatency()
+        self.assertEqual(latency.get_data(), {'wait_p95': 500, 'run_p95': 2000})
+        other.record('djutils.tests.queue.queuecmd_add_numbers', .1, 1.0)
+        other.publish(invoker.queue.name)
+        data = latency.get_data()
+        self.assertTrue(100 <= data['wait_p95'] <= 110)
+        self.assertTrue(1000 <= data['run_p95'] <= 1100)
+        self.assertEqual(latency.get_data(), {'wait_p95': 0, 'run_p95': 0})
+        
+        other.reset()
+        other.record('djutils.tests.queue.queuecmd_add_numbers', 0, .3)
+        other.publish(invoker.queue.name)
+        self.assertEqual(latency.get_data(), {'wait_p95': 0, 'run_p95': 300})
+        
+        cache.delete(stats.get_index_key(invoker.queue.name))
+        stats.reset()
+    
+    def test_memory_queue(self):
+        queue = MemoryQueue('test-memory', None)
+        
+        queue.write('a')
+        queue.write_many(['b', 'c'])
+        queue.write('urgent', priority=10)
+        queue.write('later', priority=-1)
+        self.assertEqual(len(queue), 5)
+        
+        # highest priority first, then in the order they were written
+        self.assertEqual(queue.peek(2), ['urgent', 'a'])
+        self.assertEqual(queue.read(), 'urgent')
+        self.assertEqual(queue.read_many(3), ['a', 'b', 'c'])
+        self.assertEqual(queue.read_many(3), ['later'])
+        self.assertEqual(queue.read(), None)
+        
+        # removing a message takes the copy that would be read first
+        queue.write_many(['x', 'y', 'x'])
+        queue.write('y', 5)
+        self.assertTrue(queue.remove('y'))
+        self.assertFalse(queue.remove('z'))
+        self.assertTrue(queue.remove('x'))
+        self.assertEqual(queue.read_many(5), ['y', 'x'])
+        
+        # scheduled messages are readable once they are due and promoted
+        now = datetime.datetime.now()
+        start = time.time()
+        self.assertEqual(queue.next_eta(), None)
+        queue.schedule('due', now - datetime.timedelta(seconds=1))
+        queue.schedule('future', now + datetime.timedelta(seconds=60))
+        self.assertTrue(abs(queue.next_eta() - start + 1) < .1)
+        self.assertEqual(queue.read(), None)
+        self.assertEqual(queue.promote(), 1)
+        self.assertEqual(queue.read_many(2), ['due'])
+        self.assertTrue(abs(queue.next_eta() - start - 60) < .1)
+        
+        queue.write('a')
+        queue.flush()
+        self.assertEqual(len(queue), 0)
+        self.assertEqual(queue.promote(), 0)
+        self.assertEqual(queue.next_eta(), None)
+    
+    def test_sqlite_queue(self):
+        self.assertRaises(ImproperlyConfigured, SqliteQueue, 'test-sqlite', '')
+        
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        
+        try:
+            queue = SqliteQueue('test-sqlite', filename)
+            self.assertTrue(queue.reliable)
+            
+            queue.write('a')
+            queue.write_many(['b', 'c'])
+            queue.write('urgent', priority=10)
+            self.assertEqual(len(queue), 4)
+            self.assertEqual(queue.peek(2), ['urgent', 'a'])
+            
+            # messages are durable, and queues with other names are separate
+            self.assertEqual(len(SqliteQueue('test-sqlite', filename)), 4)
+            self.assertEqual(len(SqliteQueue('test-other', filename)), 0)
+            
+            self.assertEqual(queue.read(), 'urgent')
+            self.assertEqual(queue.read_many(2), ['a', 'b'])
+            self.assertEqual(len(queue), 1)
+            
+            # acknowledged messages are deleted, others are made available
+            # again once the visibility timeout passes
+            queue.ack('urgent')
+            queue.ack('a')
+            self.assertEqual(queue.reap(), 0)
+            queue.visibility_timeout = -1
+            self.assertEqual(queue.reap(), 1)
+            self.assertEqual(queue.read_many(3), ['b', 'c'])
+            queue.ack('b')
+            queue.ack('c')
+            self.assertEqual(queue.reap(), 0)
+            
+            # a message that was reaped and read again is acknowledged by the
+            # newest read, leaving nothing behind for later copies
+            queue.write('x')
+            self.assertEqual(queue.read(), 'x')
+            self.assertEqual(queue.reap(), 1)
+            self.assertEqual(queue.read(), 'x')
+            queue.ack('x')
+            queue.write('x')
+            self.assertEqual(queue.read(), 'x')
+            queue.ack('x')
+            self.assertEqual(queue.reap(), 0)
+            self.assertEqual(queue.execute('SELECT COUNT(*) FROM messages').fetchone()[0], 0)
+            
+            # removing a message takes the copy that would be read first
+            queue.write_many(['x', 'y', 'x'])
+            queue.write('y', 5)
+            self.assertTrue(queue.remove('y'))
+            self.assertFalse(queue.remove('z'))
+            self.assertTrue(queue.remove('x'))
+            self.assertEqual(queue.read_many(5), ['y', 'x'])
+            queue.ack('y')
+            queue.ack('x')
+            
+            # scheduled messages are readable once they are due and promoted
+            now = datetime.datetime.now()
+            start = time.time()
+            self.assertEqual(queue.next_eta(), None)
+            queue.schedule('due', now - datetime.timedelta(seconds=1))
+            queue.schedule('future', now + datetime.timedelta(seconds=60))
+            self.assertTrue(abs(queue.next_eta() - start + 1) < .1)
+            self.assertEqual(queue.read(), None)
+            self.assertEqual(queue.promote(), 1)
+            self.assertEqual(queue.read_many(2), ['due'])
+            self.assertTrue(abs(queue.next_eta() - start - 60) < .1)
+            
+            # binary messages are stored as-is
+            queue.write('\xd7\x00\xff')
+            self.assertEqual(queue.read(), '\xd7\x00\xff')
+            
+            queue.flush()
+            self.assertEqual(len(queue), 0)
+            self.assertEqual(queue.promote(), 0)
+        finally:
+            os.unlink(filename)
+    
+    def test_sqlite_queue_threads(self):
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        
+        try:
+            queue = SqliteQueue('test-sqlite', filename)
+            queue.write_many([str(i) for i in range(200)])
+            
+            read = []
+            def reader():
+                messages = queue.read_many(7)
+                while messages:
+                    read.extend(messages)
+                    messages = queue.read_many(7)
+            
+            threads = [threading.Thread(target=reader) for i in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            
+            # every message was read exactly once
+            self.assertEqual(sorted(read, key=int), [str(i) for i in range(200)])
+        finally:
+            os.unlink(filename)
+    
+    def test_redis_connection(self):
+        options = parse_connection('')
+        self.assertEqual((options['host'], options['port'], options['db']), ('localhost', 6379, 0))
+        self.assertEqual((options['timeout'], options['connect_timeout']), (30, 5))
+        self.assertEqual(options['max_connections'], None)
+        
+        options = parse_connection('10.0.0.75:6380:2')
+        self.assertEqual((options['host'], options['port'], options['db']), ('10.0.0.75', 6380, 2))
+        
+        options = parse_connection('redis://:secret@10.0.0.75:6380/3?max_connections=20&timeout=2.5')
+        self.assertEqual((options['host'], options['port'], options['db']), ('10.0.0.75', 6380, 3))
+        self.assertEqual(options['password'], 'secret')
+        self.assertEqual(options['max_connections'], 20)
+        self.assertEqual(options['timeout'], 2.5)
+        self.assertEqual(options['path'], None)
+        
+        options = parse_connection('unix:///var/run/redis.sock?db=1&connect_timeout=1')
+        self.assertEqual(options['path'], '/var/run/redis.sock')
+        self.assertEqual(options['db'], 1)
+        self.assertEqual(options['connect_timeout'], 1)
+        
+        for spec in ('localhost:6379', 'http://localhost', 'unix://', 'redis://localhost?size=1', 'redis://localhost/db'):
+            self.assertRaises(ImproperlyConfigured, parse_connection, spec)
+        
+        # clients with the same connection share a pool
+        pool = get_connection_pool('redis://localhost:6390/1?max_connections=4&pool_timeout=1')
+        self.assertTrue(pool is get_connection_pool('redis://localhost:6390/1?max_connections=4&pool_timeout=1'))
+        self.assertEqual(pool.max_connections, 4)
+        self.assertEqual(pool.timeout, 1)
+        self.assertEqual(pool.connection_kwargs['port'], 6390)
+        self.assertEqual(pool.connection_kwargs['socket_timeout'], 30)
+        
+        pool = get_connection_pool('unix:///tmp/redis-test.sock?timeout=3')
+        self.assertEqual(pool.connection_kwargs['path'], '/tmp/redis-test.sock')
+        self.assertEqual(pool.connection_kwargs['socket_timeout'], 3)
+        self.assertTrue(get_connection_pool(None) is get_connection_pool('localhost:6379:0'))
+    
+    def test_lazy_invoker(self):
+        orig_queue_class = settings.QUEUE_CLASS
+        settings.QUEUE_CLASS = 'djutils.tests.queue.MissingQueue'
+        try:
+            # the queue class is not loaded until the invoker is used
+            lazy_invoker = LazyInvoker()
+            self.assertRaises(AttributeError, getattr, lazy_invoker, 'queue')
+            
+            settings.QUEUE_CLASS = 'djutils.queue.backends.memory.MemoryQueue'
+            self.assertTrue(isinstance(lazy_invoker.queue, MemoryQueue))
+            self.assertEqual(lazy_invoker.queue.name, 'testqueue')
+            
+            # once loaded the same instance is always used
+            queue = lazy_invoker.queue
+            lazy_invoker.write('a')
+            self.assertEqual(lazy_invoker.read(), 'a')
+            self.assertTrue(lazy_invoker.queue is queue)
+        finally:
+            settings.QUEUE_CLASS = orig_queue_class
+        
+        # the global queue refers to the global invoker's queue
+        self.assertEqual(len(queue_module.queue), len(invoker.queue))
+        
+        # the old module-level names still work
+        from djutils.queue.queue import Queue, queue_name
+        self.assertEqual(queue_name, 'testqueue')
+        self.assertEqual('%s.dead' % queue_name, 'testqueue.dead')
+        self.assertEqual(queue_name + '.dead', 'testqueue.dead')
+        old_queue = Queue(queue_name, getattr(settings, 'QUEUE_CONNECTION', None))
+        self.assertTrue(isinstance(old_queue, queue_module.get_queue_class()))
+        self.assertEqual(old_queue.name, 'testqueue')
+    
+    def test_startup(self):
+        # importing the queue succeeds in a fresh interpreter that has no
+        # settings configured, so nothing is read or connected to at import
+        result = measure_startup(1)
+        self.assertEqual(result['benchmark'], 'startup')
+        self.assertEqual(result['backend'], 'djutils.queue.backends.database.DatabaseQueue')
+        self.assertTrue(result['seconds'] > 0)
+    
+    def test_benchmark(self):
+        self.assertEqual(percentile([], 50), 0)
+        self.assertEqual(percentile(range(1, 101), 95), 95)
+        self.assertEqual(percentile(range(1, 101), 100), 100)
+        
+        stats.reset()
+        cache.delete(stats.get_index_key(invoker.queue.name))
+        
+        benchmark = QueueBenchmark(MemoryQueue, messages=20)
+        results = benchmark.run([10], [2])
+        
+        # the benchmark's consumer neither records nor publishes its stats
+        # where those of the real consumers go
+        self.assertEqual(stats.snapshot()['commands'], {})
+        self.assertEqual(cache.get(stats.get_index_key(invoker.queue.name)), None)
+        
+        self.assertEqual(
+            [result['benchmark'] for result in results],
+            ['enqueue', 'enqueue_many', 'dequeue', 'dequeue_many', 'consume'],
+        )
+        for result in results:
+            self.assertEqual(result['backend'], 'djutils.queue.backends.memory.MemoryQueue')
+            self.assertEqual(result['payload'], 10)
+            self.assertTrue(result['ops_per_sec'] > 0)
+        
+        consume = results[-1]
+        self.assertEqual(consume['threads'], 2)
+        self.assertEqual(consume['executed'], 20)
+        self.assertTrue(0 <= consume['latency_p50'] <= consume['latency_max'])
+        
+        # the global queue is left as it was
+        self.assertFalse(isinstance(invoker.queue, MemoryQueue))
+        
+        previous = {'version': 1, 'results': [dict(result, ops_per_sec=result['ops_per_sec'] / 2) for result in results]}
+        comparison = compare_results(previous, {'version': 1, 'results': results})
+        self.assertEqual(len(comparison), 5)
+        for result, old, change in comparison:
+            self.assertAlmostEqual(change, 100)
+        
+        self.assertEqual(compare_results({'version': 0, 'results': results}, {'version': 1, 'results': results}), [])
+    
+    def test_weighted_round_robin(self):
+        self.assertEqual(parse_queues('images:1,email:5, default'), [('images', 1), ('email', 5), ('default', 1)])
+        for value in ('images:0', 'images:x', 'images,', ':2', 'email,email:2', 'images,dead:2', 'e.mail'):
+            self.assertRaises(ValueError, parse_queues, value)
+        
+        lanes = WeightedRoundRobin(parse_queues('images:1,email:5,default:2'))
+        picks = [lanes.next() for i in range(16)]
+        self.assertEqual(picks.count('images'), 2)
+        self.assertEqual(picks.count('email'), 10)
+        self.assertEqual(picks.count('default'), 4)
+        
+        # picks of the heaviest queue are interleaved with the others
+        self.assertEqual(picks[:8], ['email', 'default', 'email', 'images', 'email', 'email', 'default', 'email'])
+        
+        # the next queue in turn is followed by the others, heaviest first
+        lanes = WeightedRoundRobin(parse_queues('images:1,email:5,default:2'))
+        self.assertEqual(lanes.order(), ['email', 'default', 'images'])
+        self.assertEqual(lanes.order(), ['default', 'email', 'images'])
+    
+    def test_named_queues(self):
+        del(rebuilt[:])
+        
+        resize(1)
+        user_command(self.dummy, 'default@example.com')
+        images = invoker.get_queue('images')
+        self.assertEqual(images.name, invoker.queue.name + '.images')
+        self.assertTrue(invoker.get_queue('images') is images)
+        self.assertTrue(invoker.get_queue('default') is invoker.queue)
+        self.assertEqual(len(images), 1)
+        self.assertEqual(len(invoker.queue), 1)
+        
+        # the depth panel counts every queue commands are routed to
+        self.assertTrue('images' in registry.get_queue_names())
+        depth = QueueDepth().get_data()
+        self.assertEqual((depth['messages'], depth[images.name], depth['dead']), (1, 1, 0))
+        
+        # the dead-letter queue cannot be used as a named queue
+        self.assertRaises(ValueError, invoker.get_queue, 'dead')
+        self.assertRaises(ValueError, queue_command, queue='dead')
+        for name in ('e mail', 'images.large', 'a:b', u'caf\xe9'):
+            self.assertRaises(ValueError, invoker.get_queue, name)
+        self.assertEqual(invoker.get_queue('Large_images-2').name, invoker.queue.name + '.Large_images-2')
+        
+        # map() and schedule() write to the command's queue too
+        resize.map([(2,), (3,)])
+        resize.schedule((4,), eta=datetime.datetime.now() - datetime.timedelta(seconds=1))
+        self.assertEqual(len(images), 3)
+        self.assertEqual(invoker.promote(), 1)
+        self.assertEqual(len(images), 4)
+        
+        # a consumer reading the default queue only leaves the images alone
+        consumer = TestQueueConsumer()
+        consumer.initialize_options(self.consumer_options)
+        self.assertEqual(consumer.queues, [('default', 1)])
+        consumer.process_message()
+        consumer.process_message()
+        self.assertEqual(User.objects.get(username='username').email, 'default@example.com')
+        self.assertEqual(rebuilt, [])
+        
+        self.consumer_options['queues'] = 'images:2,default'
+        consumer = TestQueueConsumer()
+        consumer.initialize_options(self.consumer_options)
+        for i in range(4):
+            consumer.process_message()
+        self.assertEqual(rebuilt, [1, 2, 3, 4])
+        
+        # failed commands are retried in their own queue
+        del(rebuilt[:])
+        resize('bad')
+        consumer.execute_message(invoker.read('images'), 'images')
+        self.assertEqual(len(images), 1)
+        self.assertEqual(len(invoker.queue), 0)
+        
+        # the first of the queues with messages waiting is read
+        name, messages = invoker.read_first(5, ['default', 'images'])
+        self.assertEqual((name, len(messages)), ('images', 1))
+        self.assertEqual(invoker.read_first(5, ['default', 'images']), (None, []))
+        
+        self.consumer_options['queues'] = 'images:0'
+        self.assertRaises(CommandError, consumer.initialize_options, self.consumer_options)
+        
+        invoker.flush()
+        self.assertEqual(len(images), 0)
+    
+    def test_socket_notifier(self):
+        orig_connection = getattr(settings, 'QUEUE_NOTIFIER_CONNECTION', None)
+        settings.QUEUE_NOTIFIER_CONNECTION = tempfile.mkdtemp()
+        
+        notifier = SocketNotifier()
+        try:
+            # nothing is sent before a consumer listens
+            notifier.notify('a')
+            start = time.time()
+            self.assertFalse(notifier.wait(['a', 'b'], .05))
+            self.assertTrue(time.time() - start >= .05)
+            
+            # a burst of notifications wakes the consumer once
+            for i in range(3):
+                notifier.notify('b')
+            start = time.time()
+            self.assertTrue(notifier.wait(['a', 'b'], 5))
+            self.assertTrue(time.time() - start < 1)
+            self.assertFalse(notifier.wait(['a', 'b'], .05))
+            
+            # other queues do not wake it
+            notifier.notify('c')
+            self.assertFalse(notifier.wait(['a', 'b'], .05))
+            
+            # sockets left behind by a consumer that died are cleaned up
+            other = SocketNotifier()
+            other.listen(['a'])
+            sock, path = other._sockets['a']
+            sock.close()
+            notifier.notify('a')
+            self.assertFalse(os.path.exists(path))
+            self.assertTrue(notifier.wait(['a'], 5))
+        finally:
+            notifier.close()
+            self.assertEqual(os.listdir(settings.QUEUE_NOTIFIER_CONNECTION), [])
+            os.rmdir(settings.QUEUE_NOTIFIER_CONNECTION)
+            settings.QUEUE_NOTIFIER_CONNECTION = orig_connection
+    
+    def test_notify(self):
+        notifier = RecordingNotifier()
+        test_invoker = Invoker(MemoryQueue('notify', None), notifier=notifier)
+        
+        # writing, and promoting scheduled messages, notifies the queue
+        test_invoker.enqueue(add_numbers.command_class(((1, 2), {})))
+        test_invoker.enqueue_many([
+            add_numbers.command_class(((1, 2), {})),
+            resize.command_class((('a',), {})),
+            resize.command_class((('b',), {})),
+        ])
+        test_invoker.schedule(add_numbers.command_class(((1, 2), {})), datetime.datetime.now())
+        self.assertEqual(notifier.notified, ['notify', 'notify', 'notify.images', 'notify:scheduled'])
+        
+        test_invoker.promote()
+        self.assertEqual(notifier.notified[4:], ['notify'])
+        test_invoker.promote()
+        self.assertEqual(len(notifier.notified), 5)
+        
+        # without a notifier the invoker sleeps
+        start = time.time()
+        self.assertFalse(Invoker(MemoryQueue('notify', None)).wait(.05))
+        self.assertTrue(time.time() - start >= .05)
+    
+    def test_consumer_notification(self):
+        consumer = TestQueueConsumer()
+        consumer.initialize_options(self.consumer_options)
+        consumer.delay = 5
+        
+        orig_connection = getattr(settings, 'QUEUE_NOTIFIER_CONNECTION', None)
+        settings.QUEUE_NOTIFIER_CONNECTION = tempfile.mkdtemp()
+        invoker.notifier = SocketNotifier()
+        try:
+            # the consumer is waiting on an empty queue when a message is
+            # written, and is woken up long before its delay is up
+            invoker.notifier.listen([invoker.queue.name])
+            timer = threading.Timer(.1, invoker.notifier.notify, (invoker.queue.name,))
+            timer.start()
+            
+            start = time.time()
+            consumer.process_message()
+            self.assertTrue(time.time() - start < 2)
+            self.assertEqual(consumer.delay, consumer.default_delay)
+            timer.join()
+        finally:
+            invoker.notifier.close()
+            invoker.notifier = None
+            os.rmdir(settings.QUEUE_NOTIFIER_CONNECTION)
+            settings.QUEUE_NOTIFIER_CONNECTION = orig_connection
+    
     def test_crontab_month(self):
         # validates the following months, 1, 4, 7, 8, 9
         valids = [1, 4, 7, 8, 9]
@@ -219,6 +1464,107 @@ class QueueTest(TestCase):
         # fails validation on minute
         self.assertFalse(validate(datetime.datetime(2011, 1, 1, 4, 6)))
     
+    def test_crontab_seconds(self):
+        validate = crontab(minute='*/15', second='*/20')
+        self.assertTrue(validate(datetime.datetime(2011, 1, 1, 1, 15, 40)))
+        self.assertFalse(validate(datetime.datetime(2011, 1, 1, 1, 15, 30)))
+        
+        # without seconds any datetime within a matching minute is valid
+        self.assertTrue(crontab(minute='*/15')(datetime.datetime(2011, 1, 1, 1, 15, 30)))
+        
+        self.assertRaises(ValidationError, crontab, second='60')
+    
+    def test_crontab_next_fire_after(self):
+        schedule = crontab(minute='*/15')
+        self.assertEqual(schedule.next_fire_after(datetime.datetime(2011, 1, 1, 1, 7, 30)),
+            datetime.datetime(2011, 1, 1, 1, 15))
+        self.assertEqual(schedule.next_fire_after(datetime.datetime(2011, 1, 1, 1, 15)),
+            datetime.datetime(2011, 1, 1, 1, 30))
+        self.assertEqual(schedule.next_fire_after(datetime.datetime(2011, 12, 31, 23, 50)),
+            datetime.datetime(2012, 1, 1, 0, 0))
+        
+        schedule = crontab(second='*/10')
+        self.assertEqual(schedule.next_fire_after(datetime.datetime(2011, 1, 1, 1, 7, 55, 500)),
+            datetime.datetime(2011, 1, 1, 1, 8, 0))
+        
+        # jan 1, 2011 is a saturday
+        schedule = crontab(month='1,5', day='1,4,7', day_of_week='0,6', hour='*/4', minute='10-15')
+        self.assertEqual(schedule.next_fire_after(datetime.datetime(2011, 1, 1, 20, 15)),
+            datetime.datetime(2011, 5, 1, 0, 10))
+        
+        self.assertEqual(crontab(month=2, day=29).next_fire_after(datetime.datetime(2011, 1, 1)),
+            datetime.datetime(2012, 2, 29, 0, 0))
+        self.assertEqual(crontab(month=2, day=30).next_fire_after(datetime.datetime(2011, 1, 1)), None)
+        
+        # each match is the first datetime validated by the schedule
+        schedule = crontab(day_of_week='1', hour='8-9', minute='*/20')
+        dt = datetime.datetime(2011, 1, 1)
+        for i in range(20):
+            next_dt = schedule.next_fire_after(dt)
+            self.assertTrue(schedule(next_dt))
+            while dt + datetime.timedelta(minutes=1) < next_dt:
+                dt += datetime.timedelta(minutes=1)
+                self.assertFalse(schedule(dt.replace(second=0)))
+            dt = next_dt
+    
+    def test_periodic_scheduler(self):
+        start = datetime.datetime(2011, 1, 1, 1, 10, 30)
+        scheduler = PeriodicScheduler([every_fifteen.command_class(), TestPeriodicCommand()], start)
+        
+        # both commands are checked at the start of the next minute
+        self.assertEqual(scheduler.next_run(), datetime.datetime(2011, 1, 1, 1, 11))
+        self.assertEqual(scheduler.seconds_until_next(start), 30)
+        self.assertEqual(scheduler.pop_due(start), [])
+        
+        # commands are only returned when they validate
+        due = scheduler.pop_due(datetime.datetime(2011, 1, 1, 1, 11))
+        self.assertEqual(due, [])
+        
+        # the decorated command skips straight to its next tick
+        self.assertEqual(len(scheduler), 2)
+        self.assertEqual(sorted([dt for dt, _, _ in scheduler._heap]), [
+            datetime.datetime(2011, 1, 1, 1, 12),
+            datetime.datetime(2011, 1, 1, 1, 15),
+        ])
+        
+        # ticks missed during a pause are caught up
+        due = scheduler.pop_due(datetime.datetime(2011, 1, 1, 1, 45, 30))
+        self.assertEqual([(dt, type(command)) for dt, command in due], [
+            (datetime.datetime(2011, 1, 1, 1, 15), every_fifteen.command_class),
+            (datetime.datetime(2011, 1, 1, 1, 30), every_fifteen.command_class),
+            (datetime.datetime(2011, 1, 1, 1, 30), TestPeriodicCommand),
+            (datetime.datetime(2011, 1, 1, 1, 45), every_fifteen.command_class),
+        ])
+        
+        # but only up to a limit
+        scheduler.max_catchup = 2
+        due = scheduler.pop_due(datetime.datetime(2011, 1, 2, 1, 45, 30))
+        self.assertEqual(len(due), 2)
+        self.assertEqual(scheduler.next_run(), datetime.datetime(2011, 1, 2, 1, 46))
+    
+    def test_periodic_scheduler_lock(self):
+        start = datetime.datetime(2011, 1, 1, 1, 10, 30)
+        tick = datetime.datetime(2011, 1, 1, 1, 15)
+        command = every_fifteen.command_class()
+        
+        # without a lock every scheduler enqueues every tick
+        scheduler = PeriodicScheduler([command], start)
+        self.assertTrue(scheduler.claim(tick, command))
+        self.assertTrue(scheduler.claim(tick, command))
+        
+        # with a shared lock only the first consumer claims each tick
+        lock = CacheLock()
+        schedulers = [PeriodicScheduler([command], start, lock, 'q.') for i in range(3)]
+        claims = [s.claim(tick, command) for s in schedulers]
+        self.assertEqual(claims, [True, False, False])
+        
+        self.assertTrue(schedulers[1].claim(tick + datetime.timedelta(minutes=15), command))
+        self.assertFalse(schedulers[0].claim(tick + datetime.timedelta(minutes=15), command))
+        
+        # ticks are claimed per queue
+        other = PeriodicScheduler([command], start, lock, 'other.')
+        self.assertTrue(other.claim(tick, command))
+    
     def test_registry_get_periodic_commands(self):
         # three, one for the base class, one for the TestPeriodicCommand, and
         # one for the decorated function
@@ -312,6 +1658,40 @@ class QueueTest(TestCase):
         self.consumer_options['backoff'] = 2
         self.consumer_options['threads'] = 0
         self.assertRaises(CommandError, consumer.initialize_options, self.consumer_options)
+        
+        self.consumer_options['threads'] = 2
+        self.consumer_options['prefetch'] = 0
+        self.assertRaises(CommandError, consumer.initialize_options, self.consumer_options)
+        
+        # one dispatching thread is used per worker process
+        self.consumer_options['prefetch'] = 1
+        self.consumer_options['processes'] = 3
+        consumer.initialize_options(self.consumer_options)
+        self.assertEqual(consumer.threads, 3)
+        
+        self.consumer_options['processes'] = -1
+        self.assertRaises(CommandError, consumer.initialize_options, self.consumer_options)
+        
+        # autoscaling starts with --threads, kept within the range
+        self.consumer_options['processes'] = 0
+        self.consumer_options['max_threads'] = 8
+        consumer.initialize_options(self.consumer_options)
+        self.assertEqual((consumer.min_threads, consumer.threads, consumer.max_threads), (1, 2, 8))
+        
+        self.consumer_options['min_threads'] = 4
+        consumer.initialize_options(self.consumer_options)
+        self.assertEqual(consumer.threads, 4)
+        
+        self.consumer_options['min_threads'] = 10
+        self.assertRaises(CommandError, consumer.initialize_options, self.consumer_options)
+        
+        self.consumer_options['min_threads'] = 4
+        self.consumer_options['processes'] = 2
+        self.assertRaises(CommandError, consumer.initialize_options, self.consumer_options)
+        
+        self.consumer_options['processes'] = 0
+        self.consumer_options['max_threads'] = 0
+        self.assertRaises(CommandError, consumer.initialize_options, self.consumer_options)
     
     def test_consumer_delay(self):
         consumer = TestQueueConsumer()
@@ -348,8 +1728,331 @@ class QueueTest(TestCase):
         # make sure the delay was reset
         self.assertEqual(consumer.delay, .1)
     
+    def test_consumer_prefetch(self):
+        self.consumer_options['prefetch'] = 2
+        consumer = TestQueueConsumer()
+        consumer.initialize_options(self.consumer_options)
+        
+        other = User.objects.create_user('other', 'other@example.com', 'password')
+        user_command(self.dummy, 'first@example.com')
+        user_command(other, 'second@example.com')
+        user_command(self.dummy, 'third@example.com')
+        
+        # a single round-trip reads two messages
+        consumer.process_message()
+        self.assertEqual(len(invoker.queue), 1)
+        self.assertEqual(User.objects.get(username='username').email, 'first@example.com')
+        self.assertEqual(User.objects.get(username='other').email, 'second@example.com')
+        
+        consumer.process_message()
+        self.assertEqual(len(invoker.queue), 0)
+        self.assertEqual(User.objects.get(username='username').email, 'third@example.com')
+    
+    def test_read_many(self):
+        for i in range(3):
+            invoker.write('message-%d' % i)
+        
+        self.assertEqual(invoker.read_many(2), ['message-0', 'message-1'])
+        self.assertEqual(invoker.read_many(2), ['message-2'])
+        self.assertEqual(invoker.read_many(2), [])
+        
+        # removing a message takes the copy that would be read first
+        queue = invoker.queue
+        queue.write_many(['x', 'y', 'x'])
+        queue.write('y', 5)
+        self.assertTrue(queue.remove('y'))
+        self.assertFalse(queue.remove('z'))
+        self.assertTrue(queue.remove('x'))
+        self.assertEqual(queue.read_many(5), ['y', 'x'])
+        
+        # including messages stored before they were base64-encoded
+        QueueMessage.objects.create(queue=queue.name, message='old:message')
+        self.assertTrue(queue.remove('old:message'))
+        self.assertEqual(len(queue), 0)
+    
+    def test_claimed_messages(self):
+        invoker.write('first')
+        invoker.write('second')
+        
+        # simulate another consumer having claimed the oldest message
+        message = QueueMessage.objects.all()[0]
+        message.claim = 'another-consumer'
+        message.save()
+        
+        # claimed messages are invisible to everyone else
+        self.assertEqual(len(invoker.queue), 1)
+        self.assertEqual(invoker.read_many(2), ['second'])
+        self.assertEqual(invoker.read(), None)
+        
+        # the claiming consumer still owns its message
+        self.assertEqual(QueueMessage.objects.filter(claim='another-consumer').count(), 1)
+        
+        # the claim does not use a subquery, which MySQL rejects
+        invoker.write('third')
+        orig_debug = settings.DEBUG
+        settings.DEBUG = True
+        try:
+            del(connection.queries[:])
+            self.assertEqual(invoker.read(), 'third')
+            updates = [query['sql'] for query in connection.queries if query['sql'].startswith('UPDATE')]
+        finally:
+            settings.DEBUG = orig_debug
+        self.assertEqual(len(updates), 1)
+        self.assertFalse('SELECT' in updates[0])
+        
+        # rows claimed by another consumer between the SELECT and the UPDATE
+        # are replaced by the next unclaimed rows
+        invoker.queue.write_many(['r1', 'r2', 'r3', 'r4'])
+        select_pending = invoker.queue._select_pending
+        def race(n):
+            pending = select_pending(n)
+            QueueMessage.objects.filter(pk=pending[0]).update(claim='other')
+            invoker.queue._select_pending = select_pending
+            return pending
+        invoker.queue._select_pending = race
+        try:
+            self.assertEqual(invoker.read_many(2), ['r2', 'r3'])
+        finally:
+            del(invoker.queue._select_pending)
+        self.assertEqual(QueueMessage.objects.filter(claim='other').count(), 1)
+        self.assertEqual(invoker.read_many(2), ['r4'])
+        
+        # ...but only a bounded number of times
+        invoker.flush()
+        invoker.queue.write_many(['r1', 'r2', 'r3', 'r4'])
+        def always_lose(n):
+            pending = select_pending(n)
+            QueueMessage.objects.filter(pk__in=pending).update(claim='other')
+            return pending
+        invoker.queue._select_pending = always_lose
+        try:
+            self.assertEqual(invoker.read_many(1), [])
+        finally:
+            del(invoker.queue._select_pending)
+        self.assertEqual(QueueMessage.objects.filter(claim='other').count(), invoker.queue.claim_attempts)
+        self.assertEqual(invoker.read_many(2), ['r4'])
+        
+        # errors are not mistaken for an empty queue
+        def broken(*args):
+            raise DatabaseError('connection lost')
+        invoker.queue._claim_with_token = broken
+        try:
+            self.assertRaises(DatabaseError, invoker.read_many, 2)
+            
+            # the consumer logs them and backs off
+            consumer = TestQueueConsumer()
+            consumer.initialize_options(self.consumer_options)
+            consumer.process_message()
+            self.assertEqual(consumer.delay, .2)
+        finally:
+            del(invoker.queue._claim_with_token)
+        
+        # read messages are deleted, and flushing removes claimed messages too
+        invoker.flush()
+        self.assertEqual(QueueMessage.objects.count(), 0)
+    
     def test_daemon_multithreading(self):
-        pass
+        consumer = TestQueueConsumer()
+        consumer.initialize_options(self.consumer_options)
+        
+        # use a real buffer, holding one waiting message per worker thread
+        consumer._queue = IterableQueue(consumer.threads)
+        
+        record_thread.map([(i,) for i in range(6)])
+        messages = invoker.read_many(6)
+        
+        del executed[:]
+        consumer._workers = consumer.start_workers()
+        for message in messages:
+            consumer._queue.put((None, message))
+        
+        # stopping the consumer lets the workers drain the buffer
+        consumer.stop()
+        
+        self.assertEqual(sorted([value for value, _ in executed]), range(6))
+        
+        # the messages were shared between the same two long-lived threads
+        threads = set([thread for _, thread in executed])
+        self.assertEqual(threads, set(consumer._workers))
+        for worker in consumer._workers:
+            self.assertFalse(worker.is_alive())
+    
+    def test_autoscale(self):
+        self.consumer_options['threads'] = 1
+        self.consumer_options['max_threads'] = 4
+        
+        consumer = TestQueueConsumer()
+        consumer.initialize_options(self.consumer_options)
+        consumer.scale_down_after = 3
+        
+        # threads are added once every worker has been busy with messages
+        # waiting for two checks in a row
+        self.assertEqual(consumer.autoscale(1, 1, 5), 0)
+        self.assertEqual(consumer.autoscale(1, 1, 5), 3)
+        consumer.threads = 4
+        self.assertEqual(consumer.autoscale(4, 0, 10), 0)
+        self.assertEqual(consumer.autoscale(4, 0, 10), 0)
+        
+        # and removed once they have been idle for three checks in a row,
+        # only as many as were idle at every check
+        self.assertEqual(consumer.autoscale(2, 0, 0), 0)
+        self.assertEqual(consumer.autoscale(1, 0, 0), 0)
+        self.assertEqual(consumer.autoscale(3, 0, 0), -1)
+        consumer.threads = 3
+        
+        # a burst in between starts the count over
+        self.assertEqual(consumer.autoscale(0, 0, 0), 0)
+        self.assertEqual(consumer.autoscale(0, 0, 0), 0)
+        self.assertEqual(consumer.autoscale(3, 1, 0), 0)
+        self.assertEqual(consumer.autoscale(0, 0, 0), 0)
+        self.assertEqual(consumer.autoscale(0, 0, 0), 0)
+        self.assertEqual(consumer.autoscale(0, 0, 0), -2)
+        consumer.threads = 1
+        
+        # never fewer than min-threads
+        for i in range(5):
+            self.assertEqual(consumer.autoscale(0, 0, 0), 0)
+    
+    def test_scale_workers(self):
+        self.consumer_options['threads'] = 1
+        self.consumer_options['max_threads'] = 4
+        
+        consumer = TestQueueConsumer()
+        consumer.initialize_options(self.consumer_options)
+        consumer._queue = IterableQueue(consumer.threads)
+        consumer._workers = consumer.start_workers()
+        
+        consumer.scale_workers(3)
+        self.assertEqual(consumer.threads, 4)
+        self.assertEqual(consumer._queue.maxsize, 4)
+        self.assertEqual(len([w for w in consumer._workers if w.is_alive()]), 4)
+        
+        record_thread.map([(i,) for i in range(8)])
+        messages = invoker.read_many(8)
+        del executed[:]
+        for message in messages[:4]:
+            consumer._queue.put((None, message))
+        
+        # stopped threads finish what is in the buffer first
+        consumer.scale_workers(-3)
+        self.assertEqual(consumer.threads, 1)
+        self.assertEqual(consumer._queue.maxsize, 1)
+        for message in messages[4:]:
+            consumer._queue.put((None, message))
+        
+        start = time.time()
+        while len([w for w in consumer._workers if w.is_alive()]) > 1 and time.time() - start < 5:
+            time.sleep(.01)
+        self.assertEqual(len([w for w in consumer._workers if w.is_alive()]), 1)
+        
+        consumer.stop()
+        self.assertEqual(sorted([value for value, _ in executed]), range(8))
+        for worker in consumer._workers:
+            self.assertFalse(worker.is_alive())
+    
+    def test_daemon_multiprocessing(self):
+        self.consumer_options['processes'] = 2
+        self.consumer_options['max_tasks_per_child'] = 1
+        
+        consumer = TestQueueConsumer()
+        consumer.initialize_options(self.consumer_options)
+        
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        
+        record_pid.map([(filename,)] * 4)
+        messages = invoker.read_many(4)
+        
+        consumer._process_pool = consumer.start_process_pool()
+        try:
+            for message in messages:
+                consumer.execute_message(message)
+        finally:
+            consumer.stop_process_pool()
+        
+        fh = open(filename)
+        pids = [int(pid) for pid in fh.read().split()]
+        fh.close()
+        os.unlink(filename)
+        
+        # the commands ran outside this process, and each worker process was
+        # replaced after executing a single message
+        self.assertEqual(len(pids), 4)
+        self.assertFalse(os.getpid() in pids)
+        self.assertEqual(len(set(pids)), 4)
+    
+    def test_soft_time_limit(self):
+        stats.reset()
+        self.assertRaises(ValueError, queue_command, soft_time_limit=10, time_limit=5)
+        
+        consumer = TestQueueConsumer()
+        consumer.initialize_options(self.consumer_options)
+        
+        # the soft limit is raised in the thread executing the command
+        spin(5)
+        start = time.time()
+        consumer.execute_message(invoker.read())
+        self.assertTrue(time.time() - start < 2)
+        self.assertEqual(len(invoker.get_dead_queue()), 1)
+        
+        # a command finishing within its limit is left alone, and so is the
+        # thread afterwards
+        spin(.05)
+        consumer.execute_message(invoker.read())
+        spin.command_class.soft_time_limit = None
+        try:
+            spin.command_class(((.3,), {})).execute()
+        finally:
+            spin.command_class.soft_time_limit = .2
+        
+        spin_stats = stats.snapshot()['commands']['djutils.tests.queue.queuecmd_spin']
+        self.assertEqual(spin_stats['executed'], 1)
+        self.assertEqual(spin_stats['failed'], 1)
+        self.assertEqual(spin_stats['timeouts'], 1)
+    
+    def test_hard_time_limit(self):
+        stats.reset()
+        self.consumer_options['processes'] = 1
+        
+        consumer = TestQueueConsumer()
+        consumer.initialize_options(self.consumer_options)
+        
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        
+        hang(False)
+        hang(True)
+        record_pid(filename)
+        messages = invoker.read_many(3)
+        
+        consumer._process_pool = consumer.start_process_pool()
+        try:
+            # the soft limit interrupts the sleep in the worker process
+            start = time.time()
+            consumer.execute_message(messages.pop(0))
+            self.assertTrue(time.time() - start < 1)
+            
+            # ignoring it gets the worker process killed
+            consumer.execute_message(messages.pop(0))
+            self.assertTrue(time.time() - start < 4)
+            
+            # and replaced by the pool
+            consumer.execute_message(messages.pop(0))
+            self.assertEqual(len(consumer._abandoned), 1)
+        finally:
+            # the lost job does not hold up shutting the pool down
+            consumer.stop_process_pool()
+        
+        fh = open(filename)
+        pids = fh.read().split()
+        fh.close()
+        os.unlink(filename)
+        self.assertEqual(len(pids), 1)
+        
+        hang_stats = stats.snapshot()['commands']['djutils.tests.queue.queuecmd_hang']
+        self.assertEqual(hang_stats['failed'], 2)
+        self.assertEqual(hang_stats['timeouts'], 2)
+        self.assertEqual(len(invoker.get_dead_queue()), 2)
     
     def test_daemon_periodic_commands(self):
         pass
@@ -359,3 +2062,163 @@ class QueueTest(TestCase):
     
     def test_daemon_periodic_thread_exception(self):
         pass
+
+
+# the redis tests are skipped unless a server is listening here, they only
+# touch keys belonging to their own queues
+REDIS_TEST_CONNECTION = os.environ.get('DJUTILS_TEST_REDIS', 'localhost:6379:15')
+
+class RedisQueueTest(TestCase):
+    def setUp(self):
+        try:
+            get_redis_connection(REDIS_TEST_CONNECTION).ping()
+        except Exception, exc:
+            self.skipTest('redis is not available at %s: %s' % (REDIS_TEST_CONNECTION, exc))
+        
+        self.queues = []
+    
+    def tearDown(self):
+        for queue in self.queues:
+            queue.flush()
+    
+    def get_queue(self, queue_class, name='djutils-test'):
+        queue = queue_class(name, REDIS_TEST_CONNECTION)
+        queue.flush()
+        self.queues.append(queue)
+        return queue
+    
+    def assertReadsInOrder(self, queue):
+        queue.write('a')
+        queue.write_many(['b', 'c'])
+        queue.write('urgent', 5)
+        queue.write_many(['later', 'last'], -1)
+        queue.write('urgent-2', 5)
+        
+        self.assertEqual(len(queue), 7)
+        expected = ['urgent', 'urgent-2', 'a', 'b', 'c', 'later', 'last']
+        self.assertEqual(queue.peek(10), expected)
+        self.assertEqual(queue.read(), 'urgent')
+        self.assertEqual(queue.read_many(5), expected[1:6])
+        self.assertEqual(queue.read_many(5), ['last'])
+        self.assertEqual(queue.read_many(5), [])
+        self.assertEqual(queue.read(), None)
+        self.assertEqual(len(queue), 0)
+        
+        for message in expected:
+            queue.ack(message)
+        
+        # removing a message takes the copy that would be read first
+        queue.write_many(['x', 'y', 'x'])
+        queue.write('y', 5)
+        self.assertTrue(queue.remove('y'))
+        self.assertFalse(queue.remove('z'))
+        self.assertTrue(queue.remove('x'))
+        self.assertEqual(queue.read_many(5), ['y', 'x'])
+        for message in ['y', 'x']:
+            queue.ack(message)
+    
+    def assertPromotes(self, queue):
+        now = datetime.datetime.now()
+        start = time.time()
+        queue.schedule('due', now - datetime.timedelta(seconds=1))
+        queue.schedule('due-urgent', now - datetime.timedelta(seconds=1), 5)
+        queue.schedule('not-due', now + datetime.timedelta(seconds=60))
+        
+        # scheduled messages cannot be read until they are promoted
+        self.assertTrue(abs(queue.next_eta() - start + 1) < .1)
+        self.assertEqual(queue.read(), None)
+        self.assertEqual(queue.promote(), 2)
+        self.assertEqual(queue.promote(), 0)
+        self.assertEqual(queue.read_many(5), ['due-urgent', 'due'])
+        self.assertTrue(abs(queue.next_eta() - start - 60) < .1)
+        queue.ack('due-urgent')
+        queue.ack('due')
+    
+    def test_redis_queue(self):
+        queue = self.get_queue(RedisQueue)
+        self.assertReadsInOrder(queue)
+        self.assertPromotes(queue)
+        
+        # named queues are stored under their own keys, even when their names
+        # only differ in characters that are stripped from the queue's name
+        test_invoker = Invoker(queue)
+        lanes = [test_invoker.get_queue(name) for name in ('email', 'e-mail', 'mages', 'Images')]
+        lanes.append(test_invoker.get_dead_queue())
+        self.queues.extend(lanes)
+        self.assertEqual(len(set([lane.queue_name for lane in lanes + [queue]])), 6)
+        self.assertEqual(lanes[1].queue_name, queue.queue_name + ':e-mail')
+        
+        for lane in lanes:
+            lane.write(lane.name)
+        for lane in lanes:
+            self.assertEqual(lane.read_many(5), [lane.name])
+        self.assertEqual(len(queue), 0)
+    
+    def test_blocking_queue(self):
+        queue = self.get_queue(RedisBlockingQueue)
+        self.assertReadsInOrder(queue)
+        self.assertPromotes(queue)
+        
+        # every lane is read without blocking before blocking on all of them
+        test_invoker = Invoker(queue)
+        images = test_invoker.get_queue('images')
+        email = test_invoker.get_queue('email')
+        self.queues.extend([images, email])
+        images.write('thumbnail')
+        
+        start = time.time()
+        self.assertEqual(test_invoker.read_first(5, ['email', 'images']), ('images', ['thumbnail']))
+        self.assertTrue(time.time() - start < .5)
+        
+        # the blocking read returns as soon as any lane has a message
+        def write_later():
+            time.sleep(.2)
+            email.write('hello')
+        threading.Thread(target=write_later).start()
+        
+        start = time.time()
+        self.assertEqual(test_invoker.read_first(5, ['images', 'email']), ('email', ['hello']))
+        self.assertTrue(time.time() - start < .8)
+        
+        # or once the timeout is up
+        start = time.time()
+        self.assertEqual(test_invoker.read_first(5, ['images', 'email']), (None, []))
+        self.assertTrue(time.time() - start < queue.block_timeout + .5)
+    
+    def test_reliable_queue(self):
+        queue = self.get_queue(RedisReliableQueue)
+        self.assertReadsInOrder(queue)
+        self.assertPromotes(queue)
+        
+        queue.write_many(['a', 'b', 'c'])
+        self.assertEqual(queue.read_many(2), ['a', 'b'])
+        
+        # read messages are held until they are acknowledged
+        processing = queue.get_processing_name()
+        self.assertEqual(queue.conn.llen(processing), 2)
+        self.assertEqual(len(queue), 1)
+        queue.ack('a')
+        queue.ack('unknown')
+        self.assertEqual(queue.conn.llen(processing), 1)
+        
+        # unacknowledged messages stay put until the visibility timeout
+        self.assertEqual(queue.reap(), 0)
+        self.assertEqual(queue.conn.llen(processing), 1)
+        
+        # and are then put back to be read first
+        queue.visibility_timeout = 0
+        self.assertEqual(queue.reap(), 1)
+        self.assertEqual(queue.conn.llen(processing), 0)
+        self.assertFalse(queue.conn.sismember(queue.processing_set, processing))
+        self.assertEqual(queue.read_many(5), ['b', 'c'])
+        
+        # messages keep their priority when they are put back
+        queue.write('normal')
+        queue.write('urgent', 5)
+        self.assertEqual(queue.read(), 'urgent')
+        self.assertEqual(queue.reap(), 3)
+        self.assertEqual(queue.read_many(5), ['urgent', 'b', 'c', 'normal'])
+        
+        for message in ['urgent', 'b', 'c', 'normal']:
+            queue.ack(message)
+        self.assertEqual(queue.conn.llen(processing), 0)